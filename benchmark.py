@@ -0,0 +1,221 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import data_preprocessing as dp
+import grid_utils as gu
+import npps_analysis as na
+import rebalancer as rb
+import sector_optimization as so
+import snapping as sn
+import synthetic
+from workload import SectorLedger
+
+# Size each stage is expected to scale with, for the fitted exponents.
+# rebalance_sectors runs a fixed iteration budget (rebalance_iter), so its
+# time tracks the budget rather than the grid; it is timed (with the max/min
+# ratio it reached) but not fitted. multilevel_rebalance runs to convergence.
+STAGE_SIZE = {
+    "create_grid": "n_cells",
+    "assign_sectors_to_grid": "n_cells",
+    "identify_boundary_grids": "n_cells",
+    "calculate_npps": "n_incidents",
+    "aggregate_npps_by_grid": "n_incidents",
+    "bulk_transfers": "n_cells",
+    "multilevel_rebalance": "n_cells",
+    "smooth_sectors": "n_cells",
+}
+
+
+def _time(fn, repeats, setup=None):
+    """Best wall time of fn over repeats (stage logging below WARNING muted); returns (seconds, last result)."""
+    best = float("inf")
+    result = None
+    logging.disable(logging.INFO)
+    try:
+        for _ in range(repeats):
+            args = setup() if setup is not None else ()
+            start = time.perf_counter()
+            result = fn(*args)
+            best = min(best, time.perf_counter() - start)
+    finally:
+        logging.disable(logging.NOTSET)
+    return best, result
+
+
+def _bulk_transfers(grid, neighbors, excess, deficient):
+    ledger = SectorLedger.from_grid(grid)
+    grid, _ = so.give_bulk_boundaries_from_excess(grid, neighbors, excess, ledger, True)
+    grid, _ = so.take_bulk_boundaries_to_deficient(grid, deficient, neighbors[deficient], ledger, True)
+    return grid
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_metadata():
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "geopandas": gpd.__version__,
+        "shapely": shapely.__version__,
+    }
+
+
+def run_benchmarks(cell_sizes, incident_counts, repeats=3, n_sectors=14, seed=0, snap=True,
+                   rebalance_iter=50000):
+    """
+    Time each pipeline stage on a synthetic city across grid cell sizes and
+    incident volumes. Grid stages run once per cell size (with the largest
+    incident volume for the optimization and snapping stages); NPPS stages
+    run for every incident volume.
+    Returns a list of result dicts: stage, cell_size, n_cells, n_incidents,
+    seconds (plus max_min_ratio for the rebalancing stages)
+    """
+    beats = synthetic.synthetic_beats(n_sectors, seed=seed)
+    neighbors = synthetic.synthetic_sector_neighbors(beats)
+    streets = synthetic.synthetic_streets()
+    results = []
+
+    def record(stage, seconds, cell_size, n_cells, n_incidents, **extra):
+        results.append({"stage": stage, "cell_size": cell_size, "n_cells": int(n_cells),
+                        "n_incidents": int(n_incidents), "seconds": seconds, **extra})
+        print(f"⏱️ {stage:<24} cell={cell_size:<8g} cells={n_cells:<9d} "
+              f"incidents={n_incidents:<9d} {seconds:.4f}s")
+
+    scored = {}
+    for n in incident_counts:
+        raw = dp.preprocess_incident_data(synthetic.synthetic_incidents(n, seed=seed))
+        seconds, scored[n] = _time(dp.calculate_npps, repeats, setup=lambda: (raw.copy(),))
+        record("calculate_npps", seconds, 0.0, 0, n)
+
+    for cell_size in cell_sizes:
+        seconds, lattice = _time(gu.create_grid, repeats, setup=lambda: (beats, cell_size))
+        record("create_grid", seconds, cell_size, len(lattice), 0)
+        seconds, grid = _time(gu.assign_sectors_to_grid, repeats, setup=lambda: (lattice, beats))
+        n_cells = len(grid)
+        record("assign_sectors_to_grid", seconds, cell_size, n_cells, 0)
+        seconds, _ = _time(gu.identify_boundary_grids, repeats, setup=lambda: (grid,))
+        record("identify_boundary_grids", seconds, cell_size, n_cells, 0)
+
+        for n in incident_counts:
+            seconds, npps_grid = _time(na.aggregate_npps_by_grid, repeats, setup=lambda: (scored[n], grid))
+            record("aggregate_npps_by_grid", seconds, cell_size, n_cells, n)
+
+        n = incident_counts[-1]
+        totals = SectorLedger.from_grid(npps_grid)
+        order = totals.sectors[np.argsort(totals.totals)]
+        excess = [int(s) for s in order[-3:]]
+        deficient = int(order[0])
+        seconds, _ = _time(_bulk_transfers, repeats,
+                           setup=lambda: (npps_grid.copy(), neighbors, excess, deficient))
+        record("bulk_transfers", seconds, cell_size, n_cells, n)
+        seconds, (_, _, stats) = _time(lambda g: rb.rebalance_sectors(g, rebalance_iter, seed=seed, contiguous=True),
+                                       repeats, setup=lambda: (npps_grid.copy(),))
+        record("rebalance_sectors", seconds, cell_size, n_cells, n,
+               iterations=stats["iterations"], max_min_ratio=stats["final_ratio"])
+        seconds, (_, _, stats) = _time(lambda g: rb.multilevel_rebalance(g, seed=seed, contiguous=True),
+                                       repeats, setup=lambda: (npps_grid.copy(),))
+        record("multilevel_rebalance", seconds, cell_size, n_cells, n, max_min_ratio=stats["final_ratio"])
+        if snap:
+            with tempfile.TemporaryDirectory() as output_dir:
+                seconds, _ = _time(sn.smooth_sectors, repeats,
+                                   setup=lambda: (npps_grid, streets, output_dir, 1))
+            record("smooth_sectors", seconds, cell_size, n_cells, n)
+    return results
+
+
+def scaling_exponents(results):
+    """
+    Fitted log-log slope of seconds against each stage's size (STAGE_SIZE),
+    using the runs at the largest value of the other size.
+    Returns {stage: exponent}; stages with fewer than two sizes are omitted.
+    """
+    df = pd.DataFrame(results)
+    exponents = {}
+    for stage, size in STAGE_SIZE.items():
+        rows = df[df["stage"] == stage]
+        other = "n_incidents" if size == "n_cells" else "n_cells"
+        rows = rows[rows[other] == rows[other].max()]
+        rows = rows[(rows[size] > 0) & (rows["seconds"] > 0)]
+        if rows[size].nunique() < 2:
+            continue
+        slope = np.polyfit(np.log(rows[size]), np.log(rows["seconds"]), 1)[0]
+        exponents[stage] = round(float(slope), 3)
+    return exponents
+
+
+def compare_results(current, baseline, threshold=1.2):
+    """
+    Compare two benchmark runs on matching (stage, cell_size, n_incidents).
+    Returns DataFrame: stage, cell_size, n_incidents, seconds_old, seconds_new,
+    ratio, regression (ratio above threshold)
+    """
+    keys = ["stage", "cell_size", "n_incidents"]
+    old = pd.DataFrame(baseline["results"])[keys + ["seconds"]]
+    new = pd.DataFrame(current["results"])[keys + ["seconds"]]
+    merged = old.merge(new, on=keys, suffixes=("_old", "_new"))
+    merged["ratio"] = merged["seconds_new"] / merged["seconds_old"]
+    merged["regression"] = merged["ratio"] > threshold
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data.")
+    parser.add_argument("--cell-sizes", type=float, nargs="+", default=[0.002, 0.001, 0.0005])
+    parser.add_argument("--incidents", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--repeats", type=int, default=3, help="best-of repeats per timing")
+    parser.add_argument("--sectors", type=int, default=14)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-snap", action="store_true", help="skip the smooth_sectors stage")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio flagged as a regression")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(sorted(args.cell_sizes, reverse=True), sorted(args.incidents),
+                             repeats=args.repeats, n_sectors=args.sectors, seed=args.seed,
+                             snap=not args.no_snap)
+    report = {
+        "meta": run_metadata(),
+        "params": {"cell_sizes": args.cell_sizes, "incidents": args.incidents, "repeats": args.repeats,
+                   "sectors": args.sectors, "seed": args.seed},
+        "results": results,
+        "scaling": scaling_exponents(results),
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"📈 Scaling exponents: {report['scaling']}")
+    print(f"Benchmark results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparison = compare_results(report, baseline, args.threshold)
+        print(comparison.to_string(index=False))
+        if comparison["regression"].any():
+            print(f"⚠️ {int(comparison['regression'].sum())} stage timing(s) slower than {args.threshold}x baseline")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,28 @@
 # File paths
 SHAPEFILE_PATH = "bpd_final/Balanced_Beats_V2.shp"
 YEAR_DATA_PATH = "bpd_final/2024.csv"
+INCIDENT_DATA_DIR = None  # directory of yearly CSVs (e.g. 2015.csv ... 2025.csv); None loads YEAR_DATA_PATH
 CENTERLINES_PATH = "bpd_final/Centerlines.shp"
-FINAL_GRID_PATH = "bpd_final/final_grid.shp"
-SNAPPED_SECTORS_PATH = "bpd_final/output/snapped_sectors.shp"
+FINAL_GRID_PATH = "bpd_final/final_grid.gpkg"  # format from the extension: .parquet (GeoParquet), .gpkg, .shp or .lattice
+FINAL_LATTICE_PATH = "bpd_final/output/final_grid.lattice"  # compact memory-mappable grid for dashboards; None skips it
+SNAPPED_SECTORS_PATH = "bpd_final/output/snapped_sectors.gpkg"
+EXPORT_NPPS_CUBE = False  # also export the per-cell hour-of-week NPPS series with the final grid
+
+# Streaming ingest
+INGEST_CHUNK_SIZE = 250000  # rows per CSV chunk
+
+# Stage cache
+CACHE_ENABLED = True
+CACHE_DIR = "bpd_final/.stage_cache"
+CACHE_MAX_BYTES = 2 * 1024 ** 3  # least recently used entries are evicted beyond this
 
 # Grid parameters
 CELL_SIZE = 0.001  # 100m grid
+GRID_MODE = "uniform"  # "uniform" CELL_SIZE lattice or "quadtree" (refined by incident density and beat boundaries)
+QUADTREE_MIN_CELL_SIZE = 0.0001  # ~10m finest quadtree cells
+QUADTREE_LEVELS = 5  # quadtree cell sizes MIN_CELL_SIZE * 1, 2, 4, 8, 16
+QUADTREE_BOUNDARY_CELL_SIZE = 0.0008  # cells straddling a beat boundary are split down to this size
+QUADTREE_TARGET_CELLS = None  # quadtree cell budget; None matches the uniform CELL_SIZE grid's cell count
 
 # NPPS weights
 PRIORITY_WEIGHTS = {1: 1.0, 2: 0.7, 3: 0.4, 4: 0.2, 5: 0.1}
@@ -22,24 +38,45 @@ NPPS_WEIGHTS = {
 OUTLIER_METHOD = "IQR"
 OUTLIER_REPLACEMENT = 0
 
+# Time-sliced NPPS
+TIMESTAMP_COLUMN = "Create Time"  # incident timestamp column used for the hour-of-week NPPS cube
+SHIFTS = {  # (start hour, end hour), end exclusive; shifts ending at or before their start run past midnight
+    "day": (6, 16),
+    "evening": (14, 24),
+    "night": (22, 8),
+}
+REBALANCE_SHIFT_MIX = None  # e.g. {"night": 1.0} or {"day": 0.5, "night": 0.5}; None balances all-hours NPPS
+REPORT_SHIFT_BALANCE = False  # build the hour-of-week cube to report per-shift sector balance (run report, service /balance)
+
+# Optimization parameters
+OPTIMIZATION_METHOD = "local_search"  # "local_search", "multilevel" or "bulk"; use "multilevel" below ~50m cells, where local search needs far more than REBALANCE_MAX_ITER moves
+BULK_EXCESS_TOLERANCE = 0.15  # bulk method: sectors more than this fraction above the mean give boundary cells away; the lightest sector then pulls from its neighbors
+REBALANCE_MAX_ITER = 500000
+REBALANCE_TIME_LIMIT = None  # seconds, None for iteration budget only
+REBALANCE_SEED = 0
+REBALANCE_STARTS = 1  # >1 runs independent searches across a process pool
+REBALANCE_WORKERS = None  # None uses one worker per CPU core
+REBALANCE_PERTURB_MOVES = 0  # random boundary moves applied before each multi-start run
+PRESERVE_CONTIGUITY = True  # reject cell moves that would split a sector
+TRAVEL_WEIGHT = 0.0  # local-search penalty (squared-NPPS units) per CELL_SIZE cell per meter of road distance from its sector centre; 0 disables
+
 # Snapping parameters
 SNAP_TOLERANCE = 50  # meters
+SNAP_WORKERS = 1  # processes for per-sector snapping; None uses one per CPU core
+SNAP_CRS = None  # projected metric CRS used for snapping; None estimates the local UTM zone
+
+# Scenario engine
+SCENARIO_WORKERS = None  # processes for scenarios.run_scenarios; None uses one per CPU core
+
+# Rebalancing service
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_SOCKET = None  # Unix socket path; overrides host/port when set
+SERVICE_WORKERS = 2  # processes for rebalancing requests
 
-# Sector neighbors
-def get_sector_neighbors():
-    return {
-        1: [2],
-        2: [1, 3, 4, 14],
-        3: [2, 4, 5, 11, 12, 14],
-        4: [2, 3, 5, 6],
-        5: [3, 4, 6, 9, 10, 11],
-        6: [4, 5, 7, 8, 9],
-        7: [6, 8],
-        8: [6, 7, 9],
-        9: [5, 6, 8, 10],
-        10: [5, 9, 11],
-        11: [3, 5, 10, 12],
-        12: [3, 11, 13],
-        13: [12, 14],
-        14: [2, 3, 13]
-    } 
\ No newline at end of file
+# Logging and run report
+LOG_LEVEL = "INFO"  # "WARNING" silences progress output (and its DataFrame formatting) for batch runs
+RUN_REPORT_PATH = "bpd_final/output/run_report.json"
+PROFILE_STAGES = False  # cProfile each stage; top functions go in the run report
+PROFILE_DIR = "bpd_final/output/profiles"  # per-stage .prof dumps when PROFILE_STAGES is on
+TRACE_MEMORY = False  # tracemalloc peak and top allocation sites per stage (slows the run)
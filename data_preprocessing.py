@@ -5,6 +5,8 @@ import re
 from sklearn.preprocessing import MinMaxScaler
 import config
 
+INCIDENT_COLUMNS = ['Priority', 'lat', 'lon', 'Time Spent Responding', 'Dispositions']
+
 
 def load_shapefile():
     """Load the patrol sector shapefile and ensure 'Sector' is int."""
@@ -20,20 +22,32 @@ def load_incident_data():
 
 
 def preprocess_incident_data(df):
-    """Select relevant columns and clean the data."""
-    selected_columns = ['Priority', 'lat', 'lon', 'Time Spent Responding', 'Dispositions']
-    new_df = df[selected_columns].copy()
+    """
+    Select relevant columns and clean the data.
+    The incident timestamp (config.TIMESTAMP_COLUMN) is kept when present.
+    """
+    columns = INCIDENT_COLUMNS + [c for c in [config.TIMESTAMP_COLUMN] if c in df.columns]
+    new_df = df[columns].copy()
     return new_df
 
 
-def replace_outliers_with_zero(df, column):
-    """Replace outliers in a column with zero using IQR method."""
-    Q1 = df[column].quantile(0.25)
-    Q3 = df[column].quantile(0.75)
-    IQR = Q3 - Q1
-    lower_bound = Q1 - 1.5 * IQR
-    upper_bound = Q3 + 1.5 * IQR
-    df[column] = df[column].apply(lambda x: config.OUTLIER_REPLACEMENT if x < lower_bound or x > upper_bound else x)
+def iqr_bounds(q1, q3):
+    """Lower and upper outlier bounds from the first and third quartiles."""
+    iqr = q3 - q1
+    return q1 - 1.5 * iqr, q3 + 1.5 * iqr
+
+
+def replace_outliers_with_zero(df, column, bounds=None):
+    """
+    Replace outliers in a column with zero using IQR method.
+    bounds=(lower, upper) can be passed when the quartiles were computed
+    over a larger dataset than df (streaming ingest).
+    """
+    if bounds is None:
+        bounds = iqr_bounds(df[column].quantile(0.25), df[column].quantile(0.75))
+    lower_bound, upper_bound = bounds
+    values = df[column]
+    df[column] = values.where(~((values < lower_bound) | (values > upper_bound)), config.OUTLIER_REPLACEMENT)
     return df
 
 
@@ -59,19 +73,56 @@ def get_disposition_weight(disposition):
         return 0.3
 
 
-def calculate_npps(df):
-    """Calculate NPPS score for each row."""
+def priority_lookup(priority):
+    """
+    Vectorized extract_priority and PRIORITY_WEIGHTS lookup.
+    Each distinct Priority value is parsed once; rows are filled by their
+    factorized codes. Returns (priority_numeric, priority_weight) arrays.
+    """
+    codes, uniques = pd.factorize(priority)
+    text = pd.Series(uniques, dtype=object).astype(str)
+    digits = text.str.extract(r'(\d+)', expand=False)
+    numeric = pd.to_numeric(digits).fillna(0).to_numpy(dtype=np.int64)
+    weight = np.array([config.PRIORITY_WEIGHTS.get(x, 0.0) for x in numeric], dtype=np.float64)
+    # NaN/None get code -1, which maps to the trailing 0 / 0.0 entry
+    numeric = np.append(numeric, 0)
+    weight = np.append(weight, config.PRIORITY_WEIGHTS.get(0, 0.0))
+    return numeric[codes], weight[codes]
+
+
+def disposition_lookup(dispositions):
+    """
+    Vectorized get_disposition_weight over the distinct Dispositions values.
+    Returns an array of disposition weights.
+    """
+    codes, uniques = pd.factorize(dispositions)
+    text = pd.Series(uniques, dtype=object).astype(str).str.lower()
+    weight = np.select(
+        [text.str.contains("arrest", regex=False), text.str.contains("case", regex=False)],
+        [1.0, 0.7],
+        default=0.3
+    )
+    # NaN/None get code -1, which maps to the trailing default weight
+    weight = np.append(weight, 0.3)
+    return weight[codes]
+
+
+def calculate_npps(df, bounds=None, scaler=None):
+    """
+    Calculate NPPS score for each row.
+    Outlier bounds and the fitted response-time MinMaxScaler are computed
+    from df unless given (streaming ingest passes dataset-wide ones).
+    """
     # Outlier handling
-    df = replace_outliers_with_zero(df, 'Time Spent Responding')
-    # Priority numeric
-    df['Priority Numeric'] = df['Priority'].apply(extract_priority)
-    # Priority weight
-    df['Priority Weight'] = df['Priority Numeric'].apply(lambda x: config.PRIORITY_WEIGHTS.get(x, 0.0))
+    df = replace_outliers_with_zero(df, 'Time Spent Responding', bounds)
+    # Priority numeric and weight
+    df['Priority Numeric'], df['Priority Weight'] = priority_lookup(df['Priority'])
     # Scaled response time
-    scaler = MinMaxScaler()
-    df['Scaled Response Time'] = scaler.fit_transform(df[['Time Spent Responding']])
+    if scaler is None:
+        scaler = MinMaxScaler().fit(df[['Time Spent Responding']])
+    df['Scaled Response Time'] = scaler.transform(df[['Time Spent Responding']])
     # Disposition weight
-    df['Disposition Weight'] = df['Dispositions'].apply(get_disposition_weight)
+    df['Disposition Weight'] = disposition_lookup(df['Dispositions'])
     # NPPS calculation
     w = config.NPPS_WEIGHTS
     df['NPPS'] = (
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from pyproj import CRS
+import grid_utils as gu
+import npps_cube
+
+try:
+    import pyarrow
+except ImportError:  # optional, only needed for .parquet output
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+LATTICE_FORMAT_VERSION = 1
+LATTICE_META = "lattice.json"
+CUBE_ARRAY = "npps_by_hour"
+
+
+def cube_columns(cube):
+    """Per-cell NPPS time series as one column per hour-of-week bin (npps_h000 ... npps_h167)."""
+    return {f"npps_h{b:03d}": cube.values[:, b] for b in range(cube.values.shape[1])}
+
+
+def write_frame(frame, path):
+    """
+    Write a GeoDataFrame in bulk, choosing the format from the extension:
+    .parquet (GeoParquet, needs pyarrow), .gpkg (GeoPackage) or .shp.
+    Existing output at path is replaced.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if ext == ".parquet":
+        if pyarrow is None:
+            raise ImportError(f"Writing {path} needs pyarrow (pip install pyarrow), or use a .gpkg or .shp path")
+        frame.to_parquet(path, index=False)
+    elif ext == ".gpkg":
+        if os.path.exists(path):
+            os.remove(path)
+        frame.to_file(path, driver="GPKG", index=False)
+    elif ext == ".shp":
+        frame.to_file(path)
+    else:
+        raise ValueError(f"Unsupported export format '{ext}' (use .parquet, .gpkg, .shp or .lattice)")
+
+
+def save_lattice(grid, path, cube=None):
+    """
+    Write a grid in the compact lattice format: a directory holding
+    lattice.json (origin, cell size, extent, CRS and column dtypes) and one
+    .npy array per column, plus the cells x hour-of-week NPPS cube when
+    given. No geometry is stored; load_lattice rebuilds the grid and cell
+    polygons come from CompactGrid.to_geodataframe() when needed.
+    """
+    if not isinstance(grid, gu.CompactGrid):
+        grid = gu.CompactGrid.from_geodataframe(grid)
+    lattice = grid.lattice
+    arrays = {name: grid[name].to_numpy() for name in grid.columns}
+    if cube is not None:
+        arrays[CUBE_ARRAY] = cube.values
+    meta = {
+        "format": "lattice", "version": LATTICE_FORMAT_VERSION,
+        "minx": lattice.minx, "miny": lattice.miny, "cell_size": lattice.cell_size,
+        "n_rows": lattice.n_rows, "n_cols": lattice.n_cols,
+        "crs": None if lattice.crs is None else CRS.from_user_input(lattice.crs).to_wkt(),
+        "n_cells": len(grid), "columns": grid.columns, "cube": cube is not None,
+    }
+    # Written next to the target and swapped in, so readers never see a partial result
+    tmp = f"{path.rstrip(os.sep)}.tmp{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(values))
+    with open(os.path.join(tmp, LATTICE_META), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+def load_lattice(path, mmap_mode="r"):
+    """
+    Load a grid written by save_lattice. Arrays are memory-mapped by default
+    (mmap_mode=None reads them into memory), so loading costs milliseconds
+    regardless of grid size.
+    Returns (CompactGrid, NppsCube or None)
+    """
+    with open(os.path.join(path, LATTICE_META)) as f:
+        meta = json.load(f)
+    if meta.get("format") != "lattice" or meta.get("version", 0) > LATTICE_FORMAT_VERSION:
+        raise ValueError(f"{path} is not a lattice export this version can read")
+
+    def load(name):
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+    lattice = gu.LatticeGrid(meta["minx"], meta["miny"], meta["cell_size"],
+                             meta["n_rows"], meta["n_cols"], crs=meta["crs"])
+    grid = gu.CompactGrid(lattice, {name: load(name) for name in meta["columns"]})
+    cube = npps_cube.NppsCube(load(CUBE_ARRAY)) if meta["cube"] else None
+    return grid, cube
+
+
+def export_grid(grid, path, cube=None):
+    """
+    Export a grid to path: the compact lattice format for a .lattice path,
+    otherwise a GeoDataFrame with cell polygons (see write_frame), with the
+    NPPS cube as npps_hNNN columns when given.
+    """
+    if os.path.splitext(path)[1].lower() == ".lattice":
+        save_lattice(grid, path, cube)
+    else:
+        frame = grid.to_geodataframe() if isinstance(grid, gu.CompactGrid) else grid
+        if cube is not None:
+            hours = pd.DataFrame(cube_columns(cube), index=frame.index)
+            frame = gpd.GeoDataFrame(pd.concat([frame, hours], axis=1), geometry=frame.geometry.name,
+                                     crs=frame.crs)
+        write_frame(frame, path)
+    logger.info(f"💾 Grid saved to {path}")
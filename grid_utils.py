@@ -1,62 +1,770 @@
+import heapq
+from collections import namedtuple
 import geopandas as gpd
-from shapely.geometry import box
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
 import config
+import instrumentation
 
 
-def create_grid(beats):
+class LatticeGrid:
     """
-    Create a grid of square cells covering the bounds of the beats GeoDataFrame.
-    Returns a GeoDataFrame of grid cells.
+    Regular lattice of square cells anchored at (minx, miny).
+    Cells are stored as integer (row, col) indices; row counts cells along y
+    and col along x. Grid_ID follows the column-major order of the original
+    cell-by-cell construction: Grid_ID = col * n_rows + row.
+    """
+
+    def __init__(self, minx, miny, cell_size, n_rows, n_cols, crs=None):
+        self.minx = float(minx)
+        self.miny = float(miny)
+        self.cell_size = float(cell_size)
+        self.n_rows = int(n_rows)
+        self.n_cols = int(n_cols)
+        self.crs = crs
+        # Cell edges are accumulated like the original cell-by-cell loop so
+        # that neighbouring boxes share bit-identical edge coordinates.
+        self.x_edges = np.add.accumulate(np.r_[self.minx, np.full(self.n_cols, self.cell_size)])
+        self.y_edges = np.add.accumulate(np.r_[self.miny, np.full(self.n_rows, self.cell_size)])
+
+    @property
+    def row(self):
+        """Row index of every lattice cell, in Grid_ID order."""
+        return np.arange(len(self), dtype=np.int64) % self.n_rows
+
+    @property
+    def col(self):
+        """Column index of every lattice cell, in Grid_ID order."""
+        return np.arange(len(self), dtype=np.int64) // self.n_rows
+
+    def __len__(self):
+        return self.n_rows * self.n_cols
+
+    def grid_ids(self, row, col):
+        """Grid_ID of the given lattice indices."""
+        return np.asarray(col, dtype=np.int64) * self.n_rows + np.asarray(row, dtype=np.int64)
+
+    def centroids(self, row, col, span=1):
+        """Centroid coordinates (x, y) of the given lattice indices."""
+        col = np.asarray(col)
+        row = np.asarray(row)
+        x = (self.x_edges[col] + self.x_edges[col + span]) / 2
+        y = (self.y_edges[row] + self.y_edges[row + span]) / 2
+        return x, y
+
+    def cell_polygons(self, row, col, span=1):
+        """
+        Build shapely boxes for the given lattice indices (export/plotting only).
+        span gives the size of multi-resolution cells in lattice cells.
+        """
+        col = np.asarray(col)
+        row = np.asarray(row)
+        return shapely.box(self.x_edges[col], self.y_edges[row],
+                           self.x_edges[col + span], self.y_edges[row + span])
+
+    def to_geodataframe(self):
+        """Materialize every lattice cell as a GeoDataFrame."""
+        return gpd.GeoDataFrame(
+            {"row": self.row, "col": self.col},
+            geometry=self.cell_polygons(self.row, self.col),
+            crs=self.crs
+        )
+
+
+class CompactGrid:
+    """
+    Grid cells held as contiguous arrays, without per-cell Python objects:
+    int32 row/col (int16 span for quadtree grids), int16 Sector, int32
+    Grid_ID and float64 value columns such as total_npps, plus the
+    LatticeGrid they index. Cell polygons are only built by geometry and
+    to_geodataframe() (export and plotting).
+    Supports the column access the pipeline uses: grid[name] returns a
+    Series view of a column and grid[name] = values replaces it. Columns
+    loaded from the stage cache are read-only memory maps, so they are
+    replaced, never written in place.
+    """
+
+    __slots__ = ("lattice", "_columns")
+
+    COLUMN_DTYPES = {"row": np.int32, "col": np.int32, "span": np.int16, "Sector": np.int16}
+
+    def __init__(self, lattice, columns):
+        self.lattice = lattice
+        self._columns = {}
+        for name, values in columns.items():
+            self[name] = values
+
+    @classmethod
+    def from_geodataframe(cls, grid, lattice=None):
+        """Compact copy of a grid GeoDataFrame's non-geometry columns."""
+        lattice = lattice_spec(grid) if lattice is None else lattice
+        return cls(lattice, {name: grid[name].to_numpy() for name in grid.columns
+                             if name != grid.geometry.name})
+
+    def _dtype(self, name, values):
+        if name == "Grid_ID":
+            return np.int32 if len(self.lattice) <= np.iinfo(np.int32).max else np.int64
+        if name in self.COLUMN_DTYPES:
+            return self.COLUMN_DTYPES[name]
+        return np.float64 if np.issubdtype(np.asarray(values).dtype, np.number) else None
+
+    def __len__(self):
+        return len(next(iter(self._columns.values()), ()))
+
+    def __getitem__(self, name):
+        return pd.Series(self._columns[name], name=name, copy=False)
+
+    def __setitem__(self, name, values):
+        values = np.asarray(values)
+        self._columns[name] = np.ascontiguousarray(values, dtype=self._dtype(name, values))
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    @property
+    def crs(self):
+        return self.lattice.crs
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self._columns.values())
+
+    def cell_polygons(self):
+        """Shapely boxes of the cells (built on every call)."""
+        span = self._columns["span"] if "span" in self._columns else 1
+        return self.lattice.cell_polygons(self._columns["row"], self._columns["col"], span)
+
+    @property
+    def geometry(self):
+        return gpd.GeoSeries(self.cell_polygons(), crs=self.crs)
+
+    def to_geodataframe(self):
+        """GeoDataFrame view for export and plotting, indexed by Grid_ID like assign_sectors_to_grid."""
+        grid = gpd.GeoDataFrame(dict(self._columns), geometry=self.cell_polygons(), crs=self.crs)
+        return grid.set_index("Grid_ID", drop=False).rename_axis(None)
+
+
+def _count_steps(start, stop, step):
+    """
+    Number of cells along one axis. Steps are accumulated the same way as the
+    original cell-by-cell loop so that Grid_IDs stay stable across versions.
+    """
+    n = int(np.ceil((stop - start) / step)) + 2
+    edges = np.add.accumulate(np.r_[start, np.full(n, step)])
+    return int(np.count_nonzero(edges < stop))
+
+
+def create_grid(beats, cell_size=None):
+    """
+    Create a lattice of square cells covering the bounds of the beats GeoDataFrame.
+    Returns a LatticeGrid; cell polygons are only built when needed.
     """
     minx, miny, maxx, maxy = beats.total_bounds
-    cell_size = config.CELL_SIZE
-    grid_cells = []
-    x = minx
-    while x < maxx:
-        y = miny
-        while y < maxy:
-            cell = box(x, y, x + cell_size, y + cell_size)
-            grid_cells.append(cell)
-            y += cell_size
-        x += cell_size
-    grid = gpd.GeoDataFrame(geometry=grid_cells, crs=beats.crs)
-    return grid
-
-
-def assign_sectors_to_grid(grid, beats):
-    """
-    Assign each grid cell to a sector based on centroid spatial join.
-    Returns the grid with 'Sector' and 'Grid_ID' columns.
-    """
-    # Calculate centroids
-    grid["centroid"] = grid.geometry.centroid
-    centroids = grid.copy()
-    centroids["geometry"] = centroids["centroid"]
-    # Spatial join
-    centroids_sjoined = gpd.sjoin(
-        centroids,
-        beats,
-        how="left",
-        predicate="intersects"
-    ).reset_index(drop=True)
-    grid["Sector"] = centroids_sjoined["Sector"]
-    # Drop cells with no sector assignment
-    grid = grid.dropna(subset=["Sector"])
-    grid["Sector"] = grid["Sector"].astype(int)
-    grid["Grid_ID"] = grid.index
-    return grid
-
-
-def identify_boundary_grids(grid):
+    cell_size = config.CELL_SIZE if cell_size is None else cell_size
+    n_cols = _count_steps(minx, maxx, cell_size)
+    n_rows = _count_steps(miny, maxy, cell_size)
+    return LatticeGrid(minx, miny, cell_size, n_rows, n_cols, crs=beats.crs)
+
+
+def rasterize_sectors(grid, beats):
+    """
+    Rasterize beat polygons onto the lattice by cell centroid.
+    Centroids are tested in bulk against each beat within the beat's bounding
+    window; the first beat containing a centroid wins.
+    Returns an (n_rows, n_cols) array of sectors, -1 where no beat applies.
+    """
+    sector = np.full((grid.n_rows, grid.n_cols), -1, dtype=np.int64)
+    cs = grid.cell_size
+    for beat_sector, geom in zip(beats["Sector"].to_numpy(), beats.geometry.to_numpy()):
+        if geom is None or geom.is_empty:
+            continue
+        bminx, bminy, bmaxx, bmaxy = geom.bounds
+        c0 = max(int(np.floor((bminx - grid.minx) / cs - 0.5)), 0)
+        c1 = min(int(np.ceil((bmaxx - grid.minx) / cs - 0.5)) + 1, grid.n_cols)
+        r0 = max(int(np.floor((bminy - grid.miny) / cs - 0.5)), 0)
+        r1 = min(int(np.ceil((bmaxy - grid.miny) / cs - 0.5)) + 1, grid.n_rows)
+        if c0 >= c1 or r0 >= r1:
+            continue
+        window = sector[r0:r1, c0:c1]
+        rows, cols = np.nonzero(window < 0)
+        if len(rows) == 0:
+            continue
+        x, y = grid.centroids(rows + r0, cols + c0)
+        shapely.prepare(geom)
+        inside = shapely.intersects_xy(geom, x, y)
+        window[rows[inside], cols[inside]] = int(beat_sector)
+    return sector
+
+
+def assign_sectors_to_grid(grid, beats, compact=False):
+    """
+    Assign each lattice cell to a sector based on its centroid and drop cells
+    outside every beat. Cell polygons are built only for the kept cells.
+    Returns a GeoDataFrame with 'Sector', 'Grid_ID', 'row' and 'col' columns
+    (a CompactGrid without polygons when compact is True).
+    """
+    sector = rasterize_sectors(grid, beats)
+    # Column-major order keeps Grid_ID ascending
+    cols, rows = np.nonzero(sector.T >= 0)
+    columns = {
+        "Sector": sector[rows, cols],
+        "Grid_ID": grid.grid_ids(rows, cols),
+        "row": rows,
+        "col": cols,
+    }
+    if compact:
+        return CompactGrid(grid, columns)
+    return gpd.GeoDataFrame(
+        columns,
+        geometry=grid.cell_polygons(rows, cols),
+        crs=grid.crs
+    ).set_index("Grid_ID", drop=False).rename_axis(None)
+
+
+def build_grid(beats, points=None):
+    """
+    Build the CompactGrid for config.GRID_MODE: the uniform CELL_SIZE
+    lattice, or a quadtree grid refined by the incident points (lon, lat).
+    """
+    if config.GRID_MODE == "quadtree":
+        if points is None:
+            raise ValueError("GRID_MODE 'quadtree' needs the incident points")
+        return create_quadtree_grid(beats, *points, compact=True)
+    if config.GRID_MODE != "uniform":
+        raise ValueError(f"Unknown GRID_MODE: {config.GRID_MODE}")
+    return assign_sectors_to_grid(create_grid(beats), beats, compact=True)
+
+
+def _block_pyramid(raster, levels, reduce):
+    """raster reduced over aligned 2**k x 2**k blocks, for k = 0 .. levels - 1."""
+    n_rows, n_cols = raster.shape
+    return [reduce(raster.reshape(n_rows >> k, 1 << k, n_cols >> k, 1 << k), axis=(1, 3))
+            for k in range(levels)]
+
+
+def create_quadtree_grid(beats, x, y, min_cell_size=None, levels=None, boundary_cell_size=None,
+                         target_cells=None, compact=False):
+    """
+    Create an adaptive (quadtree) grid over the beats. Cells are squares of
+    min_cell_size * 2**k for k < levels, aligned on a fine lattice of
+    min_cell_size. Starting from the coarsest cells, cells straddling a beat
+    boundary are split down to boundary_cell_size; then the cells holding
+    the most incident points (x, y) are split, busiest first, until the grid
+    reaches target_cells (default: the cell count of a uniform CELL_SIZE
+    grid over the beats). Cells are assigned to sectors by centroid and cells
+    outside every beat are dropped.
+    Returns a GeoDataFrame (or CompactGrid) like assign_sectors_to_grid plus
+    a 'span' column: row/col index each cell's lower-left fine lattice cell,
+    span is its size in fine cells and Grid_ID = col * n_rows + row on the
+    fine lattice.
+    """
+    min_cell_size = config.QUADTREE_MIN_CELL_SIZE if min_cell_size is None else min_cell_size
+    levels = config.QUADTREE_LEVELS if levels is None else levels
+    boundary_cell_size = config.QUADTREE_BOUNDARY_CELL_SIZE if boundary_cell_size is None else boundary_cell_size
+    top = 1 << (levels - 1)
+    base = create_grid(beats, min_cell_size)
+    n_rows = -(-base.n_rows // top) * top
+    n_cols = -(-base.n_cols // top) * top
+    lattice = LatticeGrid(base.minx, base.miny, min_cell_size, n_rows, n_cols, crs=beats.crs)
+    sector = rasterize_sectors(lattice, beats)
+    smin = _block_pyramid(sector, levels, np.min)
+    smax = _block_pyramid(sector, levels, np.max)
+    target_cells = config.QUADTREE_TARGET_CELLS if target_cells is None else target_cells
+    if target_cells is None:
+        target_cells = int(round(np.count_nonzero(sector >= 0) * (min_cell_size / config.CELL_SIZE) ** 2))
+
+    # Summed-area table of incident counts per fine cell
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    col = np.floor((x - lattice.minx) / min_cell_size)
+    row = np.floor((y - lattice.miny) / min_cell_size)
+    inside = (col >= 0) & (col < n_cols) & (row >= 0) & (row < n_rows)
+    counts = np.bincount(row[inside].astype(np.int64) * n_cols + col[inside].astype(np.int64),
+                         minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+    table = np.zeros((n_rows + 1, n_cols + 1), dtype=np.int64)
+    table[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+
+    def block_count(r, c, s):
+        return table[r + s, c + s] - table[r, c + s] - table[r + s, c] + table[r, c]
+
+    def kept(r, c, s):
+        # Cells whose centroid falls outside every beat are dropped at the end
+        return int(sector[r + s // 2, c + s // 2] >= 0)
+
+    # Boundary refinement, one level at a time
+    leaves = []
+    r, c = np.nonzero(smax[levels - 1] >= 0)
+    r, c = r * top, c * top
+    for k in range(levels - 1, -1, -1):
+        s = 1 << k
+        split = (smin[k][r >> k, c >> k] != smax[k][r >> k, c >> k]) & (s > boundary_cell_size / min_cell_size)
+        leaves += [(int(i), int(j), s) for i, j in zip(r[~split], c[~split])]
+        if k == 0:
+            break
+        half = s // 2
+        r = np.concatenate([r[split] + dr for dr in (0, half) for _ in (0, 1)])
+        c = np.concatenate([c[split] + dc for _ in (0, 1) for dc in (0, half)])
+        keep = smax[k - 1][r >> (k - 1), c >> (k - 1)] >= 0
+        r, c = r[keep], c[keep]
+
+    # Density refinement, busiest cell first
+    heap = [(-block_count(i, j, s), i, j, s) for i, j, s in leaves if s > 1]
+    heapq.heapify(heap)
+    done = [(i, j, s) for i, j, s in leaves if s == 1]
+    n_cells = sum(kept(i, j, s) for i, j, s in leaves)
+    while heap and n_cells < target_cells and heap[0][0] < 0:
+        _, i, j, s = heapq.heappop(heap)
+        half = s // 2
+        k = half.bit_length() - 1
+        children = [(i + dr, j + dc) for dr in (0, half) for dc in (0, half)
+                    if smax[k][(i + dr) >> k, (j + dc) >> k] >= 0]
+        n_cells += sum(kept(ci, cj, half) for ci, cj in children) - kept(i, j, s)
+        for ci, cj in children:
+            if half > 1:
+                heapq.heappush(heap, (-block_count(ci, cj, half), ci, cj, half))
+            else:
+                done.append((ci, cj, 1))
+    done += [(i, j, s) for _, i, j, s in heap]
+
+    row, col, span = np.array(done, dtype=np.int64).reshape(-1, 3).T
+    # Sector of the fine cell at (or just above and right of) the centroid
+    cell_sector = sector[row + span // 2, col + span // 2]
+    kept_mask = cell_sector >= 0
+    row, col, span, cell_sector = row[kept_mask], col[kept_mask], span[kept_mask], cell_sector[kept_mask]
+    grid_ids = lattice.grid_ids(row, col)
+    order = np.argsort(grid_ids)
+    row, col, span = row[order], col[order], span[order]
+    columns = {
+        "Sector": cell_sector[order],
+        "Grid_ID": grid_ids[order],
+        "row": row,
+        "col": col,
+        "span": span,
+    }
+    if compact:
+        return CompactGrid(lattice, columns)
+    return gpd.GeoDataFrame(
+        columns,
+        geometry=lattice.cell_polygons(row, col, span),
+        crs=lattice.crs
+    ).set_index("Grid_ID", drop=False).rename_axis(None)
+
+
+def lattice_spec(grid):
+    """
+    Recover the LatticeGrid (origin, cell size, extent) underlying a grid
+    GeoDataFrame from its cell bounds and lattice indices. For quadtree grids
+    this is the fine lattice.
+    """
+    if isinstance(grid, CompactGrid):
+        return grid.lattice
+    row, col = lattice_indices(grid)
+    span = lattice_spans(grid)
+    bounds = shapely.bounds(grid.geometry.to_numpy())
+    cell_size = float(np.median((bounds[:, 2] - bounds[:, 0]) / span))
+    minx = float(np.median(bounds[:, 0] - col * cell_size))
+    miny = float(np.median(bounds[:, 1] - row * cell_size))
+    return LatticeGrid(minx, miny, cell_size, (row + span).max(), (col + span).max(), crs=grid.crs)
+
+
+def lattice_edges(grid):
+    """
+    Return the x and y cell-edge coordinates of the grid lattice, read from
+    the cell bounds so they match the cell polygons exactly. Edges of empty
+    lattice columns/rows are filled in arithmetically.
+    Indexed like lattice_indices: cell (row, col) spans
+    x_edges[col]..x_edges[col + span] and y_edges[row]..y_edges[row + span].
+    """
+    if isinstance(grid, CompactGrid):
+        return grid.lattice.x_edges, grid.lattice.y_edges
+    row, col = lattice_indices(grid)
+    span = lattice_spans(grid)
+    bounds = shapely.bounds(grid.geometry.to_numpy())
+    edges = []
+    for idx, lo, hi in ((col, bounds[:, 0], bounds[:, 2]), (row, bounds[:, 1], bounds[:, 3])):
+        n = (idx + span).max() + 1
+        cell_size = float(np.median((hi - lo) / span))
+        origin = float(np.median(lo - idx * cell_size))
+        axis = origin + np.arange(n) * cell_size
+        axis[idx] = lo
+        axis[idx + span] = hi
+        edges.append(axis)
+    return edges[0], edges[1]
+
+
+class CellLocator:
+    """
+    Map point coordinates to grid positions.
+    Points are binned arithmetically with floor((x - minx) / cell_size);
+    only points outside the lattice or in dropped cells fall back to a
+    nearest-cell query on the cell polygons.
+    """
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.lattice = lattice_spec(grid)
+        row, col = lattice_indices(grid)
+        self.raster = np.full((self.lattice.n_rows, self.lattice.n_cols), -1, dtype=np.int64)
+        paint_cells(self.raster, row, col, lattice_spans(grid), np.arange(len(row), dtype=np.int64))
+        self._tree = None
+
+    def locate(self, x, y, fallback=True):
+        """
+        Return the grid position of each point, -1 for missing coordinates
+        (and for unmatched points when fallback is False).
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        lat = self.lattice
+        valid = np.isfinite(x) & np.isfinite(y)
+        col = np.floor((x - lat.minx) / lat.cell_size)
+        row = np.floor((y - lat.miny) / lat.cell_size)
+        inside = valid & (col >= 0) & (col < lat.n_cols) & (row >= 0) & (row < lat.n_rows)
+        positions = np.full(len(x), -1, dtype=np.int64)
+        positions[inside] = self.raster[row[inside].astype(np.int64), col[inside].astype(np.int64)]
+        missed = np.nonzero(valid & (positions < 0))[0]
+        if fallback and len(missed) > 0:
+            if self._tree is None:
+                self._tree = shapely.STRtree(self.grid.geometry.to_numpy())
+            points = shapely.points(x[missed], y[missed])
+            instrumentation.count("spatial_queries", len(missed))
+            input_idx, tree_idx = self._tree.query_nearest(points, all_matches=False)
+            positions[missed[input_idx]] = tree_idx
+        return positions
+
+
+NEIGHBOR_OFFSETS = {
+    4: [(-1, 0), (1, 0), (0, -1), (0, 1)],
+    8: [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)],
+}
+
+
+def lattice_indices(grid):
+    """
+    Return the (row, col) lattice indices of each grid cell.
+    Uses the 'row'/'col' columns when present, otherwise derives them from
+    the cell bounds.
+    """
+    if "row" in grid.columns and "col" in grid.columns:
+        return grid["row"].to_numpy(dtype=np.int64), grid["col"].to_numpy(dtype=np.int64)
+    bounds = grid.geometry.bounds.to_numpy()
+    cell_size = bounds[0, 2] - bounds[0, 0]
+    col = np.rint((bounds[:, 0] - bounds[:, 0].min()) / cell_size).astype(np.int64)
+    row = np.rint((bounds[:, 1] - bounds[:, 1].min()) / cell_size).astype(np.int64)
+    return row, col
+
+
+def lattice_spans(grid):
+    """
+    Return the size of each grid cell in lattice cells: the 'span' column of
+    quadtree grids (see create_quadtree_grid), all ones for uniform grids.
+    """
+    if "span" in grid.columns:
+        return grid["span"].to_numpy(dtype=np.int64)
+    return np.ones(len(grid), dtype=np.int64)
+
+
+def paint_cells(raster, row, col, span, values):
+    """Write values over each cell's span x span block of lattice cells."""
+    values = np.broadcast_to(values, np.shape(row))
+    for s in np.unique(span):
+        sel = span == s
+        r, c, v = row[sel], col[sel], values[sel]
+        for dr in range(s):
+            for dc in range(s):
+                raster[r + dr, c + dc] = v
+
+
+def _position_raster(row, col, span=None):
+    """
+    Paint grid positions onto a raster with a one-cell border of -1.
+    Returns (raster, row, col) with the indices shifted into raster space.
+    """
+    row = row - row.min() + 1
+    col = col - col.min() + 1
+    if span is None:
+        raster = np.full((row.max() + 2, col.max() + 2), -1, dtype=np.int64)
+        raster[row, col] = np.arange(len(row), dtype=np.int64)
+    else:
+        raster = np.full(((row + span).max() + 1, (col + span).max() + 1), -1, dtype=np.int64)
+        paint_cells(raster, row, col, span, np.arange(len(row), dtype=np.int64))
+    return raster, row, col
+
+
+def lattice_adjacency(grid, connectivity=8):
+    """
+    Build the cell adjacency of the grid from its lattice indices.
+    connectivity=8 links cells sharing an edge or a corner (same as shapely
+    'touches' on the cell boxes); connectivity=4 links edge neighbors only.
+    Quadtree grids link cells whose blocks touch on the fine lattice.
+    Returns a CSR matrix over grid positions with sorted column indices.
+    """
+    row, col = lattice_indices(grid)
+    n = len(row)
+    if n == 0:
+        return sparse.csr_matrix((0, 0), dtype=np.int8)
+    if "span" in grid.columns:
+        return _block_adjacency(row, col, lattice_spans(grid), connectivity)
+    raster, row, col = _position_raster(row, col)
+    positions = np.arange(n, dtype=np.int64)
+    src, dst = [], []
+    for dr, dc in NEIGHBOR_OFFSETS[connectivity]:
+        nbr = raster[row + dr, col + dc]
+        found = nbr >= 0
+        src.append(positions[found])
+        dst.append(nbr[found])
+    src = np.concatenate(src)
+    dst = np.concatenate(dst)
+    adjacency = sparse.csr_matrix(
+        (np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n, n)
+    )
+    adjacency.sum_duplicates()
+    adjacency.sort_indices()
+    return adjacency
+
+
+def _block_adjacency(row, col, span, connectivity):
+    """lattice_adjacency for mixed-size cells: distinct cells on neighboring fine cells."""
+    n = len(row)
+    raster, _, _ = _position_raster(row, col, span)
+    n_rows, n_cols = raster.shape
+    keys = []
+    # One direction per offset pair; both directions are added below
+    for dr, dc in NEIGHBOR_OFFSETS[connectivity]:
+        if (dr, dc) < (0, 0):
+            continue
+        a = raster[:n_rows - dr, max(-dc, 0):n_cols - max(dc, 0)]
+        b = raster[dr:, max(dc, 0):n_cols - max(-dc, 0)]
+        linked = (a >= 0) & (b >= 0) & (a != b)
+        keys += [a[linked] * n + b[linked], b[linked] * n + a[linked]]
+    src, dst = np.divmod(np.unique(np.concatenate(keys)), n)
+    adjacency = sparse.csr_matrix(
+        (np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n, n)
+    )
+    adjacency.sort_indices()
+    return adjacency
+
+
+def lattice_contacts(grid):
+    """
+    Length of the edge shared by each pair of edge-adjacent cells, counted in
+    lattice cell edges (fine cells for quadtree grids).
+    Returns an int32 CSR matrix over grid positions with sorted column indices.
+    """
+    row, col = lattice_indices(grid)
+    n = len(row)
+    if n == 0:
+        return sparse.csr_matrix((0, 0), dtype=np.int32)
+    span = lattice_spans(grid) if "span" in grid.columns else None
+    raster, _, _ = _position_raster(row, col, span)
+    n_rows, n_cols = raster.shape
+    keys = []
+    for dr, dc in ((0, 1), (1, 0)):
+        a = raster[:n_rows - dr, :n_cols - dc]
+        b = raster[dr:, dc:]
+        linked = (a >= 0) & (b >= 0) & (a != b)
+        keys += [a[linked] * n + b[linked], b[linked] * n + a[linked]]
+    keys, lengths = np.unique(np.concatenate(keys), return_counts=True)
+    src, dst = np.divmod(keys, n)
+    return sparse.csr_matrix((lengths.astype(np.int32), (src, dst)), shape=(n, n))
+
+
+def neighbor_pairs(adjacency):
+    """
+    Expand a CSR adjacency into directed (cell, neighbor) position arrays,
+    ordered by cell and then by neighbor.
+    """
+    counts = np.diff(adjacency.indptr)
+    src = np.repeat(np.arange(adjacency.shape[0], dtype=np.int64), counts)
+    return src, adjacency.indices.astype(np.int64)
+
+
+def boundary_mask(grid, connectivity=8, adjacency=None):
+    """Boolean array marking cells that touch a neighbor with a different sector."""
+    if adjacency is None:
+        adjacency = lattice_adjacency(grid, connectivity)
+    src, dst = neighbor_pairs(adjacency)
+    sector = grid["Sector"].to_numpy()
+    is_boundary = np.zeros(len(grid), dtype=bool)
+    is_boundary[src[sector[src] != sector[dst]]] = True
+    return is_boundary
+
+
+def identify_boundary_grids(grid, connectivity=8, adjacency=None):
     """
     Identify boundary grids (grids that touch a neighbor with a different sector).
     Returns a GeoDataFrame with an 'is_boundary' column (True/False).
+    Use boundary_mask to avoid building cell polygons for a CompactGrid.
+    """
+    boundary_grids = grid.to_geodataframe() if isinstance(grid, CompactGrid) else grid.copy()
+    boundary_grids["is_boundary"] = boundary_mask(grid, connectivity, adjacency)
+    return boundary_grids
+
+
+# Ring around a cell in circular order: N, NE, E, SE, S, SW, W, NW.
+# Even ring slots are edge neighbors, odd slots corner neighbors.
+RING_OFFSETS = [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
+
+
+# One cell's ring in a RingTable: neighbor positions (-1 for gaps) in
+# circular order and whether each shares an edge with the cell.
+Ring = namedtuple("Ring", ["cells", "edge"])
+
+
+class RingTable:
+    """
+    Variable-length rings of a quadtree grid in CSR layout: ring i is
+    cells[indptr[i]:indptr[i + 1]] with matching edge flags. Indexing
+    returns a Ring, which can_transfer accepts in place of an 8-slot row.
+    """
+
+    def __init__(self, indptr, cells, edge):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.cells = np.asarray(cells, dtype=np.int64)
+        self.edge = np.asarray(edge, dtype=bool)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, pos):
+        start, end = self.indptr[pos], self.indptr[pos + 1]
+        return Ring(self.cells[start:end], self.edge[start:end])
+
+
+def _ring_walk(s):
+    """
+    (dr, dc, is_edge) of the fine cells around an s x s block, clockwise
+    from the west end of the north side; s = 1 gives RING_OFFSETS.
+    """
+    return ([(s, dc, True) for dc in range(s)] + [(s, s, False)]
+            + [(dr, s, True) for dr in range(s - 1, -1, -1)] + [(-1, s, False)]
+            + [(-1, dc, True) for dc in range(s - 1, -1, -1)] + [(-1, -1, False)]
+            + [(dr, -1, True) for dr in range(s)] + [(s, -1, False)])
+
+
+def _block_rings(row, col, span):
+    """
+    RingTable of a quadtree grid: each cell's perimeter walk on the fine
+    lattice with repeats of the same neighbor (or gap) merged into one entry,
+    which is an edge entry if any of its fine cells is.
+    """
+    n = len(row)
+    raster, row, col = _position_raster(row, col, span)
+    owners, cells, edges = [], [], []
+    for s in np.unique(span):
+        members = np.nonzero(span == s)[0]
+        walk = np.array(_ring_walk(s))
+        seq = raster[row[members, None] + walk[:, 0], col[members, None] + walk[:, 1]]
+        starts = seq != np.roll(seq, 1, axis=1)
+        starts[~starts.any(axis=1), 0] = True
+        # Entries before a row's first run start belong to its last (wrapping) run
+        n_runs = starts.sum(axis=1)
+        run = np.cumsum(starts, axis=1) - 1
+        run = np.where(run < 0, n_runs[:, None] - 1, run) + (np.cumsum(n_runs) - n_runs)[:, None]
+        run_edge = np.zeros(n_runs.sum(), dtype=bool)
+        np.logical_or.at(run_edge, run.ravel(), np.broadcast_to(walk[:, 2].astype(bool), seq.shape).ravel())
+        owners.append(np.repeat(members, n_runs))
+        cells.append(seq[starts])
+        edges.append(run_edge)
+    owners = np.concatenate(owners)
+    order = np.argsort(owners, kind="stable")
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(owners, minlength=n))
+    return RingTable(indptr, np.concatenate(cells)[order], np.concatenate(edges)[order])
+
+
+def lattice_rings(grid):
+    """
+    Return an (n, 8) array with the positions of each cell's ring neighbors
+    in RING_OFFSETS order, -1 where there is no cell. Quadtree grids, whose
+    rings vary in length, get a RingTable instead.
+    """
+    row, col = lattice_indices(grid)
+    if len(row) == 0:
+        return np.empty((0, 8), dtype=np.int64)
+    if "span" in grid.columns:
+        return _block_rings(row, col, lattice_spans(grid))
+    raster, row, col = _position_raster(row, col)
+    return np.stack([raster[row + dr, col + dc] for dr, dc in RING_OFFSETS], axis=1)
+
+
+def _removable_patterns():
+    """
+    For every 8-bit ring pattern of same-sector neighbors, decide whether the
+    center cell can leave its sector without splitting it. The sector must
+    stay edge-connected (corner contacts become MultiPolygons when dissolved),
+    so the edge neighbors in the sector must all lie on one circular run of
+    the ring; that run reconnects them without the center cell.
+    """
+    table = np.zeros(256, dtype=bool)
+    for mask in range(256):
+        bits = [(mask >> k) & 1 for k in range(8)]
+        if all(bits):
+            table[mask] = True
+            continue
+        start = bits.index(0)
+        run = -1
+        runs_with_edge = set()
+        for step in range(1, 9):
+            k = (start + step) % 8
+            if bits[k]:
+                if not bits[(k - 1) % 8]:
+                    run += 1
+                if k % 2 == 0:
+                    runs_with_edge.add(run)
+        table[mask] = len(runs_with_edge) <= 1
+    return table
+
+
+REMOVABLE_PATTERNS = _removable_patterns()
+
+
+def ring_removable(cells, edge, sector, own_sector):
+    """
+    REMOVABLE_PATTERNS test for a ring of any length (see RingTable): the
+    edge neighbors in own_sector must all lie on one circular run.
+    """
+    bits = [j >= 0 and sector[j] == own_sector for j in cells]
+    if all(bits):
+        return True
+    n = len(bits)
+    start = bits.index(False)
+    run = -1
+    runs_with_edge = set()
+    for step in range(1, n + 1):
+        k = (start + step) % n
+        if bits[k]:
+            if not bits[k - 1]:
+                run += 1
+            if edge[k]:
+                runs_with_edge.add(run)
+    return len(runs_with_edge) <= 1
+
+
+def ring_pattern(ring, sector, own_sector):
+    """8-bit mask of ring neighbors that belong to own_sector."""
+    mask = 0
+    for k, j in enumerate(ring):
+        if j >= 0 and sector[j] == own_sector:
+            mask |= 1 << k
+    return mask
+
+
+def can_transfer(ring, sector, pos, to_sector):
+    """
+    Local O(1) contiguity check for moving the cell at pos to to_sector.
+    The donor must stay edge-connected and the cell must share an edge with
+    the recipient. ring is the cell's row of lattice_rings (a Ring for
+    quadtree grids); sector is any indexable of current sectors by position.
     """
-    boundary_grids = grid.copy()
-    boundary_grids["is_boundary"] = False
-    for idx, row in grid.iterrows():
-        neighbors = grid[grid.geometry.touches(row.geometry)]
-        if not neighbors.empty:
-            if any(neighbors["Sector"] != row["Sector"]):
-                boundary_grids.at[idx, "is_boundary"] = True
-    return boundary_grids 
\ No newline at end of file
+    own_sector = sector[pos]
+    if isinstance(ring, Ring):
+        if not any(e and j >= 0 and sector[j] == to_sector for j, e in zip(ring.cells, ring.edge)):
+            return False
+        return ring_removable(ring.cells, ring.edge, sector, own_sector)
+    if not any(ring[k] >= 0 and sector[ring[k]] == to_sector for k in (0, 2, 4, 6)):
+        return False
+    return bool(REMOVABLE_PATTERNS[ring_pattern(ring, sector, own_sector)])
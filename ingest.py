@@ -0,0 +1,163 @@
+import glob
+import logging
+import os
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import MinMaxScaler
+import config
+import data_preprocessing as dp
+import grid_utils as gu
+import npps_analysis as na
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_TIME = 'Time Spent Responding'
+INCIDENT_DTYPES = {
+    'Priority': str,
+    'lat': 'float64',
+    'lon': 'float64',
+    RESPONSE_TIME: 'float64',
+    'Dispositions': str,
+}
+
+
+def incident_paths(path=None):
+    """
+    List the incident CSVs to ingest: every *.csv in a directory (sorted, so
+    yearly files load in order) or a single file. Defaults to
+    INCIDENT_DATA_DIR, or YEAR_DATA_PATH when that is None.
+    """
+    if path is None:
+        path = config.YEAR_DATA_PATH if config.INCIDENT_DATA_DIR is None else config.INCIDENT_DATA_DIR
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.csv")))
+    return [path]
+
+
+def iter_incident_chunks(paths, chunk_size=None, columns=None):
+    """Yield DataFrame chunks of the needed incident columns with fixed dtypes."""
+    chunk_size = config.INGEST_CHUNK_SIZE if chunk_size is None else chunk_size
+    columns = dp.INCIDENT_COLUMNS if columns is None else columns
+    dtypes = {c: INCIDENT_DTYPES.get(c, str) for c in columns}
+    for path in paths:
+        for chunk in pd.read_csv(path, usecols=columns, dtype=dtypes, chunksize=chunk_size):
+            yield chunk[columns]
+
+
+def load_incident_points(paths=None, chunk_size=None):
+    """Read only the incident coordinates; returns (lon, lat) float arrays."""
+    paths = incident_paths() if paths is None else paths
+    chunks = list(iter_incident_chunks(paths, chunk_size, columns=['lon', 'lat']))
+    if not chunks:
+        return np.empty(0), np.empty(0)
+    return (np.concatenate([c['lon'].to_numpy() for c in chunks]),
+            np.concatenate([c['lat'].to_numpy() for c in chunks]))
+
+
+def _truncate_mantissa(values, bits):
+    """Round floats toward zero to `bits` mantissa bits (order preserving)."""
+    raw = np.ascontiguousarray(values, dtype=np.float64).view(np.int64)
+    mask = np.int64(-1) << np.int64(52 - bits)
+    return (raw & mask).view(np.float64)
+
+
+class ValueCountSketch:
+    """
+    Mergeable value-count summary of one numeric column.
+    Counts are exact while the number of distinct values stays below
+    max_distinct, which is the usual case for response times recorded at a
+    fixed precision; memory then stays flat however many years are loaded.
+    Beyond that, values are truncated to mantissa_bits (relative error
+    2**-mantissa_bits) and `exact` is set to False.
+    """
+
+    def __init__(self, max_distinct=1_000_000, mantissa_bits=16):
+        self.max_distinct = max_distinct
+        self.mantissa_bits = mantissa_bits
+        self.exact = True
+        self.counts = pd.Series(dtype="int64")
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not self.exact:
+            values = _truncate_mantissa(values, self.mantissa_bits)
+        self.counts = self.counts.add(pd.Series(values).value_counts(), fill_value=0).astype("int64")
+        if self.exact and len(self.counts) > self.max_distinct:
+            self.exact = False
+            keys = _truncate_mantissa(self.counts.index.to_numpy(), self.mantissa_bits)
+            self.counts = self.counts.groupby(keys).sum()
+
+    def _sorted(self):
+        counts = self.counts.sort_index()
+        return counts.index.to_numpy(dtype=np.float64), np.cumsum(counts.to_numpy())
+
+    def quantile(self, q):
+        """Quantile with the same linear interpolation as Series.quantile."""
+        values, cumulative = self._sorted()
+        if len(cumulative) == 0:
+            raise ValueError("Cannot take a quantile of an empty sketch (no non-missing response times were read)")
+        n = cumulative[-1]
+        position = (n - 1) * q
+        lo = int(np.floor(position))
+        v_lo = values[np.searchsorted(cumulative, lo, side="right")]
+        v_hi = values[np.searchsorted(cumulative, min(lo + 1, n - 1), side="right")]
+        return float(np.quantile(np.array([v_lo, v_hi]), position - lo))
+
+    def range_after_replacement(self, bounds, replacement):
+        """Min and max of the column once values outside bounds are replaced."""
+        values, _ = self._sorted()
+        lower, upper = bounds
+        kept = values[(values >= lower) & (values <= upper)]
+        if len(kept) < len(values):
+            kept = np.append(kept, replacement)
+        return kept.min(), kept.max()
+
+
+def scan_response_times(paths, chunk_size=None):
+    """
+    Pass one: read only the response-time column and compute the IQR
+    outlier bounds and the fitted MinMaxScaler for the whole dataset.
+    Returns (bounds, scaler, sketch).
+    """
+    sketch = ValueCountSketch()
+    for chunk in iter_incident_chunks(paths, chunk_size, columns=[RESPONSE_TIME]):
+        sketch.update(chunk[RESPONSE_TIME].to_numpy())
+    bounds = dp.iqr_bounds(sketch.quantile(0.25), sketch.quantile(0.75))
+    data_min, data_max = sketch.range_after_replacement(bounds, config.OUTLIER_REPLACEMENT)
+    scaler = MinMaxScaler().fit(pd.DataFrame({RESPONSE_TIME: [data_min, data_max]}))
+    return bounds, scaler, sketch
+
+
+def iter_scored_chunks(paths, chunk_size=None, columns=None):
+    """
+    Two-pass streaming scoring. Pass one computes dataset-wide outlier bounds
+    and response-time scaling; pass two yields each chunk scored with
+    calculate_npps, so peak memory is one chunk regardless of how many
+    files are loaded.
+    """
+    bounds, scaler, sketch = scan_response_times(paths, chunk_size)
+    if not sketch.exact:
+        logger.warning("⚠️ Response-time quartiles are approximate (too many distinct values)")
+    for chunk in iter_incident_chunks(paths, chunk_size, columns):
+        yield dp.calculate_npps(chunk, bounds, scaler)
+
+
+def stream_npps_by_grid(paths, grid, chunk_size=None):
+    """
+    Two-pass streaming ingest (see iter_scored_chunks): each scored chunk is
+    binned straight into the grid cells, so peak memory is one chunk plus
+    the per-cell arrays.
+    Returns the grid with a 'total_npps' column.
+    """
+    locator = gu.CellLocator(grid)
+    total_npps = np.zeros(len(grid), dtype=np.float64)
+    n_rows = 0
+    for scored in iter_scored_chunks(paths, chunk_size):
+        total_npps += na.bin_npps_to_grid(scored, locator)
+        n_rows += len(scored)
+    logger.info(f"Streamed {n_rows} incidents from {len(paths)} file(s)")
+    if isinstance(grid, pd.DataFrame):
+        grid = grid.reset_index(drop=True)
+    grid["total_npps"] = total_npps
+    return grid
@@ -0,0 +1,175 @@
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def configure_logging(level="INFO"):
+    """Send progress messages to stdout as plain text at the given level."""
+    logging.basicConfig(level=level, format="%(message)s", stream=sys.stdout, force=True)
+    # Keep per-file write notices from the I/O libraries out of progress output
+    for name in ("pyogrio", "fiona"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (None where unsupported)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+class RunReport:
+    """
+    Structured record of one pipeline run.
+    stage() times a block (wall and CPU seconds, peak RSS, optionally
+    tracemalloc peak and top allocation sites, and a cProfile summary) and
+    records the counters incremented inside it; count() bumps named counters
+    such as cells moved or spatial queries issued. summary holds free-form
+    run results (e.g. balance metrics).
+    """
+
+    def __init__(self, profile=False, trace_memory=False, profile_dir=None):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.counters = {}
+        self.summary = {}
+        self.started = time.time()
+        self._profiling = False
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def merge_counters(self, counters):
+        for name, n in counters.items():
+            self.count(name, n)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {"stage": name}
+        counters_before = dict(self.counters)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+        profiler = None
+        if self.profile and not self._profiling:
+            profiler = cProfile.Profile()
+            self._profiling = True
+            profiler.enable()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - wall
+            record["cpu_seconds"] = time.process_time() - cpu
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                record["profile"] = self._profile_summary(name, profiler)
+            record["peak_rss_mb"] = peak_rss_mb()
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                record["traced_mb"] = (current - traced_before) / 1024 ** 2
+                record["traced_peak_mb"] = (peak - traced_before) / 1024 ** 2
+                top = tracemalloc.take_snapshot().statistics("lineno")[:5]
+                record["top_allocations"] = [
+                    {"site": str(stat.traceback), "mb": stat.size / 1024 ** 2, "blocks": stat.count}
+                    for stat in top
+                ]
+            record["counters"] = {k: v - counters_before.get(k, 0) for k, v in self.counters.items()
+                                  if v != counters_before.get(k, 0)}
+            self.stages.append(record)
+            logger.debug("⏱️ %s: %.3fs", name, record["seconds"])
+
+    def _profile_summary(self, name, profiler, top=15):
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+        stats = pstats.Stats(profiler, stream=io.StringIO()).sort_stats("cumulative")
+        rows = []
+        for func in stats.fcn_list[:top]:
+            calls, _, tottime, cumtime, _ = stats.stats[func]
+            rows.append({"function": pstats.func_std_string(func), "calls": calls,
+                         "tottime": tottime, "cumtime": cumtime})
+        return rows
+
+    def to_dict(self):
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "total_seconds": time.time() - self.started,
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": self.stages,
+            "counters": self.counters,
+            "summary": self.summary,
+        }
+
+    def write(self, path):
+        """Write the report as JSON."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, default=_json_default)
+        logger.info(f"Run report saved to {path}")
+
+
+def _json_default(obj):
+    # NumPy scalars and anything else json cannot encode
+    return obj.item() if hasattr(obj, "item") else str(obj)
+
+
+# Report that module-level count()/stage() calls record into
+_report = RunReport()
+
+
+def start_run(profile=False, trace_memory=False, profile_dir=None):
+    """Start a fresh run report and make it current."""
+    global _report
+    _report = RunReport(profile, trace_memory, profile_dir)
+    return _report
+
+
+def current_report():
+    return _report
+
+
+def count(name, n=1):
+    _report.count(name, n)
+
+
+def stage(name):
+    return _report.stage(name)
+
+
+@contextlib.contextmanager
+def collect_counters():
+    """
+    Collect counters incremented inside the block into a fresh dict instead
+    of the current report (used by pool workers to ship counts back).
+    """
+    saved = _report.counters
+    _report.counters = {}
+    try:
+        yield _report.counters
+    finally:
+        _report.counters = saved
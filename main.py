@@ -1,58 +1,211 @@
+import logging
+import os
 import geopandas as gpd
 import pandas as pd
 import config
 import data_preprocessing as dp
+import export
 import grid_utils as gu
+import ingest
+import instrumentation
 import npps_analysis as na
+import npps_cube
+import rebalancer as rb
+import road_network as rn
 import sector_optimization as so
 import snapping as sn
+import stage_cache
 import visualization as vis
+from sector_graph import SectorGraph
+from stage_cache import StageCache
+from workload import SectorLedger
+
+logger = logging.getLogger(__name__)
 
 
 def main():
-    # Load data
-    beats = dp.load_shapefile()
-    df = dp.load_incident_data()
-    new_df = dp.preprocess_incident_data(df)
-    npps_data = dp.calculate_npps(new_df)
-
-    # Create and assign grid
-    grid = gu.create_grid(beats)
-    grid = gu.assign_sectors_to_grid(grid, beats)
-    boundary_grids = gu.identify_boundary_grids(grid)
-
-    # Aggregate NPPS by grid and sector
-    grid = na.aggregate_npps_by_grid(npps_data, grid)
+    instrumentation.configure_logging(config.LOG_LEVEL)
+    report = instrumentation.start_run(config.PROFILE_STAGES, config.TRACE_MEMORY, config.PROFILE_DIR)
+    cache = StageCache() if config.CACHE_ENABLED else None
+
+    if cache is not None:
+        # Load data, build the grid and aggregate NPPS through the stage cache
+        with report.stage("load_beats"):
+            beats, beats_key = stage_cache.load_beats(cache)
+        with report.stage("build_grid"):
+            grid, grid_key = stage_cache.build_grid(cache, beats, beats_key)
+        with report.stage("identify_boundary_grids"):
+            report.count("boundary_cells", int(gu.boundary_mask(grid).sum()))
+        with report.stage("aggregate_npps"):
+            grid = stage_cache.aggregate_npps(cache, grid, grid_key)
+    else:
+        # Load data
+        with report.stage("load_beats"):
+            beats = dp.load_shapefile()
+
+        # Create and assign grid
+        with report.stage("build_grid"):
+            points = ingest.load_incident_points() if config.GRID_MODE == "quadtree" else None
+            grid = gu.build_grid(beats, points)
+        with report.stage("identify_boundary_grids"):
+            report.count("boundary_cells", int(gu.boundary_mask(grid).sum()))
+
+        # Aggregate NPPS by grid and sector
+        with report.stage("aggregate_npps"):
+            if config.INCIDENT_DATA_DIR is not None:
+                grid = ingest.stream_npps_by_grid(ingest.incident_paths(), grid)
+            else:
+                df = dp.load_incident_data()
+                new_df = dp.preprocess_incident_data(df)
+                npps_data = dp.calculate_npps(new_df)
+                grid = na.aggregate_npps_by_grid(npps_data, grid)
+    report.count("grid_cells", len(grid))
     sector_npps_sum = na.aggregate_npps_by_sector(grid)
     beats = beats.merge(sector_npps_sum, on="Sector", how="left")
 
     # Visualize initial NPPS heatmap
     vis.plot_sector_npps_heatmap(beats, title="Initial Sector-Level WLS Heatmap")
 
+    # Balance a shift (or weighted mix of shifts) instead of all-hours NPPS
+    value_col = "total_npps"
+    cube = None
+    if config.REBALANCE_SHIFT_MIX is not None or config.REPORT_SHIFT_BALANCE:
+        with report.stage("npps_cube"):
+            if cache is not None:
+                cube = stage_cache.build_npps_cube(cache, grid, grid_key)
+            else:
+                cube = npps_cube.load_npps_cube(grid)
+    if config.REBALANCE_SHIFT_MIX is not None:
+        grid["shift_npps"] = cube.mix_npps(config.REBALANCE_SHIFT_MIX)
+        value_col = "shift_npps"
+
+    # Road distances from sector centres for the travel term of the local search
+    streets = None
+    travel = None
+    if config.TRAVEL_WEIGHT > 0:
+        with report.stage("load_streets"):
+            streets = stage_cache.load_streets(cache) if cache is not None else gpd.read_file(config.CENTERLINES_PATH)
+        with report.stage("travel_table"):
+            if cache is not None:
+                road, cell_node, cell_offset, road_key = stage_cache.build_road_graph(cache, streets, grid, grid_key)
+                travel = stage_cache.build_travel_table(cache, grid, road, cell_node, cell_offset, road_key)
+            else:
+                road = rn.RoadGraph.from_streets(streets)
+                cell_node, cell_offset = road.snap_cells(grid)
+                travel = rn.TravelTable.build(grid, road, cell_node, cell_offset)
+        initial_travel = travel.total
+
     # Optimize sectors
-    excess_sectors = [4, 6, 7]  # Example excess sectors
-    grid, moved_ids = so.give_bulk_boundaries_from_excess(grid, config.get_sector_neighbors(), excess_sectors)
-    vis.plot_moved_grids(grid, moved_ids, beats, title="Grid Transfers from Excess Sectors")
+    ledger = SectorLedger.from_grid(grid, value_col)
+    graph = SectorGraph.from_grid(grid)
+    initial_sum = ledger.to_frame()
+    initial_sector = grid["Sector"].to_numpy().copy()
+    if config.OPTIMIZATION_METHOD == "local_search" and config.REBALANCE_STARTS > 1:
+        with report.stage("optimize"):
+            grid, moved_ids, _ = rb.multi_start_rebalance(
+                grid,
+                n_starts=config.REBALANCE_STARTS,
+                max_workers=config.REBALANCE_WORKERS,
+                seed=config.REBALANCE_SEED,
+                perturb_moves=config.REBALANCE_PERTURB_MOVES,
+                max_iter=config.REBALANCE_MAX_ITER,
+                time_limit=config.REBALANCE_TIME_LIMIT,
+                contiguous=config.PRESERVE_CONTIGUITY,
+                ledger=ledger,
+                value_col=value_col,
+                graph=graph,
+                travel=travel,
+                travel_weight=config.TRAVEL_WEIGHT
+            )
+        vis.plot_moved_grids(grid.to_geodataframe(), moved_ids, beats, title="Grid Transfers from Local Search")
+    elif config.OPTIMIZATION_METHOD == "local_search":
+        with report.stage("optimize"):
+            grid, moved_ids, _ = rb.rebalance_sectors(
+                grid,
+                max_iter=config.REBALANCE_MAX_ITER,
+                time_limit=config.REBALANCE_TIME_LIMIT,
+                seed=config.REBALANCE_SEED,
+                contiguous=config.PRESERVE_CONTIGUITY,
+                ledger=ledger,
+                value_col=value_col,
+                graph=graph,
+                travel=travel,
+                travel_weight=config.TRAVEL_WEIGHT
+            )
+        vis.plot_moved_grids(grid.to_geodataframe(), moved_ids, beats, title="Grid Transfers from Local Search")
+    elif config.OPTIMIZATION_METHOD == "multilevel":
+        with report.stage("optimize"):
+            grid, moved_ids, _ = rb.multilevel_rebalance(
+                grid,
+                seed=config.REBALANCE_SEED,
+                contiguous=config.PRESERVE_CONTIGUITY,
+                ledger=ledger,
+                value_col=value_col,
+                graph=graph,
+                travel=travel
+            )
+        vis.plot_moved_grids(grid.to_geodataframe(), moved_ids, beats, title="Grid Transfers from Multilevel Partitioning")
+    else:
+        excess_sectors = ledger.excess_sectors(config.BULK_EXCESS_TOLERANCE)
+        with report.stage("give_bulk_boundaries"):
+            grid, moved_ids = so.give_bulk_boundaries_from_excess(
+                grid, None, excess_sectors, ledger, config.PRESERVE_CONTIGUITY,
+                value_col=value_col, graph=graph
+            )
+        vis.plot_moved_grids(grid.to_geodataframe(), moved_ids, beats, title="Grid Transfers from Excess Sectors")
+
+        deficient_sector = ledger.most_deficient()
+        with report.stage("take_bulk_boundaries"):
+            grid, moved_ids = so.take_bulk_boundaries_to_deficient(
+                grid, deficient_sector, None, ledger, config.PRESERVE_CONTIGUITY,
+                value_col=value_col, graph=graph
+            )
+        vis.plot_moved_grids(grid.to_geodataframe(), moved_ids, beats, title="Grid Transfers to Deficient Sector")
 
-    deficient_sector = 12
-    neighbors_12 = [3, 11, 13]
-    grid, moved_ids = so.take_bulk_boundaries_to_deficient(grid, deficient_sector, neighbors_12)
-    vis.plot_moved_grids(grid, moved_ids, beats, title="Grid Transfers to Deficient Sector")
+    # Sector centres move with their cells; re-run Dijkstra for the ones that did
+    if travel is not None:
+        with report.stage("recentre_travel"):
+            if cache is not None:
+                stage_cache.recentre_travel_table(cache, grid, travel, road, cell_node, cell_offset, road_key)
+            else:
+                travel.recentre(grid, road, cell_node, cell_offset)
 
     # Evaluate NPPS balance
-    old_sum = sector_npps_sum
-    new_sum = na.aggregate_npps_by_sector(grid)
+    old_sum = initial_sum
+    new_sum = ledger.to_frame()
     evaluation_result = na.evaluate_npps_balance(old_sum, new_sum)
+    report.summary["balance"] = {"before": na.balance_metrics(old_sum), "after": na.balance_metrics(new_sum)}
+    report.summary["sector_neighbors"] = graph.to_dict()
+    if cube is not None:
+        # Sector totals of every shift from cumulative hour-of-week sums, before and after
+        report.summary["shift_balance"] = {
+            "before": cube.sector_windows(initial_sector).shift_balance(),
+            "after": cube.sector_windows(grid["Sector"].to_numpy()).shift_balance(),
+        }
+    if travel is not None:
+        report.summary["travel_distance"] = {"before": initial_travel, "after": travel.total}
 
     # Snap boundaries to streets
-    streets = gpd.read_file(config.CENTERLINES_PATH)
-    snapped_sectors = sn.smooth_sectors(grid, streets)
-    vis.visualize_comparison(grid, snapped_sectors, streets)
+    if streets is None:
+        with report.stage("load_streets"):
+            streets = stage_cache.load_streets(cache) if cache is not None else gpd.read_file(config.CENTERLINES_PATH)
+    with report.stage("smooth_sectors"):
+        output_dir, file_name = os.path.split(config.SNAPPED_SECTORS_PATH)
+        snapped_sectors = sn.smooth_sectors(grid, streets, output_dir, config.SNAP_WORKERS, file_name)
+    vis.visualize_comparison(grid.to_geodataframe(), snapped_sectors, streets)
     vis.plot_final_sectors(snapped_sectors)
 
     # Save final grid
-    grid.to_file(config.FINAL_GRID_PATH)
-    print("Final optimized grid saved as final_grid.shp")
+    with report.stage("save_grid"):
+        if config.EXPORT_NPPS_CUBE and cube is None:
+            if cache is not None:
+                cube = stage_cache.build_npps_cube(cache, grid, grid_key)
+            else:
+                cube = npps_cube.load_npps_cube(grid)
+        export.export_grid(grid, config.FINAL_GRID_PATH, cube)
+        if config.FINAL_LATTICE_PATH is not None:
+            export.save_lattice(grid, config.FINAL_LATTICE_PATH, cube)
+    report.write(config.RUN_REPORT_PATH)
 
 
 if __name__ == "__main__":
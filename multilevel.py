@@ -0,0 +1,215 @@
+import time
+import numpy as np
+from scipy import sparse
+from workload import max_min_ratio
+
+
+class Level:
+    """
+    One level of the coarsening hierarchy: a weighted graph (CSR, edge
+    weights are shared boundary lengths), per-node workload and cell
+    counts, each node's sector position, and the map from the finer
+    level's nodes onto this level's (None for the finest level).
+    """
+
+    def __init__(self, graph, weights, counts, assignment, fine_to_coarse=None):
+        self.graph = graph
+        self.weights = weights
+        self.counts = counts
+        self.assignment = assignment
+        self.fine_to_coarse = fine_to_coarse
+
+    def __len__(self):
+        return len(self.weights)
+
+
+def heavy_edge_matching(graph, assignment, weights, counts, max_weight, max_count, seed=0, rounds=8):
+    """
+    Match every node with at most one neighbor of the same sector along its
+    heaviest edge. Each unmatched node proposes to its heaviest eligible
+    neighbor (random tie-breaking) and mutual proposals are matched; a few
+    more rounds pick up nodes whose first choice was taken. Pairs whose combined
+    workload or cell count would exceed max_weight / max_count are not
+    matched, so super-nodes stay small relative to a sector.
+    Returns the partner of each node (itself when unmatched).
+    """
+    n = len(weights)
+    src = np.repeat(np.arange(n), np.diff(graph.indptr))
+    dst = graph.indices
+    rng = np.random.default_rng(seed)
+    # Shared boundary squared over the pair's sizes: favors compact pairs of small nodes
+    # over everything merging into a few large ones
+    edge_weight = graph.data.astype(np.float64) ** 2 / (counts[src] * counts[dst]) + rng.random(len(dst)) * 1e-9
+    eligible = ((assignment[src] == assignment[dst]) & (src != dst)
+                & (weights[src] + weights[dst] <= max_weight) & (counts[src] + counts[dst] <= max_count))
+    # Sorted once so each node's heaviest free edge comes first in every round
+    order = np.lexsort((-edge_weight[eligible], src[eligible]))
+    src, dst = src[eligible][order], dst[eligible][order]
+    partner = np.arange(n)
+    matched = np.zeros(n, dtype=bool)
+    for _ in range(rounds):
+        free = ~matched[src] & ~matched[dst]
+        src, dst = src[free], dst[free]
+        if len(src) == 0:
+            break
+        first = np.r_[True, src[1:] != src[:-1]]
+        proposers = src[first]
+        choice = np.full(n, -1)
+        choice[proposers] = dst[first]
+        mutual = proposers[(choice[choice[proposers]] == proposers) & (proposers < choice[proposers])]
+        partner[mutual] = choice[mutual]
+        partner[choice[mutual]] = mutual
+        matched[mutual] = True
+        matched[choice[mutual]] = True
+    return partner
+
+
+def coarsen(level, max_weight, max_count, seed=0):
+    """Contract a heavy-edge matching of level into the next coarser Level."""
+    partner = heavy_edge_matching(level.graph, level.assignment, level.weights, level.counts,
+                                  max_weight, max_count, seed)
+    leader = np.minimum(np.arange(len(level)), partner)
+    _, fine_to_coarse = np.unique(leader, return_inverse=True)
+    n_coarse = fine_to_coarse.max() + 1
+    coo = level.graph.tocoo()
+    src, dst = fine_to_coarse[coo.row], fine_to_coarse[coo.col]
+    keep = src != dst
+    # Parallel edges between two super-nodes add up to their shared boundary
+    graph = sparse.csr_matrix((coo.data[keep], (src[keep], dst[keep])), shape=(n_coarse, n_coarse))
+    assignment = np.zeros(n_coarse, dtype=np.int64)
+    assignment[fine_to_coarse] = level.assignment
+    return Level(graph, np.bincount(fine_to_coarse, weights=level.weights, minlength=n_coarse),
+                 np.bincount(fine_to_coarse, weights=level.counts, minlength=n_coarse).astype(np.int64),
+                 assignment, fine_to_coarse)
+
+
+def _locally_removable(c, a, assign, ptr, idx):
+    """
+    True if the neighbors of c in sector a stay connected without c through
+    a's nodes within two hops of c. Sufficient (not necessary) for moving c
+    out of a without splitting a, at O(degree^2) cost on any graph.
+    """
+    same = [j for j in idx[ptr[c]:ptr[c + 1]] if assign[j] == a]
+    if len(same) <= 1:
+        return True
+    local = set(same)
+    for j in same:
+        local.update(k for k in idx[ptr[j]:ptr[j + 1]] if assign[k] == a)
+    local.discard(c)
+    seen = {same[0]}
+    stack = [same[0]]
+    while stack:
+        j = stack.pop()
+        for k in idx[ptr[j]:ptr[j + 1]]:
+            if k in local and k not in seen:
+                seen.add(k)
+                stack.append(k)
+    return all(j in seen for j in same)
+
+
+def refine(assignment, weights, graph, n_sectors, max_passes=20, seed=0, contiguous=True, min_nodes=1):
+    """
+    Greedy boundary refinement: in random order, move each boundary node to
+    its lightest neighboring sector whenever that lowers the sum of squared
+    sector totals. With contiguous=True a move must pass _locally_removable.
+    Stops after a pass without moves.
+    Returns (assignment, number of moves).
+    """
+    rng = np.random.default_rng(seed)
+    current = np.asarray(assignment, dtype=np.int64).copy()
+    weights = np.asarray(weights, dtype=np.float64)
+    src = np.repeat(np.arange(len(current)), np.diff(graph.indptr))
+    dst = graph.indices
+    tot = np.bincount(current, weights=weights, minlength=n_sectors)
+    cnt = np.bincount(current, minlength=n_sectors).tolist()
+    ptr = idx = w = None
+    moves = 0
+    for _ in range(max_passes):
+        # Candidates improve on the totals at the start of the pass; nodes that
+        # only become improving during the pass are picked up by the next one
+        foreign = current[src] != current[dst]
+        lightest = np.full(len(current), np.inf)
+        np.minimum.at(lightest, src[foreign], tot[current[dst[foreign]]])
+        candidates = np.flatnonzero(tot[current] - lightest > weights)
+        if len(candidates) == 0:
+            break
+        if ptr is None:
+            ptr, idx, w = graph.indptr.tolist(), dst.tolist(), weights.tolist()
+        assign = current.tolist()
+        sector_tot = tot.tolist()
+        moved = 0
+        for c in rng.permutation(candidates).tolist():
+            a = assign[c]
+            wc = w[c]
+            if cnt[a] <= min_nodes:
+                continue
+            b = min((assign[j] for j in idx[ptr[c]:ptr[c + 1]] if assign[j] != a), key=sector_tot.__getitem__)
+            # Lowers the sum of squares iff 2 * wc * (tot[b] - tot[a] + wc) < 0
+            if sector_tot[a] - sector_tot[b] <= wc:
+                continue
+            if contiguous and not _locally_removable(c, a, assign, ptr, idx):
+                continue
+            assign[c] = b
+            sector_tot[a] -= wc
+            sector_tot[b] += wc
+            cnt[a] -= 1
+            cnt[b] += 1
+            moved += 1
+        current = np.asarray(assign, dtype=np.int64)
+        tot = np.asarray(sector_tot)
+        moves += moved
+        if moved == 0:
+            break
+    return current, moves
+
+
+def multilevel_partition(assignment, weights, graph, n_sectors, coarse_nodes=None, max_node_fraction=0.05,
+                         max_passes=20, seed=0, contiguous=True):
+    """
+    Multilevel rebalancing of a sector assignment over a cell graph
+    (CSR with shared boundary lengths as edge weights, e.g.
+    grid_utils.lattice_contacts). Cells are coarsened by heavy-edge matching
+    within their current sector until about coarse_nodes super-nodes remain
+    (default 50 per sector) or matching stalls; super-nodes are capped at
+    max_node_fraction of a mean sector's workload and cells. The coarsest
+    level is balanced from the current assignment, then the assignment is
+    projected back and refined level by level (see refine), so large
+    workload shifts are made by moving big super-nodes and the fine levels
+    only polish the boundaries.
+    Returns (assignment, stats).
+    """
+    start = time.perf_counter()
+    assignment = np.asarray(assignment, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float64)
+    coarse_nodes = 50 * n_sectors if coarse_nodes is None else coarse_nodes
+    max_weight = max_node_fraction * weights.sum() / n_sectors
+    max_count = max(2, int(max_node_fraction * len(weights) / n_sectors))
+    levels = [Level(graph.tocsr(), weights, np.ones(len(weights), dtype=np.int64), assignment)]
+    while len(levels[-1]) > coarse_nodes:
+        coarser = coarsen(levels[-1], max_weight, max_count, seed + len(levels))
+        if len(coarser) > 0.85 * len(levels[-1]):
+            break
+        levels.append(coarser)
+    coarsen_time = time.perf_counter() - start
+
+    current = levels[-1].assignment
+    moves = []
+    for depth in range(len(levels) - 1, -1, -1):
+        level = levels[depth]
+        current, n_moves = refine(current, level.weights, level.graph, n_sectors, max_passes,
+                                  seed + depth, contiguous)
+        moves.append(n_moves)
+        if depth > 0:
+            current = current[level.fine_to_coarse]
+    totals = np.bincount(current, weights=weights, minlength=n_sectors)
+    initial_totals = np.bincount(assignment, weights=weights, minlength=n_sectors)
+    stats = {
+        "levels": [len(level) for level in levels],
+        "moves": moves[::-1],
+        "initial_variance": float(np.var(initial_totals)),
+        "final_variance": float(np.var(totals)),
+        "final_ratio": max_min_ratio(totals),
+        "coarsen_time": coarsen_time,
+        "elapsed": time.perf_counter() - start,
+    }
+    return current, stats
@@ -1,36 +1,140 @@
-import geopandas as gpd
+import logging
 import pandas as pd
 import numpy as np
+import config
+import grid_utils as gu
+import instrumentation
+from workload import max_min_ratio
 
+logger = logging.getLogger(__name__)
 
-def aggregate_npps_by_grid(npps_data, grid):
+
+def locate_npps(npps_data, locator):
+    """
+    Grid position and NPPS of the incidents in one batch that fall in a cell.
+    Returns (positions, npps) arrays.
+    """
+    positions = locator.locate(npps_data['lon'].to_numpy(), npps_data['lat'].to_numpy())
+    weights = npps_data['NPPS'].to_numpy(dtype=np.float64)
+    keep = (positions >= 0) & ~np.isnan(weights)
+    instrumentation.count("incidents_binned", int(keep.sum()))
+    return positions[keep], weights[keep]
+
+
+def bin_npps_to_grid(npps_data, locator):
     """
-    Assign each NPPS point to the nearest grid cell and aggregate NPPS by grid.
-    Returns the grid with a new 'total_npps' column.
+    Sum the NPPS of one batch of incidents into grid cells.
+    Returns an array of per-cell NPPS aligned with the grid positions.
     """
-    npps_data = gpd.GeoDataFrame(
-        npps_data,
-        geometry=gpd.points_from_xy(npps_data['lon'], npps_data['lat']),
-        crs="EPSG:4326"
-    )
-    npps_data = gpd.sjoin_nearest(npps_data, grid, how="left", distance_col="distance_to_grid")
-    grid_npps_sum = npps_data.groupby("Grid_ID")["NPPS"].sum().reset_index()
-    grid_npps_sum.rename(columns={"NPPS": "total_npps"}, inplace=True)
-    grid = grid.merge(grid_npps_sum, on="Grid_ID", how="left")
-    grid["total_npps"] = grid["total_npps"].fillna(0)
+    positions, weights = locate_npps(npps_data, locator)
+    return np.bincount(positions, weights=weights, minlength=len(locator.grid))
+
+
+def aggregate_npps_by_grid(npps_data, grid, chunk_size=None):
+    """
+    Assign each NPPS point to its grid cell and aggregate NPPS by grid.
+    Points are binned by lattice arithmetic; points outside the grid or in
+    dropped cells go to the nearest cell. npps_data may be a DataFrame
+    (optionally processed chunk_size rows at a time) or an iterable of
+    DataFrame chunks.
+    Returns the grid with a new 'total_npps' column (a CompactGrid gets the
+    column in place).
+    """
+    locator = gu.CellLocator(grid)
+    if isinstance(npps_data, pd.DataFrame):
+        if chunk_size is None:
+            chunks = [npps_data]
+        else:
+            chunks = (npps_data.iloc[i:i + chunk_size] for i in range(0, len(npps_data), chunk_size))
+    else:
+        chunks = npps_data
+    total_npps = np.zeros(len(grid), dtype=np.float64)
+    for chunk in chunks:
+        total_npps += bin_npps_to_grid(chunk, locator)
+    if isinstance(grid, pd.DataFrame):
+        grid = grid.reset_index(drop=True)
+    grid["total_npps"] = total_npps
     return grid
 
 
+def aggregate_npps_components_by_grid(npps_data, grid):
+    """
+    Per-cell sums of the NPPS ingredients, so NPPS can be recomputed for other
+    NPPS_WEIGHTS / PRIORITY_WEIGHTS without re-reading the incidents.
+    npps_data is a scored DataFrame (see calculate_npps) or an iterable of them.
+    Returns a DataFrame aligned with the grid positions: one 'priority_<n>'
+    column of incident counts per priority level, 'response_time' (sum of
+    scaled response times) and 'disposition' (sum of disposition weights).
+    """
+    locator = gu.CellLocator(grid)
+    chunks = [npps_data] if isinstance(npps_data, pd.DataFrame) else npps_data
+    n_cells = len(grid)
+    priority = {}
+    response_time = np.zeros(n_cells, dtype=np.float64)
+    disposition = np.zeros(n_cells, dtype=np.float64)
+    for chunk in chunks:
+        positions = locator.locate(chunk['lon'].to_numpy(), chunk['lat'].to_numpy())
+        # Same rows as bin_npps_to_grid: located and with a defined NPPS
+        keep = (positions >= 0) & ~np.isnan(chunk['NPPS'].to_numpy(dtype=np.float64))
+        positions = positions[keep]
+        levels = chunk['Priority Numeric'].to_numpy()[keep]
+        for level in np.unique(levels):
+            counts = np.bincount(positions[levels == level], minlength=n_cells).astype(np.float64)
+            priority[int(level)] = priority.get(int(level), 0.0) + counts
+        response_time += np.bincount(positions, weights=chunk['Scaled Response Time'].to_numpy()[keep],
+                                     minlength=n_cells)
+        disposition += np.bincount(positions, weights=chunk['Disposition Weight'].to_numpy()[keep],
+                                   minlength=n_cells)
+    columns = {f"priority_{level}": priority[level] for level in sorted(priority)}
+    columns["response_time"] = response_time
+    columns["disposition"] = disposition
+    return pd.DataFrame(columns)
+
+
+def npps_from_components(components, npps_weights=None, priority_weights=None):
+    """
+    Per-cell NPPS from aggregate_npps_components_by_grid output under the
+    given weights (default config.NPPS_WEIGHTS / config.PRIORITY_WEIGHTS).
+    Returns an array aligned with the grid positions.
+    """
+    w = config.NPPS_WEIGHTS if npps_weights is None else npps_weights
+    priority_weights = config.PRIORITY_WEIGHTS if priority_weights is None else priority_weights
+    priority = np.zeros(len(components), dtype=np.float64)
+    for column in components.columns:
+        if column.startswith("priority_"):
+            level = int(column[len("priority_"):])
+            priority += priority_weights.get(level, 0.0) * components[column].to_numpy()
+    return (w['priority'] * priority +
+            w['response_time'] * components['response_time'].to_numpy() +
+            w['disposition'] * components['disposition'].to_numpy())
+
+
 def aggregate_npps_by_sector(grid):
     """
     Aggregate total NPPS by sector from the grid.
     Returns a DataFrame with columns: Sector, sector_total_npps
     """
-    sector_npps_sum = grid.groupby("Sector")["total_npps"].sum().reset_index()
+    columns = {"Sector": grid["Sector"].to_numpy(), "total_npps": grid["total_npps"].to_numpy()}
+    sector_npps_sum = pd.DataFrame(columns, copy=False).groupby("Sector")["total_npps"].sum().reset_index()
     sector_npps_sum.rename(columns={"total_npps": "sector_total_npps"}, inplace=True)
     return sector_npps_sum
 
 
+def balance_metrics(sector_sum: pd.DataFrame, column: str = "sector_total_npps") -> dict:
+    """
+    Summarize how balanced a sector NPPS table is.
+    Returns a dict with variance, max/min ratio and the largest absolute
+    deviation from the mean (%).
+    """
+    values = sector_sum[column].to_numpy(dtype=float)
+    mean = values.mean()
+    return {
+        "variance": float(np.var(values)),
+        "max_min_ratio": max_min_ratio(values),
+        "max_dev_from_mean(%)": float(np.abs((values - mean) / mean).max() * 100),
+    }
+
+
 def evaluate_npps_balance(old_sum: pd.DataFrame, new_sum: pd.DataFrame):
     """
     Compare NPPS balance before and after optimization.
@@ -38,22 +142,20 @@ def evaluate_npps_balance(old_sum: pd.DataFrame, new_sum: pd.DataFrame):
     Returns merged DataFrame for further analysis.
     """
     merged = old_sum.merge(new_sum, on="Sector", suffixes=("_old", "_new"))
-    old_var = np.var(merged["sector_total_npps_old"])
-    new_var = np.var(merged["sector_total_npps_new"])
-    old_ratio = merged["sector_total_npps_old"].max() / merged["sector_total_npps_old"].min()
-    new_ratio = merged["sector_total_npps_new"].max() / merged["sector_total_npps_new"].min()
+    old_metrics = balance_metrics(merged, "sector_total_npps_old")
+    new_metrics = balance_metrics(merged, "sector_total_npps_new")
     old_mean = merged["sector_total_npps_old"].mean()
     new_mean = merged["sector_total_npps_new"].mean()
     merged["old_dev_from_mean(%)"] = ((merged["sector_total_npps_old"] - old_mean) / old_mean) * 100
     merged["new_dev_from_mean(%)"] = ((merged["sector_total_npps_new"] - new_mean) / new_mean) * 100
-    print("\n📊 **NPPS Variance Comparison** 📊")
-    print(f"Before Optimization: {old_var:.2f}")
-    print(f"After Optimization:  {new_var:.2f}")
-    print("\n📊 **Max/Min Ratio Comparison** 📊")
-    print(f"Before Optimization: {old_ratio:.2f}")
-    print(f"After Optimization:  {new_ratio:.2f}")
-    print("\n📊 **Deviation from Mean (%) (First 5 Sectors)** 📊")
-    print(merged[["Sector", "old_dev_from_mean(%)", "new_dev_from_mean(%)"]].head(14))
+    logger.info("\n📊 **NPPS Variance Comparison** 📊")
+    logger.info(f"Before Optimization: {old_metrics['variance']:.2f}")
+    logger.info(f"After Optimization:  {new_metrics['variance']:.2f}")
+    logger.info("\n📊 **Max/Min Ratio Comparison** 📊")
+    logger.info(f"Before Optimization: {old_metrics['max_min_ratio']:.2f}")
+    logger.info(f"After Optimization:  {new_metrics['max_min_ratio']:.2f}")
+    logger.info("\n📊 **Deviation from Mean (%) (First 5 Sectors)** 📊")
+    logger.info("%s", merged[["Sector", "old_dev_from_mean(%)", "new_dev_from_mean(%)"]].head(14))
     return merged
 
 
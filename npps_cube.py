@@ -0,0 +1,208 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import config
+import data_preprocessing as dp
+import grid_utils as gu
+import ingest
+import npps_analysis as na
+
+HOURS_PER_DAY = 24
+HOURS_PER_WEEK = 7 * HOURS_PER_DAY
+
+
+def hour_of_week(timestamps):
+    """
+    Hour-of-week bin (Monday 00:00 = 0 ... Sunday 23:00 = 167) of each
+    timestamp; -1 where the timestamp is missing or unparseable.
+    """
+    ts = pd.to_datetime(pd.Series(timestamps), errors="coerce")
+    bins = (ts.dt.dayofweek * HOURS_PER_DAY + ts.dt.hour).to_numpy(dtype=np.float64)
+    return np.where(np.isnan(bins), -1, bins).astype(np.int64)
+
+
+def shift_mask(shift, days=None):
+    """
+    Boolean mask over the hour-of-week bins covered by a daily shift.
+    shift is a name in config.SHIFTS or a (start_hour, end_hour) pair, end
+    exclusive; shifts with end <= start run past midnight and belong to the
+    day they start on. days restricts to those start days (0 = Monday).
+    """
+    start, end = config.SHIFTS[shift] if isinstance(shift, str) else shift
+    hour = np.arange(HOURS_PER_WEEK) % HOURS_PER_DAY
+    day = np.arange(HOURS_PER_WEEK) // HOURS_PER_DAY
+    if start < end:
+        mask = (hour >= start) & (hour < end)
+        start_day = day
+    else:
+        mask = (hour >= start) | (hour < end)
+        start_day = np.where(hour < end, (day - 1) % 7, day)
+    if days is not None:
+        mask &= np.isin(start_day, days)
+    return mask
+
+
+def mix_weights(mix):
+    """
+    Per-bin weights for a weighted mix of shifts, e.g. {"day": 0.5, "night": 0.5}.
+    A bin covered by several shifts gets the sum of their weights.
+    """
+    weights = np.zeros(HOURS_PER_WEEK, dtype=np.float64)
+    for shift, weight in mix.items():
+        weights += weight * shift_mask(shift)
+    return weights
+
+
+class NppsCube:
+    """
+    Dense cells x hour-of-week NPPS array (values[i, b] is the NPPS of grid
+    position i in hour-of-week bin b), so workload can be read for any
+    shift definition without re-aggregating the incidents.
+    """
+
+    def __init__(self, values):
+        self.values = np.asarray(values, dtype=np.float64)
+
+    @property
+    def n_cells(self):
+        return self.values.shape[0]
+
+    def cell_npps(self, weights=None):
+        """Per-cell NPPS under per-bin weights (all hours when None)."""
+        if weights is None:
+            return self.values.sum(axis=1)
+        return self.values @ np.asarray(weights, dtype=np.float64)
+
+    def shift_npps(self, shift):
+        """Per-cell NPPS of one shift (a config.SHIFTS name or hour pair)."""
+        return self.cell_npps(shift_mask(shift))
+
+    def mix_npps(self, mix):
+        """Per-cell NPPS of a weighted mix of shifts."""
+        return self.cell_npps(mix_weights(mix))
+
+    def sector_hours(self, sector, sectors=None):
+        """
+        Sector x hour-of-week NPPS for a per-cell sector assignment aligned
+        with the cube; rows follow sectors (default the sorted sector labels).
+        Returns (sectors, values).
+        """
+        sector = np.asarray(sector)
+        sectors = np.unique(sector) if sectors is None else np.asarray(sectors)
+        positions = np.searchsorted(sectors, sector)
+        onehot = sparse.csr_matrix((np.ones(len(sector)), (positions, np.arange(len(sector)))),
+                                   shape=(len(sectors), len(sector)))
+        return sectors, onehot @ self.values
+
+    def sector_windows(self, sector):
+        """SectorWindows for a per-cell sector assignment aligned with the cube."""
+        return SectorWindows(*self.sector_hours(sector))
+
+
+class SectorWindows:
+    """
+    Sector x hour-of-week NPPS kept as cumulative sums along the week, so the
+    sector totals of any time window cost O(sectors) instead of re-running
+    the aggregation.
+    """
+
+    def __init__(self, sectors, values):
+        self.sectors = np.asarray(sectors)
+        self.cumulative = np.zeros((len(self.sectors), HOURS_PER_WEEK + 1), dtype=np.float64)
+        np.cumsum(values, axis=1, out=self.cumulative[:, 1:])
+
+    def window(self, start_bin, end_bin):
+        """
+        Sector totals over bins [start_bin, end_bin), at most one week long;
+        end_bin may run past the end of the week, wrapping to Monday.
+        """
+        length = end_bin - start_bin
+        if not 0 <= length <= HOURS_PER_WEEK:
+            raise ValueError(f"Window [{start_bin}, {end_bin}) must span 0 to {HOURS_PER_WEEK} hours")
+        start = start_bin % HOURS_PER_WEEK
+        end = start + length
+        c = self.cumulative
+        if end <= HOURS_PER_WEEK:
+            return c[:, end] - c[:, start]
+        return c[:, HOURS_PER_WEEK] - c[:, start] + c[:, end - HOURS_PER_WEEK]
+
+    def shift(self, shift, days=None):
+        """Sector totals of a daily shift summed over its start days (default all week)."""
+        start, end = config.SHIFTS[shift] if isinstance(shift, str) else shift
+        if end <= start:
+            end += HOURS_PER_DAY
+        days = range(7) if days is None else days
+        return sum(self.window(d * HOURS_PER_DAY + start, d * HOURS_PER_DAY + end) for d in days)
+
+    def to_frame(self, totals):
+        """DataFrame with columns: Sector, sector_total_npps"""
+        return pd.DataFrame({"Sector": self.sectors, "sector_total_npps": totals})
+
+    def balance(self, totals):
+        """Balance metrics (see balance_metrics) plus {sector: total} for one set of window totals."""
+        return {**na.balance_metrics(self.to_frame(totals)),
+                "sector_total_npps": dict(zip(self.sectors.tolist(), np.asarray(totals).tolist()))}
+
+    def shift_balance(self, shifts=None):
+        """balance() of every shift in shifts (default all of config.SHIFTS), keyed by shift name."""
+        shifts = config.SHIFTS if shifts is None else shifts
+        return {name: self.balance(self.shift(name)) for name in shifts}
+
+
+def spec_weights(shift=None, mix=None):
+    """
+    Per-bin weights for a scenario or request asking for one shift (a
+    config.SHIFTS name or [start_hour, end_hour]) or a mix of shifts;
+    None when neither is given.
+    """
+    if shift is not None and mix is not None:
+        raise ValueError("Give either a shift or a shift mix, not both")
+    if shift is not None:
+        return shift_mask(shift if isinstance(shift, str) else tuple(shift)).astype(np.float64)
+    if mix is not None:
+        return mix_weights(mix)
+    return None
+
+
+def aggregate_npps_cube(npps_data, grid, timestamp_column=None):
+    """
+    Bin scored incidents (a DataFrame or an iterable of chunks, see
+    calculate_npps) into grid cells and hour-of-week bins.
+    Incidents without a usable timestamp are left out of the cube.
+    Returns an NppsCube aligned with the grid positions.
+    """
+    locator = gu.CellLocator(grid)
+    chunks = [npps_data] if isinstance(npps_data, pd.DataFrame) else npps_data
+    n_cells = len(grid)
+    values = np.zeros(n_cells * HOURS_PER_WEEK, dtype=np.float64)
+    for chunk in chunks:
+        positions, bins, weights = locate_incidents(chunk, locator, timestamp_column)
+        values += np.bincount(positions * HOURS_PER_WEEK + bins, weights=weights, minlength=len(values))
+    return NppsCube(values.reshape(n_cells, HOURS_PER_WEEK))
+
+
+def locate_incidents(scored, locator, timestamp_column=None):
+    """
+    Grid position, hour-of-week bin and NPPS of the scored incidents that
+    fall in a cell and have a usable timestamp.
+    Returns (positions, bins, npps) arrays.
+    """
+    timestamp_column = config.TIMESTAMP_COLUMN if timestamp_column is None else timestamp_column
+    positions = locator.locate(scored['lon'].to_numpy(), scored['lat'].to_numpy())
+    bins = hour_of_week(scored[timestamp_column])
+    weights = scored['NPPS'].to_numpy(dtype=np.float64)
+    keep = (positions >= 0) & (bins >= 0) & ~np.isnan(weights)
+    return positions[keep], bins[keep], weights[keep]
+
+
+def load_npps_cube(grid):
+    """
+    Load and score the incidents (INCIDENT_DATA_DIR streamed in chunks, else
+    YEAR_DATA_PATH) with their timestamps and build the NPPS cube.
+    """
+    if config.INCIDENT_DATA_DIR is not None:
+        columns = dp.INCIDENT_COLUMNS + [config.TIMESTAMP_COLUMN]
+        npps_data = ingest.iter_scored_chunks(ingest.incident_paths(), columns=columns)
+    else:
+        npps_data = dp.calculate_npps(dp.preprocess_incident_data(dp.load_incident_data()))
+    return aggregate_npps_cube(npps_data, grid)
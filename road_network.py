@@ -0,0 +1,214 @@
+import logging
+import numpy as np
+import shapely
+from pyproj import Transformer
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+import config
+import grid_utils as gu
+
+logger = logging.getLogger(__name__)
+
+
+class RoadGraph:
+    """
+    Street centerlines as an undirected CSR graph: nodes are the line
+    vertices (merged within precision meters) in a metric CRS, edge weights
+    the segment lengths in meters. Only the largest connected component is
+    kept so every cell snaps to a node that every sector centre can reach.
+    """
+
+    def __init__(self, nodes, indptr, indices, lengths, metric_crs):
+        self.nodes = np.asarray(nodes, dtype=np.float64)
+        self.graph = sparse.csr_matrix((lengths, indices, indptr), shape=(len(self.nodes), len(self.nodes)))
+        self.metric_crs = metric_crs
+        self._tree = None
+
+    @classmethod
+    def from_streets(cls, streets, metric_crs=None, precision=0.5):
+        """Build from a centerline GeoDataFrame (LineStrings or MultiLineStrings)."""
+        if metric_crs is None:
+            metric_crs = config.SNAP_CRS if config.SNAP_CRS is not None else streets.estimate_utm_crs()
+        lines = streets.to_crs(metric_crs).geometry.explode(index_parts=False).to_numpy()
+        coords, line = shapely.get_coordinates(lines, return_index=True)
+        _, node = np.unique(np.round(coords / precision).astype(np.int64), axis=0, return_inverse=True)
+        node = node.ravel()
+        nodes = np.zeros((node.max() + 1, 2))
+        nodes[node] = coords
+        # Consecutive vertices of the same line form an edge
+        same = line[1:] == line[:-1]
+        src, dst = node[:-1][same], node[1:][same]
+        length = np.hypot(*(coords[1:][same] - coords[:-1][same]).T)
+        keep = src != dst
+        src, dst, length = src[keep], dst[keep], length[keep]
+        graph = _min_edges(np.r_[src, dst], np.r_[dst, src], np.r_[length, length], len(nodes))
+        # Largest connected component only
+        _, component = csgraph.connected_components(graph, directed=False)
+        main = np.flatnonzero(component == np.bincount(component).argmax())
+        graph = graph[main][:, main].tocsr()
+        return cls(nodes[main], graph.indptr, graph.indices, graph.data.astype(np.float32), metric_crs)
+
+    @property
+    def n_nodes(self):
+        return len(self.nodes)
+
+    def snap_points(self, x, y, crs):
+        """
+        Nearest node of each (x, y) point given in crs.
+        Returns (node index, straight-line distance to it in meters).
+        """
+        if self._tree is None:
+            self._tree = cKDTree(self.nodes)
+        mx, my = Transformer.from_crs(crs, self.metric_crs, always_xy=True).transform(x, y)
+        offset, node = self._tree.query(np.column_stack([mx, my]))
+        return node.astype(np.int64), offset
+
+    def snap_cells(self, grid):
+        """Nearest node of every grid cell centroid; see snap_points."""
+        row, col = gu.lattice_indices(grid)
+        x, y = gu.lattice_spec(grid).centroids(row, col, gu.lattice_spans(grid))
+        return self.snap_points(x, y, grid.crs)
+
+    def distances(self, sources):
+        """
+        Shortest-path distances (meters) from each source node to every node,
+        one row per source, in a single multi-source Dijkstra call.
+        """
+        return csgraph.dijkstra(self.graph, directed=True, indices=np.asarray(sources)).astype(np.float32)
+
+    def to_arrays(self):
+        return {"nodes": self.nodes, "indptr": self.graph.indptr, "indices": self.graph.indices,
+                "lengths": self.graph.data}
+
+
+def _min_edges(src, dst, length, n_nodes):
+    """CSR adjacency keeping the shortest of any parallel edges (csr_matrix would sum them)."""
+    order = np.lexsort((length, dst, src))
+    src, dst, length = src[order], dst[order], length[order]
+    first = np.r_[True, (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])]
+    return sparse.csr_matrix((length[first], (src[first], dst[first])), shape=(n_nodes, n_nodes))
+
+
+def sector_centres(grid):
+    """
+    Centre cell of every sector: the sector's own cell closest to the
+    area-weighted centroid of its cells (so it lies inside the sector).
+    Returns (sectors, centre grid positions).
+    """
+    row, col = gu.lattice_indices(grid)
+    span = gu.lattice_spans(grid)
+    x, y = gu.lattice_spec(grid).centroids(row, col, span)
+    area = span.astype(np.float64) ** 2
+    sector = grid["Sector"].to_numpy()
+    sectors, positions = np.unique(sector, return_inverse=True)
+    total = np.bincount(positions, weights=area)
+    cx = np.bincount(positions, weights=area * x) / total
+    cy = np.bincount(positions, weights=area * y) / total
+    d2 = (x - cx[positions]) ** 2 + (y - cy[positions]) ** 2
+    order = np.lexsort((d2, positions))
+    first = np.r_[True, positions[order][1:] != positions[order][:-1]]
+    return sectors, order[first]
+
+
+def centre_distances(road, centres, cell_node, cell_offset):
+    """
+    Road distance (meters) from each centre cell to every cell: Dijkstra
+    from the centres' snapped nodes plus each cell's offset to its node.
+    Returns an (n_centres, n_cells) float32 array.
+    """
+    return road.distances(cell_node[centres])[:, cell_node] + np.asarray(cell_offset, dtype=np.float32)
+
+
+class TravelTable:
+    """
+    Road distance from each sector's centre node to every cell
+    (n_sectors x n_cells float32: Dijkstra distance to the cell's snapped
+    node plus the straight-line offset to the centroid), and per-sector
+    totals of the area-weighted distance of the cells each sector holds.
+    Cell areas count in CELL_SIZE cells, so a travel weight means the same
+    on uniform and quadtree grids.
+    Cell moves update the totals in O(1); distances only change when a
+    centre is moved with recentre(), which main.py runs after every
+    rebalance (an optimizer run itself measures from the centres it started
+    with).
+    """
+
+    def __init__(self, sectors, centres, distances, cell_weight, assignment):
+        self.sectors = np.asarray(sectors, dtype=np.int64)
+        self.centres = np.asarray(centres, dtype=np.int64)
+        self.distances = distances
+        self.cell_weight = np.asarray(cell_weight, dtype=np.float64)
+        self.assignment = np.asarray(assignment, dtype=np.int64).copy()
+        self._position = {int(s): i for i, s in enumerate(self.sectors)}
+        cells = np.arange(len(self.assignment))
+        self.totals = np.bincount(self.assignment, minlength=len(self.sectors),
+                                  weights=self.cell_weight * self.distances[self.assignment, cells])
+
+    @classmethod
+    def build(cls, grid, road, cell_node=None, cell_offset=None):
+        """Snap the cells (unless cell_node/cell_offset are given) and run Dijkstra from each sector's centre."""
+        if cell_node is None:
+            cell_node, cell_offset = road.snap_cells(grid)
+        sectors, centres = sector_centres(grid)
+        return cls.from_distances(grid, sectors, centres, centre_distances(road, centres, cell_node, cell_offset))
+
+    @classmethod
+    def from_distances(cls, grid, sectors, centres, distances):
+        """Table for the grid's current assignment from precomputed (e.g. cached) centre distances."""
+        side = gu.lattice_spans(grid) * (gu.lattice_spec(grid).cell_size / config.CELL_SIZE)
+        return cls(sectors, centres, distances, side ** 2, np.searchsorted(sectors, grid["Sector"].to_numpy()))
+
+    def position(self, sector):
+        return self._position[int(sector)]
+
+    def move(self, cell, to_sector):
+        """Record that the cell at grid position cell moved to to_sector."""
+        a = self.assignment[cell]
+        b = self.position(to_sector)
+        w = self.cell_weight[cell]
+        self.totals[a] -= w * self.distances[a, cell]
+        self.totals[b] += w * self.distances[b, cell]
+        self.assignment[cell] = b
+
+    def move_cells(self, cells, to_sector):
+        """Record a batch of cells (grid positions) moving to to_sector."""
+        for cell in np.asarray(cells).tolist():
+            self.move(cell, to_sector)
+
+    def cost_matrix(self, weight):
+        """Per-cell cost of each sector holding each cell, in objective units (weight per cell-meter)."""
+        return (weight * self.cell_weight[None, :] * self.distances).astype(np.float32)
+
+    @property
+    def total(self):
+        return float(self.totals.sum())
+
+    def stale_sectors(self, grid):
+        """Sectors whose centre cell (see sector_centres) is no longer the one distances were run from."""
+        sectors, centres = sector_centres(grid)
+        current = dict(zip(sectors.tolist(), centres.tolist()))
+        return [int(s) for s, c in zip(self.sectors, self.centres) if current.get(int(s)) != c]
+
+    def recentre(self, grid, road, cell_node, cell_offset, sectors=None):
+        """
+        Re-run Dijkstra for the given sectors (default: the stale ones) from
+        their current centres and refresh their distance rows and totals.
+        Returns the sectors updated.
+        """
+        sectors = self.stale_sectors(grid) if sectors is None else list(sectors)
+        if not sectors:
+            return []
+        all_sectors, centres = sector_centres(grid)
+        centre = dict(zip(all_sectors.tolist(), centres.tolist()))
+        pos = np.array([self.position(s) for s in sectors])
+        new_centres = np.array([centre[s] for s in sectors])
+        if not self.distances.flags.writeable:
+            self.distances = np.array(self.distances)
+        self.distances[pos] = centre_distances(road, new_centres, cell_node, cell_offset)
+        self.centres[pos] = new_centres
+        cells = np.arange(len(self.assignment))
+        held = self.cell_weight * self.distances[self.assignment, cells]
+        self.totals = np.bincount(self.assignment, weights=held, minlength=len(self.sectors))
+        logger.info(f"🛣️ Recentred {len(sectors)} sector(s)")
+        return sectors
@@ -0,0 +1,331 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import config
+import data_preprocessing as dp
+import grid_utils as gu
+import ingest
+import instrumentation
+import npps_analysis as na
+import npps_cube
+import rebalancer as rb
+import sector_optimization as so
+import stage_cache
+from sector_graph import SectorGraph
+from stage_cache import StageCache
+from workload import SectorLedger
+
+logger = logging.getLogger(__name__)
+
+
+class ScenarioBase:
+    """
+    Grid and NPPS data loaded once and shared by every scenario.
+    Holds the per-cell Grid_ID, lattice row/col (plus span for quadtree
+    grids), base Sector assignment and NPPS (plus the NPPS components when
+    weight overrides are needed, and the hour-of-week NPPS cube for shift
+    scenarios) as read-only arrays; each scenario gets a frame that shares
+    them and owns only its copy of the Sector column.
+    """
+
+    def __init__(self, arrays, component_columns=None):
+        self.arrays = arrays
+        self.component_columns = component_columns
+        frame = self.frame()
+        self.adjacency = gu.lattice_adjacency(frame)
+        self.contacts = gu.lattice_contacts(frame)
+
+    @classmethod
+    def from_grid(cls, grid, npps_data=None, value_col="total_npps"):
+        """
+        Build from a grid with Grid_ID, row, col, Sector and value_col
+        columns. Pass the scored incidents (a DataFrame or an iterable of
+        chunks) to allow scenarios with their own NPPS weights.
+        """
+        components = None
+        if npps_data is not None:
+            components = na.aggregate_npps_components_by_grid(npps_data, grid)
+        return cls.from_components(grid, components, grid[value_col].to_numpy(dtype=np.float64))
+
+    @classmethod
+    def from_components(cls, grid, components=None, total_npps=None, cube=None):
+        """
+        Build from a grid with Grid_ID, row, col and Sector columns and the
+        per-cell NPPS components (see aggregate_npps_components_by_grid).
+        total_npps defaults to the components under the config weights.
+        Pass an NppsCube aligned with the grid to allow shift scenarios.
+        """
+        row, col = gu.lattice_indices(grid)
+        if total_npps is None:
+            total_npps = na.npps_from_components(components)
+        arrays = {
+            "Grid_ID": grid["Grid_ID"].to_numpy(),
+            "row": row,
+            "col": col,
+            "Sector": grid["Sector"].to_numpy(),
+            "total_npps": np.asarray(total_npps, dtype=np.float64),
+        }
+        if "span" in grid.columns:
+            arrays["span"] = gu.lattice_spans(grid)
+        component_columns = None
+        if components is not None:
+            component_columns = list(components.columns)
+            arrays["components"] = components.to_numpy(dtype=np.float64)
+        if cube is not None:
+            arrays["cube"] = cube.values
+        return cls(arrays, component_columns)
+
+    @property
+    def cube(self):
+        """The hour-of-week NppsCube, or None if the base was built without one."""
+        return npps_cube.NppsCube(self.arrays["cube"]) if "cube" in self.arrays else None
+
+    def npps(self, npps_weights=None, priority_weights=None, shift=None, mix=None):
+        """
+        Per-cell NPPS under the given weights (the loaded total_npps if none),
+        or of one shift / a mix of shifts read from the cube.
+        """
+        bins = npps_cube.spec_weights(shift, mix)
+        if bins is not None:
+            if npps_weights is not None or priority_weights is not None:
+                raise ValueError("Shift scenarios use the cube's NPPS weights; drop npps_weights/priority_weights")
+            if self.cube is None:
+                raise ValueError("Shift scenarios need the NPPS cube (ScenarioBase.from_components cube)")
+            return self.cube.cell_npps(bins)
+        if npps_weights is None and priority_weights is None:
+            return self.arrays["total_npps"]
+        if self.component_columns is None:
+            raise ValueError("Scenario weights need the scored incidents (ScenarioBase.from_grid npps_data)")
+        components = pd.DataFrame(self.arrays["components"], columns=self.component_columns, copy=False)
+        return na.npps_from_components(components, npps_weights, priority_weights)
+
+    def frame(self, npps=None):
+        """DataFrame for one scenario: shared columns, its own Sector copy."""
+        columns = {name: self.arrays[name] for name in ("Grid_ID", "row", "col", "span") if name in self.arrays}
+        columns["Sector"] = np.array(self.arrays["Sector"])
+        columns["total_npps"] = self.arrays["total_npps"] if npps is None else npps
+        return pd.DataFrame(columns, copy=False)
+
+
+def _int_keys(mapping):
+    # JSON object keys are strings
+    return None if mapping is None else {int(k): v for k, v in mapping.items()}
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Silence the per-move progress logging of the optimizers."""
+    loggers = [logging.getLogger(m.__name__) for m in (so, rb, na)]
+    levels = [lg.level for lg in loggers]
+    for lg in loggers:
+        lg.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        for lg, level in zip(loggers, levels):
+            lg.setLevel(level)
+
+
+def run_scenario(base, spec):
+    """
+    Run one scenario spec against the shared base.
+    spec keys (all optional except as noted):
+        name: label in the results table
+        method: "bulk", "local_search" or "multilevel" (default config.OPTIMIZATION_METHOD)
+        npps_weights, priority_weights: weight overrides
+        shift, mix: balance one shift (a config.SHIFTS name or [start_hour,
+              end_hour]) or a weighted mix such as {"day": 0.5, "night": 0.5};
+              needs a base with the NPPS cube
+        preserve_contiguity: default config.PRESERVE_CONTIGUITY
+        bulk: excess_sectors, deficient_sector, deficient_neighbors and
+              sector_neighbors (default: the live sector graph of the grid)
+        local_search: max_iter, time_limit, seed
+    Returns a dict of balance metrics before/after, cells moved and elapsed
+    seconds; with the NPPS cube also each shift's max/min ratio before/after.
+    """
+    return solve_scenario(base, spec)[0]
+
+
+def solve_scenario(base, spec):
+    """
+    Same as run_scenario, also returning the scenario's final per-cell
+    Sector array. Returns (result, sector).
+    """
+    start = time.perf_counter()
+    method = spec.get("method", config.OPTIMIZATION_METHOD)
+    contiguous = spec.get("preserve_contiguity", config.PRESERVE_CONTIGUITY)
+    npps = base.npps(spec.get("npps_weights"), _int_keys(spec.get("priority_weights")),
+                     spec.get("shift"), spec.get("mix"))
+    grid = base.frame(npps)
+    ledger = SectorLedger.from_grid(grid)
+    before = ledger.to_frame()
+    moved_ids = []
+    with _quiet():
+        if method == "local_search":
+            grid, moved_ids, _ = rb.rebalance_sectors(
+                grid,
+                max_iter=spec.get("max_iter", config.REBALANCE_MAX_ITER),
+                time_limit=spec.get("time_limit", config.REBALANCE_TIME_LIMIT),
+                seed=spec.get("seed", config.REBALANCE_SEED),
+                adjacency=base.adjacency,
+                ledger=ledger,
+                contiguous=contiguous
+            )
+        elif method == "multilevel":
+            grid, moved_ids, _ = rb.multilevel_rebalance(
+                grid,
+                seed=spec.get("seed", config.REBALANCE_SEED),
+                contacts=base.contacts,
+                ledger=ledger,
+                contiguous=contiguous
+            )
+        elif method == "bulk":
+            neighbors = _int_keys(spec.get("sector_neighbors"))
+            graph = SectorGraph.from_grid(grid, base.adjacency, base.contacts)
+            if spec.get("excess_sectors"):
+                grid, ids = so.give_bulk_boundaries_from_excess(
+                    grid, neighbors, spec["excess_sectors"], ledger, contiguous, base.adjacency, graph=graph
+                )
+                moved_ids += ids
+            deficient = spec.get("deficient_sector")
+            if deficient is not None:
+                deficient_neighbors = spec.get("deficient_neighbors")
+                if deficient_neighbors is None and neighbors is not None:
+                    deficient_neighbors = neighbors[deficient]
+                grid, ids = so.take_bulk_boundaries_to_deficient(
+                    grid, deficient, deficient_neighbors, ledger, contiguous, base.adjacency, graph=graph
+                )
+                moved_ids += ids
+        else:
+            raise ValueError(f"Unknown scenario method: {method}")
+    result = {"scenario": spec.get("name"), "method": method}
+    for key, value in na.balance_metrics(before).items():
+        result[f"{key}_before"] = value
+    for key, value in na.balance_metrics(ledger.to_frame()).items():
+        result[f"{key}_after"] = value
+    cube = base.cube
+    if cube is not None:
+        # Shift totals from cumulative hour-of-week sums, without re-aggregating
+        for when, sector in (("before", base.arrays["Sector"]), ("after", grid["Sector"].to_numpy())):
+            for shift, metrics in cube.sector_windows(sector).shift_balance().items():
+                result[f"{shift}_max_min_ratio_{when}"] = metrics["max_min_ratio"]
+    result["cells_moved"] = len(set(moved_ids))
+    result["elapsed"] = time.perf_counter() - start
+    return result, grid["Sector"].to_numpy()
+
+
+def score_scenarios(results):
+    """
+    Add normalized_score columns (1 worst .. 10 best within the batch) for
+    the after-optimization variance, max/min ratio and deviation from mean,
+    and their mean as 'score'.
+    """
+    metrics = {"variance_score": "variance_after", "ratio_score": "max_min_ratio_after",
+               "deviation_score": "max_dev_from_mean(%)_after"}
+    for score_col, metric in metrics.items():
+        worst, best = results[metric].max(), results[metric].min()
+        if worst == best:
+            results[score_col] = 10.0
+        else:
+            results[score_col] = [na.normalized_score(v, worst, best) for v in results[metric]]
+    results["score"] = results[list(metrics)].mean(axis=1).round(2)
+    return results
+
+
+# Scenario base shared with pool workers (memory-mapped .npy files)
+_BASE = None
+
+
+def _attach_base(paths, component_columns):
+    global _BASE
+    arrays = {name: np.load(path, mmap_mode="r") for name, path in paths.items()}
+    _BASE = ScenarioBase(arrays, component_columns)
+
+
+def _scenario_worker(spec):
+    return run_scenario(_BASE, spec)
+
+
+def run_scenarios(base, specs, max_workers=None, score=True):
+    """
+    Run a batch of scenario specs (see run_scenario) against one loaded base.
+    With max_workers > 1 the scenarios run in a process pool; the base
+    arrays are written once to memory-mapped .npy files that every worker
+    opens read-only.
+    Returns a DataFrame with one row per scenario, in spec order.
+    """
+    specs = [dict(spec, name=spec.get("name", f"scenario_{i}")) for i, spec in enumerate(specs)]
+    max_workers = config.SCENARIO_WORKERS if max_workers is None else max_workers
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers > 1 and len(specs) > 1:
+        with tempfile.TemporaryDirectory(prefix="scenarios_") as tmp:
+            paths = {}
+            for name, arr in base.arrays.items():
+                paths[name] = os.path.join(tmp, f"{name}.npy")
+                np.save(paths[name], arr)
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(specs)), initializer=_attach_base,
+                                     initargs=(paths, base.component_columns)) as pool:
+                chunksize = max(1, len(specs) // (4 * max_workers))
+                rows = list(pool.map(_scenario_worker, specs, chunksize=chunksize))
+    else:
+        rows = [run_scenario(base, spec) for spec in specs]
+    results = pd.DataFrame(rows)
+    if score:
+        results = score_scenarios(results)
+    logger.info(f"🧪 Ran {len(results)} scenarios")
+    return results
+
+
+def load_scenario_base(with_cube=False):
+    """
+    Load the grid and scored incidents the same way main.py does, without
+    plotting; with_cube also builds the hour-of-week NPPS cube for shift
+    scenarios.
+    """
+    cache = StageCache() if config.CACHE_ENABLED else None
+    cube = None
+    if cache is not None:
+        beats, beats_key = stage_cache.load_beats(cache)
+        grid, grid_key = stage_cache.build_grid(cache, beats, beats_key)
+        if with_cube:
+            cube = stage_cache.build_npps_cube(cache, grid, grid_key)
+    else:
+        beats = dp.load_shapefile()
+        points = ingest.load_incident_points() if config.GRID_MODE == "quadtree" else None
+        grid = gu.build_grid(beats, points)
+        if with_cube:
+            cube = npps_cube.load_npps_cube(grid)
+    if config.INCIDENT_DATA_DIR is not None:
+        npps_data = ingest.iter_scored_chunks(ingest.incident_paths())
+    else:
+        npps_data = dp.calculate_npps(dp.preprocess_incident_data(dp.load_incident_data()))
+    return ScenarioBase.from_components(grid, na.aggregate_npps_components_by_grid(npps_data, grid), cube=cube)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a batch of what-if rebalancing scenarios.")
+    parser.add_argument("specs", help="JSON file with a list of scenario specs")
+    parser.add_argument("--output", default="scenario_results.csv")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-score", action="store_true")
+    args = parser.parse_args(argv)
+    instrumentation.configure_logging(config.LOG_LEVEL)
+    with open(args.specs) as f:
+        specs = json.load(f)
+    with_cube = config.REPORT_SHIFT_BALANCE or any("shift" in spec or "mix" in spec for spec in specs)
+    results = run_scenarios(load_scenario_base(with_cube), specs, args.workers, score=not args.no_score)
+    results.to_csv(args.output, index=False)
+    logger.info(f"Scenario results saved to {args.output}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+import grid_utils as gu
+
+
+class SectorGraph:
+    """
+    Sector adjacency graph derived from the current grid assignment.
+    Keeps, for every pair of sector positions, the length of their shared
+    boundary (in lattice cell edges) and the number of boundary cells of one
+    sector touching the other. Both are built in one pass over the lattice
+    adjacency and updated in O(cell degree) per moved cell, so transfer
+    routines always read the live neighbor graph.
+    """
+
+    def __init__(self, sectors, assignment, adjacency, contacts, cell_size=1.0):
+        self.sectors = np.asarray(sectors, dtype=np.int64)
+        self.cell_size = cell_size
+        self._position = {int(s): i for i, s in enumerate(self.sectors)}
+        self._adjacency = adjacency
+        self._contacts = contacts
+        self.reset(assignment)
+
+    def reset(self, assignment):
+        """
+        Rebuild from a full assignment (sector positions per cell). Cheaper
+        than move() per cell once a large share of the cells has changed.
+        """
+        self.assignment = np.asarray(assignment, dtype=np.int64).copy()
+        adjacency = self._adjacency
+        contacts = self._contacts
+        n_cells = len(self.assignment)
+        n_sectors = len(self.sectors)
+
+        # neighbor_counts[c, s]: neighbors of cell c in sector position s
+        src, dst = gu.neighbor_pairs(adjacency)
+        self.neighbor_counts = np.bincount(
+            src * n_sectors + self.assignment[dst], minlength=n_cells * n_sectors
+        ).reshape(n_cells, n_sectors).astype(np.int16)
+        cells, nbr_sectors = np.nonzero(self.neighbor_counts)
+        foreign = nbr_sectors != self.assignment[cells]
+        # boundary[a, b]: cells of sector a with a neighbor in sector b
+        self.boundary = np.bincount(
+            self.assignment[cells[foreign]] * n_sectors + nbr_sectors[foreign], minlength=n_sectors ** 2
+        ).reshape(n_sectors, n_sectors)
+        # shared[a, b]: cell edges between sectors a and b (the diagonal counts
+        # internal edges twice, which keeps move() branch-free)
+        src, dst = gu.neighbor_pairs(contacts)
+        self.shared = np.bincount(
+            self.assignment[src] * n_sectors + self.assignment[dst], weights=contacts.data,
+            minlength=n_sectors ** 2
+        ).reshape(n_sectors, n_sectors).astype(np.int64)
+
+    @classmethod
+    def from_grid(cls, grid, adjacency=None, contacts=None, connectivity=8):
+        """
+        Build from a grid with a 'Sector' column. adjacency (see
+        lattice_adjacency) defines boundary cells; contacts (see
+        lattice_contacts) the shared boundary. Lengths are in map units when
+        the grid has geometry, in lattice cell edges otherwise.
+        """
+        if adjacency is None:
+            adjacency = gu.lattice_adjacency(grid, connectivity)
+        if contacts is None:
+            contacts = gu.lattice_contacts(grid)
+        cell_size = 1.0
+        if isinstance(grid, gu.CompactGrid) or ("geometry" in grid.columns and len(grid) > 0):
+            cell_size = gu.lattice_spec(grid).cell_size
+        sector = grid["Sector"].to_numpy()
+        sectors = np.unique(sector)
+        return cls(sectors, np.searchsorted(sectors, sector), adjacency, contacts, cell_size)
+
+    def position(self, sector):
+        """Array position of a sector label."""
+        return self._position[int(sector)]
+
+    def move(self, cell, to_sector):
+        """Record that the cell at grid position cell moved to to_sector."""
+        a = int(self.assignment[cell])
+        b = self.position(to_sector)
+        if a == b:
+            return
+        counts = self.neighbor_counts
+        boundary = self.boundary
+        # The cell's own boundary entries move from a to b
+        for s in np.nonzero(counts[cell])[0]:
+            if s != a:
+                boundary[a, s] -= 1
+            if s != b:
+                boundary[b, s] += 1
+        self.assignment[cell] = b
+        adj = self._adjacency
+        for x in adj.indices[adj.indptr[cell]:adj.indptr[cell + 1]]:
+            sx = self.assignment[x]
+            counts[x, a] -= 1
+            if counts[x, a] == 0 and sx != a:
+                boundary[sx, a] -= 1
+            counts[x, b] += 1
+            if counts[x, b] == 1 and sx != b:
+                boundary[sx, b] += 1
+        con = self._contacts
+        start, end = con.indptr[cell], con.indptr[cell + 1]
+        for x, length in zip(con.indices[start:end], con.data[start:end]):
+            sx = self.assignment[x]
+            self.shared[a, sx] -= length
+            self.shared[sx, a] -= length
+            self.shared[b, sx] += length
+            self.shared[sx, b] += length
+
+    def move_cells(self, cells, to_sector):
+        """Record a batch of cells (grid positions) moving to to_sector."""
+        for cell in np.asarray(cells).tolist():
+            self.move(cell, to_sector)
+
+    def neighbors(self, sector):
+        """Sectors sharing a boundary edge with sector, ascending."""
+        a = self.position(sector)
+        found = np.nonzero(self.shared[a] > 0)[0]
+        return [int(self.sectors[b]) for b in found if b != a]
+
+    def to_dict(self):
+        """{sector: [neighbor sectors]} for every sector."""
+        return {int(s): self.neighbors(s) for s in self.sectors}
+
+    def shared_length(self, sector, other):
+        """Length of the boundary between two sectors."""
+        return self.shared[self.position(sector), self.position(other)] * self.cell_size
+
+    def boundary_cells(self, sector, other):
+        """Number of cells of sector touching other."""
+        return int(self.boundary[self.position(sector), self.position(other)])
+
+    def to_frame(self):
+        """
+        One row per ordered pair of touching sectors.
+        Returns DataFrame: Sector, neighbor_sector, shared_length, boundary_cells
+        """
+        shared = self.shared.copy()
+        np.fill_diagonal(shared, 0)
+        a, b = np.nonzero((shared > 0) | (self.boundary > 0))
+        return pd.DataFrame({
+            "Sector": self.sectors[a],
+            "neighbor_sector": self.sectors[b],
+            "shared_length": shared[a, b] * self.cell_size,
+            "boundary_cells": self.boundary[a, b],
+        })
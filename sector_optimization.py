@@ -1,24 +1,38 @@
+import logging
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import grid_utils as gu
+import instrumentation
+from sector_graph import SectorGraph
+from workload import SectorLedger
 
-def build_boundary_pairs_info(grid: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+logger = logging.getLogger(__name__)
+
+
+def build_boundary_pairs_info(grid: gpd.GeoDataFrame, connectivity: int = 8,
+                              adjacency=None) -> gpd.GeoDataFrame:
     """
     Find all grid cells that are on the boundary between different sectors.
     Returns a GeoDataFrame with columns: Grid_ID, Sector, neighbor_sector, geometry
+    (a plain DataFrame without geometry when grid has no geometry column).
     """
-    boundary_list = []
-    for idx, row in grid.iterrows():
-        from_sector = row["Sector"]
-        neighbors = grid[grid.geometry.touches(row.geometry)]
-        diff_sector_neighbors = neighbors[neighbors["Sector"] != from_sector]
-        for n_idx, n_row in diff_sector_neighbors.iterrows():
-            boundary_list.append({
-                "Grid_ID": row["Grid_ID"],
-                "Sector": from_sector,
-                "neighbor_sector": n_row["Sector"],
-                "geometry": row["geometry"]
-            })
-    boundary_pairs_info = gpd.GeoDataFrame(boundary_list, crs=grid.crs)
+    if adjacency is None:
+        adjacency = gu.lattice_adjacency(grid, connectivity)
+    src, dst = gu.neighbor_pairs(adjacency)
+    sector = grid["Sector"].to_numpy()
+    diff = sector[src] != sector[dst]
+    src, dst = src[diff], dst[diff]
+    columns = {
+        "Grid_ID": grid["Grid_ID"].to_numpy()[src],
+        "Sector": sector[src],
+        "neighbor_sector": sector[dst],
+    }
+    if isinstance(grid, gpd.GeoDataFrame):
+        columns["geometry"] = grid.geometry.to_numpy()[src]
+        boundary_pairs_info = gpd.GeoDataFrame(columns, crs=grid.crs)
+    else:
+        boundary_pairs_info = pd.DataFrame(columns)
     boundary_pairs_info.drop_duplicates(subset=["Grid_ID", "Sector", "neighbor_sector"], inplace=True)
     return boundary_pairs_info
 
@@ -40,13 +54,20 @@ def print_npps_diff(old_sum: pd.DataFrame, new_sum: pd.DataFrame, sector_list: l
     merged = old_sum.merge(new_sum, on="Sector", suffixes=("_old", "_new"))
     merged["npps_diff"] = merged["sector_total_npps_new"] - merged["sector_total_npps_old"]
     filtered = merged[merged["Sector"].isin(sector_list)]
-    print(filtered[["Sector", "sector_total_npps_old", "sector_total_npps_new", "npps_diff"]])
+    logger.info("%s", filtered[["Sector", "sector_total_npps_old", "sector_total_npps_new", "npps_diff"]])
 
 
 def take_boundary_from_neighbor(grid: gpd.GeoDataFrame, boundary_pairs_info: gpd.GeoDataFrame,
-                               from_sector: int, to_sector: int):
+                               from_sector: int, to_sector: int, ledger: SectorLedger = None,
+                               preserve_contiguity: bool = False, rings=None, value_col: str = "total_npps",
+                               graph: SectorGraph = None):
     """
     Move all boundary grids from from_sector to to_sector.
+    If a ledger is given, it is updated with the moved cells' NPPS (value_col);
+    a SectorGraph is updated with the moved cells.
+    With preserve_contiguity, cells are moved one at a time and a cell is
+    skipped when its move would split its current sector or it does not
+    share an edge with to_sector (local lattice check, see grid_utils.can_transfer).
     Returns updated grid and list of moved Grid_IDs.
     """
     target_boundary = boundary_pairs_info[
@@ -54,61 +75,102 @@ def take_boundary_from_neighbor(grid: gpd.GeoDataFrame, boundary_pairs_info: gpd
         (boundary_pairs_info["neighbor_sector"] == to_sector)
     ]
     moved_ids = target_boundary["Grid_ID"].unique()
+    instrumentation.count("transfer_candidates", len(moved_ids))
     if len(moved_ids) == 0:
         return grid, []
-    grid.loc[grid["Grid_ID"].isin(moved_ids), "Sector"] = to_sector
+    mask = grid["Grid_ID"].isin(moved_ids).to_numpy()
+    if preserve_contiguity:
+        if rings is None:
+            rings = gu.lattice_rings(grid)
+        sector = grid["Sector"].to_numpy().tolist()
+        keep = []
+        for pos in np.nonzero(mask)[0]:
+            if sector[pos] != to_sector and gu.can_transfer(rings[pos], sector, pos, to_sector):
+                sector[pos] = to_sector
+                keep.append(pos)
+        mask = np.zeros(len(grid), dtype=bool)
+        mask[keep] = True
+        moved_ids = grid["Grid_ID"].to_numpy()[mask]
+        if len(moved_ids) == 0:
+            return grid, []
+    if ledger is not None:
+        # Cells may already have left from_sector in an earlier transfer
+        ledger.reassign(grid["Sector"].to_numpy()[mask], grid[value_col].to_numpy()[mask], to_sector)
+    if graph is not None:
+        graph.move_cells(np.nonzero(mask)[0], to_sector)
+    grid["Sector"] = np.where(mask, to_sector, grid["Sector"].to_numpy())
+    instrumentation.count("cells_moved", len(moved_ids))
     return grid, moved_ids.tolist()
 
 
-def give_bulk_boundaries_from_excess(grid: gpd.GeoDataFrame, sector_neighbors: dict, excess_sectors: list):
+def give_bulk_boundaries_from_excess(grid: gpd.GeoDataFrame, sector_neighbors: dict, excess_sectors: list,
+                                     ledger: SectorLedger = None, preserve_contiguity: bool = False,
+                                     adjacency=None, value_col: str = "total_npps", graph: SectorGraph = None):
     """
     Excess sectors give all their boundary grids to non-excess neighbors.
+    With sector_neighbors None, neighbors are read from the live SectorGraph
+    (built from the grid unless given; a given graph is kept up to date).
     Returns updated grid and list of all moved grid IDs.
     """
-    boundary_pairs_info = build_boundary_pairs_info(grid)
+    boundary_pairs_info = build_boundary_pairs_info(grid, adjacency=adjacency)
     moved_all = []
-    old_sum = recalc_sector_npps_sum(grid)
+    if ledger is None:
+        ledger = SectorLedger.from_grid(grid, value_col)
+    if graph is None and sector_neighbors is None:
+        graph = SectorGraph.from_grid(grid, adjacency)
+    neighbors = graph.neighbors if sector_neighbors is None else sector_neighbors.__getitem__
+    rings = gu.lattice_rings(grid) if preserve_contiguity else None
     eligible_donors = sorted(
         [s for s in excess_sectors],
-        key=lambda s: len([n for n in sector_neighbors[s] if n not in excess_sectors])
+        key=lambda s: len([n for n in neighbors(s) if n not in excess_sectors])
     )
     for donor in eligible_donors:
-        recipients = [n for n in sector_neighbors[donor] if n not in excess_sectors]
-        print(f"\n🔁 Sector {donor} attempts to give boundary grids to: {recipients}")
+        recipients = [n for n in neighbors(donor) if n not in excess_sectors]
+        logger.info(f"\n🔁 Sector {donor} attempts to give boundary grids to: {recipients}")
         for recipient in recipients:
-            old_local_sum = recalc_sector_npps_sum(grid)
-            grid, moved_ids = take_boundary_from_neighbor(grid, boundary_pairs_info, donor, recipient)
+            old_local_totals = ledger.snapshot()
+            grid, moved_ids = take_boundary_from_neighbor(grid, boundary_pairs_info, donor, recipient, ledger,
+                                                         preserve_contiguity, rings, value_col, graph)
             if len(moved_ids) > 0:
                 moved_all.extend(moved_ids)
-                new_local_sum = recalc_sector_npps_sum(grid)
-                print(f"✅ Moved {len(moved_ids)} grids from Sector {donor} ➝ {recipient}")
-                print_npps_diff(old_local_sum, new_local_sum, [donor, recipient])
-    final_sum = recalc_sector_npps_sum(grid)
-    print("\n📊 Final NPPS (partial):")
-    print(final_sum.sort_values("Sector"))
+                logger.info(f"✅ Moved {len(moved_ids)} grids from Sector {donor} ➝ {recipient}")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("%s", ledger.diff_frame(old_local_totals, [donor, recipient]))
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("\n📊 Final NPPS (partial):\n%s", ledger.to_frame())
     return grid, moved_all
 
 
-def take_bulk_boundaries_to_deficient(grid: gpd.GeoDataFrame, deficient_sector: int, neighbors: list):
+def take_bulk_boundaries_to_deficient(grid: gpd.GeoDataFrame, deficient_sector: int, neighbors: list = None,
+                                      ledger: SectorLedger = None, preserve_contiguity: bool = False,
+                                      adjacency=None, value_col: str = "total_npps", graph: SectorGraph = None):
     """
     Deficient sector pulls boundary grids from its neighbors.
+    With neighbors None, they are read from the live SectorGraph (built from
+    the grid unless given; a given graph is kept up to date).
     Returns updated grid and list of all moved grid IDs.
     """
-    boundary_pairs_info = build_boundary_pairs_info(grid)
+    boundary_pairs_info = build_boundary_pairs_info(grid, adjacency=adjacency)
     moved_all = []
-    old_sum = recalc_sector_npps_sum(grid)
-    print(f"\n🟢 Sector {deficient_sector} attempts to pull grids from neighbors: {neighbors}")
+    if ledger is None:
+        ledger = SectorLedger.from_grid(grid, value_col)
+    if graph is None and neighbors is None:
+        graph = SectorGraph.from_grid(grid, adjacency)
+    if neighbors is None:
+        neighbors = graph.neighbors(deficient_sector)
+    rings = gu.lattice_rings(grid) if preserve_contiguity else None
+    logger.info(f"\n🟢 Sector {deficient_sector} attempts to pull grids from neighbors: {neighbors}")
     for nbr in neighbors:
-        old_local_sum = recalc_sector_npps_sum(grid)
-        grid, moved_ids = take_boundary_from_neighbor(grid, boundary_pairs_info, nbr, deficient_sector)
+        old_local_totals = ledger.snapshot()
+        grid, moved_ids = take_boundary_from_neighbor(grid, boundary_pairs_info, nbr, deficient_sector, ledger,
+                                                     preserve_contiguity, rings, value_col, graph)
         if len(moved_ids) > 0:
             moved_all.extend(moved_ids)
-            new_local_sum = recalc_sector_npps_sum(grid)
-            print(f"✅ Moved {len(moved_ids)} grids from Sector {nbr} ➝ {deficient_sector}")
-            print_npps_diff(old_local_sum, new_local_sum, [nbr, deficient_sector])
+            logger.info(f"✅ Moved {len(moved_ids)} grids from Sector {nbr} ➝ {deficient_sector}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("%s", ledger.diff_frame(old_local_totals, [nbr, deficient_sector]))
         else:
-            print(f"⚠️ No boundary grids moved from Sector {nbr} ➝ {deficient_sector} (already transferred or not adjacent)")
-    final_sum = recalc_sector_npps_sum(grid)
-    print("\n📊 Final NPPS (partial):")
-    print(final_sum.sort_values("Sector"))
-    return grid, moved_all 
\ No newline at end of file
+            logger.info(f"⚠️ No boundary grids moved from Sector {nbr} ➝ {deficient_sector} (already transferred or not adjacent)")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("\n📊 Final NPPS (partial):\n%s", ledger.to_frame())
+    return grid, moved_all
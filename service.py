@@ -0,0 +1,441 @@
+import argparse
+import asyncio
+import io
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import config
+import data_preprocessing as dp
+import export
+import grid_utils as gu
+import ingest
+import instrumentation
+import npps_analysis as na
+import npps_cube
+import scenarios
+import snapping as sn
+import stage_cache
+from sector_graph import SectorGraph
+from stage_cache import StageCache
+from workload import SectorLedger
+
+logger = logging.getLogger(__name__)
+
+# Columns shipped once to the rebalancing workers; Sector and NPPS go with each request
+STATIC_COLUMNS = ("Grid_ID", "row", "col", "span")
+MAX_BODY_BYTES = 256 * 1024 ** 2
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RebalancingService:
+    """
+    Warm rebalancing state kept resident between requests: the grid with
+    per-cell NPPS, the sector ledger and graph, the street index and,
+    when loaded, the hour-of-week NPPS cube with per-sector hourly totals
+    for shift and time-window balance.
+    Appended incident batches are scored with the outlier bounds and
+    response-time scaling of the history loaded at startup, so history is
+    never re-scored; restart the service to refit them. All state changes
+    run on the event loop; scoring runs in a thread and optimization in a
+    process pool, so balance queries stay fast while those are busy.
+    """
+
+    def __init__(self, grid, bounds, scaler, streets=None, max_workers=None, cube=None):
+        self.grid = grid
+        # Writable copy (cached columns are read-only memory maps), added to in place as incidents arrive
+        self.total_npps = np.array(grid["total_npps"].to_numpy(), dtype=np.float64)
+        self.grid["total_npps"] = self.total_npps
+        self.bounds = bounds
+        self.scaler = scaler
+        self.locator = gu.CellLocator(grid)
+        self.ledger = SectorLedger.from_grid(grid)
+        self.graph = SectorGraph.from_grid(grid)
+        self.cube = None
+        if cube is not None:
+            self.cube = npps_cube.NppsCube(np.array(cube.values))  # updated in place as incidents arrive
+            # sector x hour-of-week NPPS, in ledger sector order
+            _, self.sector_hours = self.cube.sector_hours(grid["Sector"].to_numpy(), self.ledger.sectors)
+        self.snapper = None
+        if streets is not None:
+            self.snapper = sn.StreetSnapper(streets, crs=grid.crs, tolerance=config.SNAP_TOLERANCE)
+        self.n_incidents = 0
+        self.version = 0  # bumped on every state change
+        self.assignment_version = 0  # bumped when cells change sector
+        self.max_workers = config.SERVICE_WORKERS if max_workers is None else max_workers
+        self._pool = None
+        self._tmp = None
+        self._snap_lock = asyncio.Lock()
+        self.routes = {
+            ("GET", "/health"): self.health,
+            ("GET", "/balance"): self.balance,
+            ("POST", "/balance"): self.window_balance,
+            ("GET", "/sectors"): self.sectors,
+            ("POST", "/incidents"): self.incidents,
+            ("POST", "/rebalance"): self.rebalance,
+            ("POST", "/snap"): self.snap,
+            ("POST", "/snapshot"): self.snapshot,
+        }
+
+    @classmethod
+    def load(cls, max_workers=None):
+        """Load the grid, NPPS and streets the same way main.py does (through the stage cache if enabled)."""
+        paths = ingest.incident_paths()
+        bounds, scaler, _ = ingest.scan_response_times(paths)
+        cache = StageCache() if config.CACHE_ENABLED else None
+        cube = None
+        if cache is not None:
+            beats, beats_key = stage_cache.load_beats(cache)
+            grid, grid_key = stage_cache.build_grid(cache, beats, beats_key)
+            grid = stage_cache.aggregate_npps(cache, grid, grid_key)
+            streets = stage_cache.load_streets(cache)
+            if config.REPORT_SHIFT_BALANCE:
+                cube = stage_cache.build_npps_cube(cache, grid, grid_key)
+        else:
+            beats = dp.load_shapefile()
+            points = ingest.load_incident_points(paths) if config.GRID_MODE == "quadtree" else None
+            grid = gu.build_grid(beats, points)
+            chunks = (dp.calculate_npps(chunk, bounds, scaler) for chunk in ingest.iter_incident_chunks(paths))
+            grid = na.aggregate_npps_by_grid(chunks, grid)
+            streets = gpd.read_file(config.CENTERLINES_PATH)
+            if config.REPORT_SHIFT_BALANCE:
+                cube = npps_cube.load_npps_cube(grid)
+        return cls(grid, bounds, scaler, streets, max_workers, cube)
+
+    # State updates (event loop only)
+
+    def score(self, incidents):
+        """Score a batch of raw incident rows with the startup bounds and scaling."""
+        missing = [c for c in dp.INCIDENT_COLUMNS if c not in incidents.columns]
+        if missing:
+            raise HttpError(400, f"Incidents are missing columns: {missing}")
+        incidents = dp.preprocess_incident_data(incidents)
+        for column, dtype in ingest.INCIDENT_DTYPES.items():
+            if dtype == "float64":
+                incidents[column] = pd.to_numeric(incidents[column], errors="coerce")
+        return dp.calculate_npps(incidents, self.bounds, self.scaler)
+
+    def add_scored(self, scored):
+        """
+        Add scored incidents to the per-cell NPPS and the sector ledger.
+        Cost is one pass over the batch plus the touched cells.
+        Returns the number of incidents binned into a cell.
+        """
+        with instrumentation.collect_counters() as counters:
+            positions, npps = na.locate_npps(scored, self.locator)
+        cells, batch_cell = np.unique(positions, return_inverse=True)
+        cell_npps = np.bincount(batch_cell, weights=npps, minlength=len(cells))
+        self.total_npps[cells] += cell_npps
+        self.ledger.add(self.grid["Sector"].to_numpy()[cells], cell_npps)
+        if self.cube is not None and config.TIMESTAMP_COLUMN in scored.columns:
+            positions, bins, npps = npps_cube.locate_incidents(scored, self.locator)
+            np.add.at(self.cube.values, (positions, bins), npps)
+            sector = self.ledger.positions(self.grid["Sector"].to_numpy()[positions])
+            np.add.at(self.sector_hours, (sector, bins), npps)
+        self.n_incidents += len(scored)
+        self.version += 1
+        return counters.get("incidents_binned", 0)
+
+    def apply_assignment(self, sector):
+        """Move every cell whose sector differs in the new assignment. Returns cells changed."""
+        sector = np.asarray(sector)
+        current = self.grid["Sector"].to_numpy()
+        npps = self.grid["total_npps"].to_numpy()
+        changed = np.flatnonzero(sector != current)
+        for to_sector in np.unique(sector[changed]):
+            cells = changed[sector[changed] == to_sector]
+            self.ledger.reassign(current[cells], npps[cells], to_sector)
+            self.graph.move_cells(cells, to_sector)
+            if self.cube is not None:
+                hours = self.cube.values[cells]
+                np.subtract.at(self.sector_hours, self.ledger.positions(current[cells]), hours)
+                self.sector_hours[self.ledger.position(to_sector)] += hours.sum(axis=0)
+        self.grid["Sector"] = sector
+        if len(changed):
+            self.assignment_version += 1
+            self.version += 1
+        return len(changed)
+
+    # Request handlers
+
+    async def health(self, body):
+        return {"status": "ok", "cells": len(self.grid), "incidents_added": self.n_incidents,
+                "version": self.version}
+
+    async def balance(self, body):
+        """
+        Balance metrics and per-sector NPPS from the ledger, O(sectors); with
+        the NPPS cube also each config.SHIFTS shift's balance, O(sectors x hours).
+        """
+        result = {"version": self.version, **na.balance_metrics(self.ledger.to_frame()),
+                  "sector_total_npps": dict(zip(self.ledger.sectors.tolist(), self.ledger.totals.tolist()))}
+        if self.cube is not None:
+            result["shifts"] = self.windows().shift_balance()
+        return result
+
+    async def window_balance(self, body):
+        """
+        Balance of one time window: {"shift": name or [start_hour, end_hour],
+        "days": [0-6, ...]} or {"window": [start_bin, end_bin]} in hour-of-week
+        bins (Monday 00:00 = 0).
+        """
+        if self.cube is None:
+            raise HttpError(404, "No NPPS cube loaded (set REPORT_SHIFT_BALANCE)")
+        body = body or {}
+        windows = self.windows()
+        if "window" in body:
+            start_bin, end_bin = body["window"]
+            totals = windows.window(int(start_bin), int(end_bin))
+        elif "shift" in body:
+            shift = body["shift"] if isinstance(body["shift"], str) else tuple(body["shift"])
+            totals = windows.shift(shift, body.get("days"))
+        else:
+            raise HttpError(400, 'Give a "shift" or a "window"')
+        return {"version": self.version, **windows.balance(totals)}
+
+    def windows(self):
+        """SectorWindows of the current sector x hour-of-week totals."""
+        return npps_cube.SectorWindows(self.ledger.sectors, self.sector_hours)
+
+    async def sectors(self, body):
+        return {int(s): {"total_npps": float(self.ledger.totals[i]), "cells": int(self.ledger.counts[i]),
+                         "neighbors": self.graph.neighbors(s)}
+                for i, s in enumerate(self.ledger.sectors)}
+
+    async def incidents(self, body):
+        """Append a batch: a JSON list of incident records (or {"incidents": [...]}) or CSV text."""
+        if isinstance(body, (bytes, str)):
+            incidents = pd.read_csv(io.BytesIO(body if isinstance(body, bytes) else body.encode()))
+        else:
+            incidents = pd.DataFrame.from_records(body["incidents"] if isinstance(body, dict) else body)
+        loop = asyncio.get_running_loop()
+        scored = await loop.run_in_executor(None, self.score, incidents)
+        binned = self.add_scored(scored)
+        logger.info(f"📥 Added {len(scored)} incidents ({binned} in the grid)")
+        return {"added": len(scored), "binned": binned, "version": self.version,
+                **na.balance_metrics(self.ledger.to_frame())}
+
+    async def rebalance(self, body):
+        """
+        Run a scenario spec (see scenarios.run_scenario) on the current
+        assignment and NPPS in the worker pool. With "apply": true the result
+        is adopted, unless the assignment changed while it was running.
+        """
+        spec = dict(body or {})
+        apply = bool(spec.pop("apply", False))
+        assignment_version = self.assignment_version
+        sector = self.grid["Sector"].to_numpy()
+        npps = self.grid["total_npps"].to_numpy().copy()  # pickled for the worker after this handler yields
+        bins = npps_cube.spec_weights(spec.pop("shift", None), spec.pop("mix", None))
+        if bins is not None:
+            # Shifts are resolved here, against the live cube, and sent to the worker as plain NPPS
+            if self.cube is None:
+                raise HttpError(404, "No NPPS cube loaded (set REPORT_SHIFT_BALANCE)")
+            npps = self.cube.cell_npps(bins)
+        loop = asyncio.get_running_loop()
+        result, new_sector = await loop.run_in_executor(self._worker_pool(), _rebalance_worker, sector, npps, spec)
+        result["applied"] = False
+        if apply:
+            if self.assignment_version != assignment_version:
+                raise HttpError(409, "The sector assignment changed while rebalancing; retry")
+            result["cells_changed"] = self.apply_assignment(new_sector)
+            result["applied"] = True
+            logger.info(f"🔁 Applied rebalancing: {result['cells_changed']} cells changed sector")
+        return result
+
+    def frozen_grid(self):
+        """
+        Copy of the grid and the version it reflects, for work run off the
+        event loop (total_npps is updated in place as incidents arrive).
+        """
+        columns = {name: self.grid[name].to_numpy().copy() for name in self.grid.columns}
+        return gu.CompactGrid(self.grid.lattice, columns), self.version
+
+    async def snap(self, body):
+        """
+        Snap the current sectors to the resident street index; returns GeoJSON
+        (with the state version snapped) and writes SNAPPED_SECTORS_PATH.
+        """
+        if self.snapper is None:
+            raise HttpError(404, "No street centerlines loaded")
+        grid, version = self.frozen_grid()
+        output_dir, file_name = os.path.split(config.SNAPPED_SECTORS_PATH)
+        loop = asyncio.get_running_loop()
+        async with self._snap_lock:
+            snapped = await loop.run_in_executor(
+                None, lambda: sn.smooth_sectors(grid, None, output_dir, 1, file_name, snapper=self.snapper))
+        return {**json.loads(snapped.to_json()), "version": version}
+
+    async def snapshot(self, body):
+        """Write the current grid to FINAL_LATTICE_PATH (see export.save_lattice)."""
+        if config.FINAL_LATTICE_PATH is None:
+            raise HttpError(404, "FINAL_LATTICE_PATH is not set")
+        grid, version = self.frozen_grid()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, export.save_lattice, grid, config.FINAL_LATTICE_PATH)
+        return {"path": config.FINAL_LATTICE_PATH, "version": version}
+
+    # Worker pool
+
+    def _worker_pool(self):
+        """
+        Start the rebalancing pool on first use. The static cell arrays are
+        written once to memory-mapped .npy files that every worker opens;
+        workers are spawned, not forked from the threaded event loop.
+        """
+        if self._pool is None:
+            self._tmp = tempfile.mkdtemp(prefix="service_")
+            paths = {}
+            for name in STATIC_COLUMNS + ("Sector", "total_npps"):
+                if name in self.grid.columns:
+                    paths[name] = os.path.join(self._tmp, f"{name}.npy")
+                    np.save(paths[name], self.grid[name].to_numpy())
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_attach_worker, initargs=(paths,))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+        if self._tmp is not None:
+            shutil.rmtree(self._tmp, ignore_errors=True)
+            self._tmp = None
+
+    # HTTP
+
+    async def handle(self, reader, writer):
+        """Serve one HTTP/1.1 request with a JSON response, then close the connection."""
+        start = time.perf_counter()
+        method, path = "-", "-"
+        try:
+            method, path, headers, body = await _read_request(reader)
+            handler = self.routes.get((method, path))
+            if handler is None:
+                known = any(route_path == path for _, route_path in self.routes)
+                raise HttpError(405 if known else 404, f"No route for {method} {path}")
+            if body and not headers.get("content-type", "").startswith("text/csv"):
+                body = json.loads(body)
+            status, payload = 200, await handler(body)
+        except HttpError as e:
+            status, payload = e.status, {"error": str(e)}
+        except (ValueError, KeyError, TypeError) as e:
+            status, payload = 400, {"error": f"{type(e).__name__}: {e}"}
+        except Exception as e:
+            logger.exception(f"❌ {method} {path} failed")
+            status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+        writer.write(_response(status, payload))
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+        logger.debug(f"{method} {path} {status} {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    async def serve(self, host=None, port=None, socket_path=None):
+        """Serve until cancelled, on a Unix socket when socket_path is given, else TCP host:port."""
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle, path=socket_path)
+            where = socket_path
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            where = ", ".join(str(s.getsockname()) for s in server.sockets)
+        logger.info(f"🚓 Rebalancing service listening on {where}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+async def _read_request(reader):
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    if not request_line:
+        raise HttpError(400, "Empty request")
+    try:
+        method, target, _ = request_line.split(" ", 2)
+    except ValueError:
+        raise HttpError(400, f"Malformed request line: {request_line!r}")
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1")
+        if line in ("\r\n", "\n", ""):
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, f"Request body over {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else None
+    return method.upper(), urlsplit(target).path.rstrip("/") or "/", headers, body
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+def _response(status, payload):
+    body = json.dumps(payload, default=_json_default).encode()
+    head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n")
+    return head.encode("latin-1") + body
+
+
+# Scenario base of a pool worker: static arrays memory-mapped, adjacency built once
+_BASE = None
+
+
+def _attach_worker(paths):
+    global _BASE
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the service shuts the pool down on Ctrl-C
+    arrays = {name: np.load(path, mmap_mode="r") for name, path in paths.items()}
+    _BASE = scenarios.ScenarioBase(arrays)
+
+
+def _rebalance_worker(sector, npps, spec):
+    _BASE.arrays["Sector"] = sector
+    _BASE.arrays["total_npps"] = npps
+    return scenarios.solve_scenario(_BASE, spec)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve balance and rebalancing queries from warm state.")
+    parser.add_argument("--host", default=config.SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVICE_PORT)
+    parser.add_argument("--socket", default=config.SERVICE_SOCKET, help="Unix socket path (overrides host/port)")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+    instrumentation.configure_logging(config.LOG_LEVEL)
+    service = RebalancingService.load(args.workers)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,85 +1,283 @@
+import logging
 import geopandas as gpd
+import multiprocessing
+import numpy as np
 import os
-from shapely.geometry import Point, Polygon, MultiPolygon
-from shapely.ops import unary_union
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from pyproj import Transformer
+from shapely import STRtree
+from shapely.geometry import Polygon, MultiPolygon
 import config
+import export
+import grid_utils as gu
+import instrumentation
 
+logger = logging.getLogger(__name__)
 
-def find_nearest_point_on_lines(point, lines, max_distance=50):
+
+class StreetSnapper:
     """
-    Find the nearest point on any line within max_distance meters.
-    Returns None if no line is within max_distance.
+    Snap polygon vertices to street centerlines.
+    Streets are projected once to a metric CRS (config.SNAP_CRS, or the
+    local UTM zone) and indexed in an STRtree, so tolerance is in meters and
+    each geometry is snapped with a single bulk nearest query.
     """
-    min_dist = float('inf')
-    nearest_point = None
-    for line in lines:
-        if line.distance(point) <= max_distance:
-            p = line.interpolate(line.project(point))
-            dist = point.distance(p)
-            if dist < min_dist:
-                min_dist = dist
-                nearest_point = p
-    return nearest_point if min_dist <= max_distance else None
-
-
-def snap_polygon_to_streets(polygon, street_lines, tolerance=50):
+
+    def __init__(self, streets, crs=None, tolerance=None, metric_crs=None):
+        self.crs = streets.crs if crs is None else crs
+        self.tolerance = config.SNAP_TOLERANCE if tolerance is None else tolerance
+        if metric_crs is None:
+            metric_crs = config.SNAP_CRS if config.SNAP_CRS is not None else streets.estimate_utm_crs()
+        self.metric_crs = metric_crs
+        self.lines = streets.to_crs(self.metric_crs).geometry.to_numpy()
+        self._build_index()
+
+    def _build_index(self):
+        self.tree = STRtree(self.lines)
+        self._to_metric = Transformer.from_crs(self.crs, self.metric_crs, always_xy=True)
+        self._from_metric = Transformer.from_crs(self.metric_crs, self.crs, always_xy=True)
+
+    def __getstate__(self):
+        # Ship projected lines as WKB; the index is rebuilt on unpickling
+        return {"crs": self.crs, "metric_crs": self.metric_crs, "tolerance": self.tolerance,
+                "lines": shapely.to_wkb(self.lines)}
+
+    def __setstate__(self, state):
+        self.crs = state["crs"]
+        self.metric_crs = state["metric_crs"]
+        self.tolerance = state["tolerance"]
+        self.lines = shapely.from_wkb(state["lines"])
+        self._build_index()
+
+    def snap_coords(self, coords):
+        """
+        Move each (x, y) coordinate to the nearest point on the nearest street
+        within tolerance; coordinates with no street in range are unchanged.
+        """
+        coords = np.array(coords, dtype=np.float64)
+        if len(coords) == 0:
+            return coords
+        mx, my = self._to_metric.transform(coords[:, 0], coords[:, 1])
+        points = shapely.points(mx, my)
+        input_idx, line_idx = self.tree.query_nearest(points, max_distance=self.tolerance, all_matches=False)
+        instrumentation.count("spatial_queries", len(points))
+        instrumentation.count("vertices_snapped", len(input_idx))
+        if len(input_idx) == 0:
+            return coords
+        lines = self.lines[line_idx]
+        snapped = shapely.line_interpolate_point(lines, shapely.line_locate_point(lines, points[input_idx]))
+        sx, sy = self._from_metric.transform(shapely.get_x(snapped), shapely.get_y(snapped))
+        coords[input_idx, 0] = sx
+        coords[input_idx, 1] = sy
+        return coords
+
+    def snap_polygons(self, polygons):
+        """Snap the exterior vertices of several polygons in one bulk query."""
+        rings = [np.asarray(poly.exterior.coords)[:-1] for poly in polygons]
+        snapped = self.snap_coords(np.concatenate(rings)) if rings else np.empty((0, 2))
+        result = []
+        start = 0
+        for ring in rings:
+            part = snapped[start:start + len(ring)]
+            start += len(ring)
+            result.append(Polygon(np.vstack([part, part[:1]])))
+        return result
+
+    def snap(self, geom):
+        """Snap a Polygon or MultiPolygon."""
+        if isinstance(geom, Polygon):
+            return self.snap_polygons([geom])[0]
+        elif isinstance(geom, MultiPolygon):
+            return MultiPolygon(self.snap_polygons(list(geom.geoms)))
+        else:
+            raise ValueError(f"Unsupported geometry type: {type(geom)}")
+
+
+def snap_to_streets(geom, streets, tolerance=50):
     """
-    Snap a single polygon's vertices to nearest street segments.
+    Snap polygon vertices to nearest street segments within tolerance (meters).
+    Handles both Polygon and MultiPolygon geometries. streets may be a
+    GeoDataFrame or a prebuilt StreetSnapper (reuse one for many geometries).
     """
-    coords = list(polygon.exterior.coords)
-    new_coords = []
-    for i, coord in enumerate(coords[:-1]):  # Skip last point (same as first)
-        point = Point(coord)
-        snapped = find_nearest_point_on_lines(point, street_lines, tolerance)
-        if snapped:
-            new_coords.append((snapped.x, snapped.y))
+    if not isinstance(streets, StreetSnapper):
+        streets = StreetSnapper(streets, tolerance=tolerance)
+    return streets.snap(geom)
+
+
+# Boundary edges of a cell mask, oriented with the sector on the left.
+# Direction codes: 0 east, 1 north, 2 west, 3 south.
+def _boundary_edges(mask):
+    padded = np.pad(mask, 1)
+    inner = padded[1:-1, 1:-1]
+    edges = []
+    # (neighbor that must be empty, start corner, end corner, direction)
+    for empty, start, end, direction in (
+        (padded[:-2, 1:-1], (0, 0), (0, 1), 0),   # bottom edge
+        (padded[1:-1, 2:], (0, 1), (1, 1), 1),    # right edge
+        (padded[2:, 1:-1], (1, 1), (1, 0), 2),    # top edge
+        (padded[1:-1, :-2], (1, 0), (0, 0), 3),   # left edge
+    ):
+        rows, cols = np.nonzero(inner & ~empty)
+        edges.append((rows + start[0], cols + start[1], rows + end[0], cols + end[1],
+                      np.full(len(rows), direction)))
+    return [np.concatenate(part) for part in zip(*edges)]
+
+
+def _split_loops(ring):
+    """Split a closed vertex sequence at repeated vertices into simple loops."""
+    loops, stack, seen = [], [], {}
+    for key in ring:
+        if key in seen:
+            start = seen[key]
+            loops.append(stack[start:])
+            for k in stack[start + 1:]:
+                del seen[k]
+            del stack[start + 1:]
         else:
-            new_coords.append(coord)
-    new_coords.append(new_coords[0])  # Close the polygon
-    return Polygon(new_coords)
+            seen[key] = len(stack)
+            stack.append(key)
+    loops.append(stack)
+    return loops
 
 
-def snap_to_streets(geom, streets, tolerance=50):
+def trace_outline(mask, x_edges, y_edges):
     """
-    Snap polygon vertices to nearest street segments within tolerance distance.
-    Handles both Polygon and MultiPolygon geometries.
+    Build a sector outline from its lattice cells by tracing the raster
+    boundary instead of unioning cell boxes.
+    mask is a (rows, cols) boolean cell raster and x_edges/y_edges its cell
+    edge coordinates. Every cell corner on the boundary is kept as a vertex,
+    as unary_union does. At corner-only contacts the trace turns left and
+    rings are split where they touch themselves, so the result is valid and
+    equal to unary_union of the cell boxes.
+    Returns a Polygon or MultiPolygon.
     """
-    street_lines = [geom for geom in streets.geometry]
-    if isinstance(geom, Polygon):
-        return snap_polygon_to_streets(geom, street_lines, tolerance)
-    elif isinstance(geom, MultiPolygon):
-        snapped_polys = []
-        for poly in geom.geoms:
-            snapped_poly = snap_polygon_to_streets(poly, street_lines, tolerance)
-            snapped_polys.append(snapped_poly)
-        return MultiPolygon(snapped_polys)
-    else:
-        raise ValueError(f"Unsupported geometry type: {type(geom)}")
+    r0, c0, r1, c1, direction = _boundary_edges(mask)
+    width = mask.shape[1] + 1
+    start_key = (r0 * width + c0).tolist()
+    end_key = (r1 * width + c1).tolist()
+    direction = direction.tolist()
+    outgoing = {}
+    for edge, key in enumerate(start_key):
+        outgoing.setdefault(key, []).append(edge)
+
+    rings = []
+    remaining = set(range(len(start_key)))
+    while remaining:
+        first = remaining.pop()
+        ring = [start_key[first]]
+        edge = first
+        while True:
+            options = outgoing[end_key[edge]]
+            if len(options) == 1:
+                nxt = options[0]
+            else:
+                left = (direction[edge] + 1) % 4
+                nxt = next(e for e in options if direction[e] == left)
+            if nxt == first:
+                break
+            remaining.discard(nxt)
+            ring.append(start_key[nxt])
+            edge = nxt
+        for loop in _split_loops(ring):
+            keys = np.asarray(loop + loop[:1])
+            rings.append(np.column_stack([x_edges[keys % width], y_edges[keys // width]]))
+
+    shells, holes = [], []
+    for ring in rings:
+        (shells if shapely.is_ccw(shapely.linearrings(ring)) else holes).append(ring)
+    shell_polys = [Polygon(shell) for shell in shells]
+    hole_lists = [[] for _ in shells]
+    for hole in holes:
+        # Innermost shell covering the hole (islands inside holes are shells too)
+        hole_poly = Polygon(hole)
+        owners = [i for i, shell in enumerate(shell_polys) if shell.covers(hole_poly)]
+        hole_lists[min(owners, key=lambda i: shell_polys[i].area)].append(hole)
+    polygons = [Polygon(shell, hole_list) for shell, hole_list in zip(shells, hole_lists)]
+    return polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
+
+
+def _sector_masks(grid):
+    """Yield (sector, cropped cell mask, x_edges, y_edges) per sector in order."""
+    row, col = gu.lattice_indices(grid)
+    span = gu.lattice_spans(grid)
+    x_edges, y_edges = gu.lattice_edges(grid)
+    sector = grid["Sector"].to_numpy()
+    for s in np.unique(sector):
+        sel = sector == s
+        r, c, w = row[sel], col[sel], span[sel]
+        rmin, cmin, rmax, cmax = r.min(), c.min(), (r + w).max(), (c + w).max()
+        mask = np.zeros((rmax - rmin, cmax - cmin), dtype=bool)
+        gu.paint_cells(mask, r - rmin, c - cmin, w, True)
+        yield s, mask, x_edges[cmin:cmax + 1], y_edges[rmin:rmax + 1]
+
+
+# Street index used by snapping workers (inherited on fork, pickled once per worker otherwise)
+_WORKER_SNAPPER = None
 
 
-def smooth_sectors(grid, streets, output_dir="output"):
+def _init_snap_worker(snapper):
+    global _WORKER_SNAPPER
+    if snapper is not None:
+        _WORKER_SNAPPER = snapper
+
+
+def _snap_sector(sector, mask, x_edges, y_edges):
+    return sector, _WORKER_SNAPPER.snap(trace_outline(mask, x_edges, y_edges))
+
+
+def _pooled_snap_sector(*task):
+    # Ship the worker's counters back to the parent's run report
+    with instrumentation.collect_counters() as counters:
+        result = _snap_sector(*task)
+    return result, counters
+
+
+def smooth_sectors(grid, streets, output_dir=None, max_workers=None, file_name=None, snapper=None):
     """
-    Smooth sector boundaries by snapping to nearby streets and export as shapefile.
+    Smooth sector boundaries by snapping to nearby streets and export them.
+    Sector outlines are traced from the lattice; with max_workers > 1 the
+    sectors are traced and snapped in a process pool sharing one street index.
     Args:
         grid: GeoDataFrame containing the grid-based sectors
         streets: GeoDataFrame containing street centerlines
-        output_dir: Directory to save output files
+        output_dir: Directory to save output files (default: that of config.SNAPPED_SECTORS_PATH)
+        max_workers: Worker processes (default config.SNAP_WORKERS; 1 runs in-process)
+        file_name: Output file; the extension picks the format (see export.write_frame)
+            (default: that of config.SNAPPED_SECTORS_PATH)
+        snapper: Prebuilt StreetSnapper to reuse (streets is then ignored)
     """
-    if not os.path.exists(output_dir):
+    global _WORKER_SNAPPER
+    default_dir, default_name = os.path.split(config.SNAPPED_SECTORS_PATH)
+    output_dir = default_dir if output_dir is None else output_dir
+    file_name = default_name if file_name is None else file_name
+    if output_dir and not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    streets = streets.to_crs(grid.crs)
-    sectors = []
-    for sector in sorted(grid["Sector"].unique()):
-        print(f"Processing Sector {sector}...")
-        sector_grids = grid[grid["Sector"] == sector]
-        sector_polygon = unary_union(sector_grids.geometry)
-        snapped_polygon = snap_to_streets(sector_polygon, streets, config.SNAP_TOLERANCE)
-        sectors.append({
-            "Sector": sector,
-            "geometry": snapped_polygon
-        })
+    max_workers = config.SNAP_WORKERS if max_workers is None else max_workers
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if snapper is None:
+        snapper = StreetSnapper(streets, crs=grid.crs, tolerance=config.SNAP_TOLERANCE)
+    _WORKER_SNAPPER = snapper
+    tasks = list(_sector_masks(grid))
+    if max_workers > 1 and len(tasks) > 1:
+        inherit = multiprocessing.get_start_method() == "fork"
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks)), initializer=_init_snap_worker,
+                                 initargs=(None if inherit else _WORKER_SNAPPER,)) as pool:
+            futures = [pool.submit(_pooled_snap_sector, *task) for task in tasks]
+            results = []
+            for future in futures:
+                result, counters = future.result()
+                instrumentation.current_report().merge_counters(counters)
+                results.append(result)
+    else:
+        results = []
+        for task in tasks:
+            logger.info(f"Processing Sector {task[0]}...")
+            results.append(_snap_sector(*task))
+    sectors = [{"Sector": sector, "geometry": geom} for sector, geom in results]
     snapped_sectors = gpd.GeoDataFrame(sectors, crs=grid.crs)
-    output_file = os.path.join(output_dir, "snapped_sectors.shp")
-    snapped_sectors.to_file(output_file)
-    print(f"Snapped sectors saved to {output_file}")
-    return snapped_sectors 
\ No newline at end of file
+    output_file = os.path.join(output_dir, file_name)
+    export.write_frame(snapped_sectors, output_file)
+    logger.info(f"Snapped sectors saved to {output_file}")
+    return snapped_sectors
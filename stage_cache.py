@@ -0,0 +1,326 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import CRS
+import config
+import data_preprocessing as dp
+import grid_utils as gu
+import ingest
+import npps_analysis as na
+import npps_cube
+import road_network as rn
+
+SHAPEFILE_SIDECARS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+
+class StageCache:
+    """
+    Content-addressed cache for pipeline stage outputs.
+    Each entry is a directory '<stage>-<key>' holding .npy arrays (loaded
+    memory-mapped, read-only) and a meta.json. Keys hash the input file
+    contents and the config values a stage depends on. Entries are evicted
+    least recently used first once the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = config.CACHE_DIR if root is None else root
+        self.max_bytes = config.CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        os.makedirs(self.root, exist_ok=True)
+        self._hash_index_path = os.path.join(self.root, "file_hashes.json")
+        if os.path.exists(self._hash_index_path):
+            with open(self._hash_index_path) as f:
+                self._hash_index = json.load(f)
+        else:
+            self._hash_index = {}
+
+    def file_hash(self, path):
+        """
+        SHA-256 of a file's contents. Hashes are remembered per
+        (path, size, mtime) so unchanged files are not re-read on warm runs.
+        """
+        stat = os.stat(path)
+        stamp = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        if stamp not in self._hash_index:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            self._hash_index[stamp] = digest.hexdigest()
+            with open(self._hash_index_path, "w") as f:
+                json.dump(self._hash_index, f)
+        return self._hash_index[stamp]
+
+    def key(self, *parts):
+        """Hash JSON-serializable key parts into a short hex key."""
+        payload = json.dumps(parts, sort_keys=True, default=str).encode()
+        return hashlib.sha256(payload).hexdigest()[:24]
+
+    def _entry(self, stage, key):
+        return os.path.join(self.root, f"{stage}-{key}")
+
+    def load(self, stage, key):
+        """Return (arrays, meta) for a cached entry, or None on a miss."""
+        entry = self._entry(stage, key)
+        meta_path = os.path.join(entry, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(entry, f"{name}.npy"), mmap_mode="r")
+                  for name in meta["arrays"]}
+        os.utime(meta_path)  # LRU bookkeeping
+        return arrays, meta["meta"]
+
+    def store(self, stage, key, arrays, meta):
+        """Write an entry atomically, then evict old entries over max_bytes."""
+        entry = self._entry(stage, key)
+        tmp = f"{entry}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(arr))
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"stage": stage, "arrays": list(arrays), "meta": meta, "created": time.time()}, f)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            meta_path = os.path.join(path, "meta.json")
+            if os.path.isdir(path) and os.path.exists(meta_path):
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(meta_path), size, path))
+        return sorted(entries)
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        self._prune_hash_index()
+
+    def _prune_hash_index(self):
+        """Drop remembered hashes of files that were deleted or have changed since."""
+        stale = []
+        for stamp in self._hash_index:
+            path, size, mtime = stamp.rsplit("|", 2)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append(stamp)
+                continue
+            if f"{stat.st_size}|{stat.st_mtime_ns}" != f"{size}|{mtime}":
+                stale.append(stamp)
+        if stale:
+            for stamp in stale:
+                del self._hash_index[stamp]
+            with open(self._hash_index_path, "w") as f:
+                json.dump(self._hash_index, f)
+
+    def invalidate(self, stage=None):
+        """Remove all entries, or only those of one stage."""
+        for _, _, path in self._entries():
+            if stage is None or os.path.basename(path).startswith(f"{stage}-"):
+                shutil.rmtree(path, ignore_errors=True)
+        if stage is None:
+            self._hash_index = {}
+            if os.path.exists(self._hash_index_path):
+                os.remove(self._hash_index_path)
+
+
+def _shapefile_parts(path):
+    stem = os.path.splitext(path)[0]
+    return [stem + ext for ext in SHAPEFILE_SIDECARS if os.path.exists(stem + ext)]
+
+
+def _geometry_arrays(geoms):
+    """Pack geometries as one WKB byte buffer plus offsets (no pickling)."""
+    wkb = shapely.to_wkb(np.asarray(geoms))
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in wkb])
+    return {"wkb": np.frombuffer(b"".join(wkb), dtype=np.uint8), "wkb_offsets": offsets}
+
+
+def _geometry_from_arrays(arrays):
+    buffer = arrays["wkb"].tobytes()
+    offsets = arrays["wkb_offsets"]
+    return shapely.from_wkb([buffer[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)])
+
+
+def _crs_meta(crs):
+    return None if crs is None else CRS.from_user_input(crs).to_wkt()
+
+
+def _grid_arrays(grid, columns):
+    return {col: grid[col].to_numpy() for col in columns}
+
+
+def _grid_from_arrays(arrays, meta, columns):
+    lattice = gu.LatticeGrid(meta["minx"], meta["miny"], meta["cell_size"],
+                             meta["n_rows"], meta["n_cols"], crs=meta["crs"])
+    return gu.CompactGrid(lattice, {name: np.asarray(arrays[name]) for name in columns})
+
+
+def _lattice_meta(lattice):
+    return {"minx": lattice.minx, "miny": lattice.miny, "cell_size": lattice.cell_size,
+            "n_rows": lattice.n_rows, "n_cols": lattice.n_cols, "crs": _crs_meta(lattice.crs)}
+
+
+def load_beats(cache):
+    """Load the beats (Sector and geometry only), cached by shapefile contents."""
+    key = cache.key([cache.file_hash(p) for p in _shapefile_parts(config.SHAPEFILE_PATH)])
+    hit = cache.load("beats", key)
+    if hit is not None:
+        arrays, meta = hit
+        return gpd.GeoDataFrame({"Sector": np.asarray(arrays["Sector"])},
+                                geometry=_geometry_from_arrays(arrays), crs=meta["crs"]), key
+    beats = dp.load_shapefile()
+    arrays = {"Sector": beats["Sector"].to_numpy(), **_geometry_arrays(beats.geometry.to_numpy())}
+    cache.store("beats", key, arrays, {"crs": _crs_meta(beats.crs)})
+    return beats, key
+
+
+def build_grid(cache, beats, beats_key):
+    """
+    Create the lattice and assign sectors, cached by beats and CELL_SIZE.
+    Quadtree grids (GRID_MODE) are also keyed by the quadtree settings and
+    the incident file contents. Returns (CompactGrid, key).
+    """
+    if config.GRID_MODE == "quadtree":
+        paths = ingest.incident_paths()
+        key = cache.key(beats_key, config.CELL_SIZE, config.GRID_MODE, config.QUADTREE_MIN_CELL_SIZE,
+                        config.QUADTREE_LEVELS, config.QUADTREE_BOUNDARY_CELL_SIZE,
+                        config.QUADTREE_TARGET_CELLS, [cache.file_hash(p) for p in paths])
+        columns = ["Sector", "Grid_ID", "row", "col", "span"]
+    else:
+        key = cache.key(beats_key, config.CELL_SIZE)
+        columns = ["Sector", "Grid_ID", "row", "col"]
+    hit = cache.load("grid", key)
+    if hit is not None:
+        return _grid_from_arrays(*hit, columns), key
+    points = ingest.load_incident_points(paths) if config.GRID_MODE == "quadtree" else None
+    grid = gu.build_grid(beats, points)
+    cache.store("grid", key, _grid_arrays(grid, columns), _lattice_meta(grid.lattice))
+    return grid, key
+
+
+def aggregate_npps(cache, grid, grid_key):
+    """
+    Score incidents and aggregate NPPS by grid cell, cached by the grid, the
+    incident file contents and the NPPS config (CELL_SIZE enters via the grid).
+    Returns a CompactGrid with a 'total_npps' column.
+    """
+    if config.INCIDENT_DATA_DIR is not None:
+        paths = ingest.incident_paths()
+    else:
+        paths = [config.YEAR_DATA_PATH]
+    key = cache.key(grid_key, [cache.file_hash(p) for p in paths], config.NPPS_WEIGHTS,
+                    config.PRIORITY_WEIGHTS, config.OUTLIER_METHOD, config.OUTLIER_REPLACEMENT)
+    columns = ["Sector", "Grid_ID", "row", "col", "total_npps"]
+    if "span" in grid.columns:
+        columns.insert(4, "span")
+    hit = cache.load("npps", key)
+    if hit is not None:
+        return _grid_from_arrays(*hit, columns)
+    if config.INCIDENT_DATA_DIR is not None:
+        result = ingest.stream_npps_by_grid(paths, grid)
+    else:
+        npps_data = dp.calculate_npps(dp.preprocess_incident_data(dp.load_incident_data()))
+        result = na.aggregate_npps_by_grid(npps_data, grid)
+    cache.store("npps", key, _grid_arrays(result, columns), _lattice_meta(gu.lattice_spec(result)))
+    return result
+
+
+def build_npps_cube(cache, grid, grid_key):
+    """
+    Score incidents and bin them by grid cell and hour of week, cached like
+    aggregate_npps plus the timestamp column. Returns an NppsCube.
+    """
+    if config.INCIDENT_DATA_DIR is not None:
+        paths = ingest.incident_paths()
+    else:
+        paths = [config.YEAR_DATA_PATH]
+    key = cache.key(grid_key, [cache.file_hash(p) for p in paths], config.NPPS_WEIGHTS,
+                    config.PRIORITY_WEIGHTS, config.OUTLIER_METHOD, config.OUTLIER_REPLACEMENT,
+                    config.TIMESTAMP_COLUMN)
+    hit = cache.load("npps_cube", key)
+    if hit is not None:
+        return npps_cube.NppsCube(hit[0]["values"])
+    cube = npps_cube.load_npps_cube(grid)
+    cache.store("npps_cube", key, {"values": cube.values}, {})
+    return cube
+
+
+def build_road_graph(cache, streets, grid, grid_key):
+    """
+    Build the road graph from the centerlines and snap the grid cells to it,
+    cached by the centerline contents, SNAP_CRS and the grid.
+    Returns (RoadGraph, cell_node, cell_offset, key).
+    """
+    key = cache.key(grid_key, [cache.file_hash(p) for p in _shapefile_parts(config.CENTERLINES_PATH)],
+                    config.SNAP_CRS)
+    hit = cache.load("road_graph", key)
+    if hit is not None:
+        arrays, meta = hit
+        road = rn.RoadGraph(arrays["nodes"], arrays["indptr"], arrays["indices"], arrays["lengths"],
+                            meta["metric_crs"])
+        return road, arrays["cell_node"], arrays["cell_offset"], key
+    road = rn.RoadGraph.from_streets(streets)
+    cell_node, cell_offset = road.snap_cells(grid)
+    cache.store("road_graph", key, {**road.to_arrays(), "cell_node": cell_node, "cell_offset": cell_offset},
+                {"metric_crs": _crs_meta(road.metric_crs)})
+    return road, cell_node, cell_offset, key
+
+
+def build_travel_table(cache, grid, road, cell_node, cell_offset, road_key):
+    """
+    Road distances from the current sector centres to every cell, cached
+    (memory-mapped on a hit) by the road graph and the centre cells.
+    Returns a TravelTable for the grid's assignment.
+    """
+    sectors, centres = rn.sector_centres(grid)
+    key = cache.key(road_key, sectors.tolist(), centres.tolist())
+    hit = cache.load("travel", key)
+    if hit is not None:
+        distances = hit[0]["distances"]
+    else:
+        distances = rn.centre_distances(road, centres, cell_node, cell_offset)
+        cache.store("travel", key, {"distances": distances}, {})
+    return rn.TravelTable.from_distances(grid, sectors, centres, distances)
+
+
+def recentre_travel_table(cache, grid, travel, road, cell_node, cell_offset, road_key):
+    """
+    Recentre a TravelTable on the grid's current sector centres (see
+    TravelTable.recentre) and cache its distances under the new centres, so
+    a run starting from this assignment loads them.
+    Returns the sectors updated.
+    """
+    updated = travel.recentre(grid, road, cell_node, cell_offset)
+    if updated:
+        key = cache.key(road_key, travel.sectors.tolist(), travel.centres.tolist())
+        if cache.load("travel", key) is None:
+            cache.store("travel", key, {"distances": travel.distances}, {})
+    return updated
+
+
+def load_streets(cache):
+    """Load street centerlines (geometry only), cached by shapefile contents."""
+    key = cache.key([cache.file_hash(p) for p in _shapefile_parts(config.CENTERLINES_PATH)])
+    hit = cache.load("streets", key)
+    if hit is not None:
+        arrays, meta = hit
+        return gpd.GeoDataFrame(geometry=_geometry_from_arrays(arrays), crs=meta["crs"])
+    streets = gpd.read_file(config.CENTERLINES_PATH)
+    cache.store("streets", key, _geometry_arrays(streets.geometry.to_numpy()), {"crs": _crs_meta(streets.crs)})
+    return streets
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import box
+import config
+
+# Rough extent of Berkeley in EPSG:4326 (minx, miny, maxx, maxy)
+BERKELEY_BOUNDS = (-122.324, 37.845, -122.234, 37.906)
+
+PRIORITIES = ["1", "1F", "2", "3", "4", "5", "", None]
+PRIORITY_PROBS = [0.08, 0.02, 0.25, 0.30, 0.20, 0.10, 0.03, 0.02]
+DISPOSITIONS = ["ARREST", "Arrest; case report", "CASE", "Report taken", "Advised", "", None]
+DISPOSITION_PROBS = [0.05, 0.02, 0.18, 0.30, 0.40, 0.03, 0.02]
+# Relative call volume by hour of day (quiet early morning, evening peak)
+HOURLY_PROFILE = np.array([4, 3, 2, 2, 1, 1, 2, 3, 4, 5, 5, 6, 6, 6, 6, 7, 7, 8, 8, 8, 7, 6, 5, 5], dtype=float)
+
+
+def synthetic_beats(n_sectors=14, bounds=BERKELEY_BOUNDS, seed=0):
+    """
+    Random contiguous beat polygons: a Voronoi partition of the bounds.
+    Returns GeoDataFrame with columns: Sector (1..n_sectors), geometry
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    extent = box(*bounds)
+    points = shapely.points(rng.uniform(minx, maxx, n_sectors), rng.uniform(miny, maxy, n_sectors))
+    cells = shapely.voronoi_polygons(shapely.multipoints(points), extend_to=extent)
+    cells = shapely.intersection(np.asarray(cells.geoms), extent)
+    # Number sectors in seed-point order
+    order = [np.flatnonzero(shapely.contains(cells, p))[0] for p in points]
+    return gpd.GeoDataFrame({"Sector": np.arange(1, n_sectors + 1)}, geometry=cells[order], crs="EPSG:4326")
+
+
+def synthetic_sector_neighbors(beats):
+    """Sector adjacency dict (like SectorGraph.to_dict) from touching beats."""
+    left, right = beats.sindex.query(beats.geometry, predicate="touches")
+    sectors = beats["Sector"].to_numpy()
+    neighbors = {int(s): [] for s in sectors}
+    for i, j in zip(left, right):
+        neighbors[int(sectors[i])].append(int(sectors[j]))
+    return {s: sorted(n) for s, n in neighbors.items()}
+
+
+def synthetic_streets(bounds=BERKELEY_BOUNDS, spacing=0.002):
+    """
+    Street centerline grid over the bounds: one line per row and column,
+    split into block-length segments like a real centerline layer.
+    Returns GeoDataFrame with a geometry column
+    """
+    minx, miny, maxx, maxy = bounds
+    xs = np.arange(minx, maxx + spacing / 2, spacing)
+    ys = np.arange(miny, maxy + spacing / 2, spacing)
+    segments = []
+    for y in ys:
+        segments += [shapely.linestrings([(x0, y), (x1, y)]) for x0, x1 in zip(xs[:-1], xs[1:])]
+    for x in xs:
+        segments += [shapely.linestrings([(x, y0), (x, y1)]) for y0, y1 in zip(ys[:-1], ys[1:])]
+    return gpd.GeoDataFrame(geometry=segments, crs="EPSG:4326")
+
+
+def synthetic_incidents(n, bounds=BERKELEY_BOUNDS, seed=0, n_hotspots=20):
+    """
+    Synthetic CAD incident rows with the columns of data_preprocessing.INCIDENT_COLUMNS.
+    Locations mix uniform background with Gaussian hotspots; response times
+    are log-normal with a heavy tail and some missing values, so IQR
+    outlier handling has work to do. Timestamps (config.TIMESTAMP_COLUMN)
+    fall in 2024 and follow HOURLY_PROFILE; hotspots lean towards nights.
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    centers = np.column_stack([rng.uniform(minx, maxx, n_hotspots), rng.uniform(miny, maxy, n_hotspots)])
+    hotspot = rng.integers(0, n_hotspots, n)
+    spread = 0.05 * min(maxx - minx, maxy - miny)
+    lon = centers[hotspot, 0] + rng.normal(0, spread, n)
+    lat = centers[hotspot, 1] + rng.normal(0, spread, n)
+    background = rng.random(n) < 0.4
+    lon[background] = rng.uniform(minx, maxx, background.sum())
+    lat[background] = rng.uniform(miny, maxy, background.sum())
+    lon = np.clip(lon, minx, maxx)
+    lat = np.clip(lat, miny, maxy)
+    hour = rng.choice(24, n, p=HOURLY_PROFILE / HOURLY_PROFILE.sum())
+    night_hotspot = ~background & (hotspot % 2 == 0) & (rng.random(n) < 0.5)
+    hour[night_hotspot] = rng.choice([22, 23, 0, 1, 2], night_hotspot.sum())
+    seconds = rng.integers(0, 366, n) * 86400 + hour * 3600 + rng.integers(0, 3600, n)
+    created = np.datetime64("2024-01-01") + seconds.astype("timedelta64[s]")
+    response = np.round(rng.lognormal(3.0, 0.8, n), 1)
+    response[rng.random(n) < 0.01] = np.nan
+    return pd.DataFrame({
+        "Priority": rng.choice(np.array(PRIORITIES, dtype=object), n, p=PRIORITY_PROBS),
+        "lat": lat,
+        "lon": lon,
+        "Time Spent Responding": response,
+        "Dispositions": rng.choice(np.array(DISPOSITIONS, dtype=object), n, p=DISPOSITION_PROBS),
+        config.TIMESTAMP_COLUMN: created,
+    })
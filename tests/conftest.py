@@ -0,0 +1,60 @@
+import os
+import sys
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.sparse import csgraph
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_preprocessing as dp
+import grid_utils as gu
+import npps_analysis as na
+import synthetic
+
+
+def copy_grid(grid):
+    return gu.CompactGrid(grid.lattice, {name: grid[name].to_numpy().copy() for name in grid.columns})
+
+
+def sector_components(grid, sector=None):
+    """Number of edge-connected pieces of every sector (of grid['Sector'] unless given)."""
+    contacts = gu.lattice_contacts(grid).tocoo()
+    sector = grid["Sector"].to_numpy() if sector is None else np.asarray(sector)
+    same = sector[contacts.row] == sector[contacts.col]
+    links = sparse.coo_matrix((np.ones(int(same.sum())), (contacts.row[same], contacts.col[same])),
+                              shape=contacts.shape)
+    _, labels = csgraph.connected_components(links, directed=False)
+    return {int(s): len(np.unique(labels[sector == s])) for s in np.unique(sector)}
+
+
+@pytest.fixture(scope="session")
+def city():
+    """Synthetic 14-sector city on a 0.002 degree lattice (~1350 cells), NPPS from 20k incidents."""
+    beats = synthetic.synthetic_beats(14)
+    grid = gu.assign_sectors_to_grid(gu.create_grid(beats, 0.002), beats, compact=True)
+    incidents = dp.calculate_npps(dp.preprocess_incident_data(synthetic.synthetic_incidents(20000)))
+    return beats, na.aggregate_npps_by_grid(incidents, grid)
+
+
+@pytest.fixture(scope="session")
+def quadtree_city(city):
+    """The same city on a quadtree grid of 0.0005-0.004 degree cells (1500 cells)."""
+    beats, _ = city
+    incidents = dp.calculate_npps(dp.preprocess_incident_data(synthetic.synthetic_incidents(20000)))
+    grid = gu.create_quadtree_grid(beats, incidents["lon"].to_numpy(), incidents["lat"].to_numpy(),
+                                   min_cell_size=0.0005, levels=4, boundary_cell_size=0.001,
+                                   target_cells=1500, compact=True)
+    return beats, na.aggregate_npps_by_grid(incidents, grid)
+
+
+@pytest.fixture
+def grid(city):
+    """Fresh copy of the city grid that a test may modify."""
+    return copy_grid(city[1])
+
+
+@pytest.fixture
+def quadtree_grid(quadtree_city):
+    """Fresh copy of the quadtree city grid that a test may modify."""
+    return copy_grid(quadtree_city[1])
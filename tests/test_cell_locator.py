@@ -0,0 +1,45 @@
+import os
+import sys
+import geopandas as gpd
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import grid_utils as gu
+
+
+def sample_points(grid, n, seed):
+    """Random points inside the lattice, on cell edges and corners, and outside it."""
+    rng = np.random.default_rng(seed)
+    lat = grid.lattice
+    x0, x1 = lat.x_edges[0], lat.x_edges[-1]
+    y0, y1 = lat.y_edges[0], lat.y_edges[-1]
+    margin = 5 * lat.cell_size
+    inside = rng.uniform([x0, y0], [x1, y1], (n, 2))
+    on_x_edge = np.column_stack([rng.choice(lat.x_edges, n), rng.uniform(y0, y1, n)])
+    on_y_edge = np.column_stack([rng.uniform(x0, x1, n), rng.choice(lat.y_edges, n)])
+    corners = np.column_stack([rng.choice(lat.x_edges, n), rng.choice(lat.y_edges, n)])
+    outside = rng.uniform([x0 - margin, y0 - margin], [x1 + margin, y1 + margin], (4 * n, 2))
+    outside = outside[(outside[:, 0] < x0) | (outside[:, 0] > x1) | (outside[:, 1] < y0) | (outside[:, 1] > y1)]
+    return np.vstack([inside, on_x_edge, on_y_edge, corners, outside])
+
+
+@pytest.mark.filterwarnings("ignore:Geometry is in a geographic CRS")
+@pytest.mark.parametrize("kind", ["grid", "quadtree_grid"])
+def test_locate_matches_sjoin_nearest(kind, request):
+    grid = request.getfixturevalue(kind)
+    xy = sample_points(grid, 500, seed=0)
+    located = grid["Grid_ID"].to_numpy()[gu.CellLocator(grid).locate(xy[:, 0], xy[:, 1])]
+
+    cells = grid.to_geodataframe()
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs=cells.crs)
+    joined = gpd.sjoin_nearest(points, cells[["Grid_ID", "geometry"]], how="left")
+    # Points on a shared edge or corner are equally near to every cell touching it
+    nearest = joined.groupby(level=0)["Grid_ID"].agg(set)
+    assert len(nearest) == len(xy)
+    for i, grid_id in enumerate(located):
+        assert grid_id in nearest[i], (i, xy[i], grid_id, nearest[i])
+    unique = nearest.map(len) == 1
+    assert unique.sum() > len(xy) // 3
+    np.testing.assert_array_equal(located[unique.to_numpy()], [next(iter(s)) for s in nearest[unique]])
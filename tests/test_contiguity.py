@@ -0,0 +1,64 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import grid_utils as gu
+import rebalancer as rb
+import sector_optimization as so
+from conftest import sector_components
+from workload import SectorLedger
+
+
+def brute_force_removable(mask):
+    """
+    Whether the centre of a 3x3 block can leave its sector: the edge neighbors
+    in the sector must stay edge-connected through the ring without it.
+    """
+    cells = {gu.RING_OFFSETS[slot] for slot in range(8) if (mask >> slot) & 1}
+    edge = [offset for offset in cells if 0 in offset]
+    if not edge:
+        return True
+    seen, stack = {edge[0]}, [edge[0]]
+    while stack:
+        r, c = stack.pop()
+        for dr, dc in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            nxt = (r + dr, c + dc)
+            if nxt in cells and nxt not in seen:
+                seen.add(nxt)
+                stack.append(nxt)
+    return all(offset in seen for offset in edge)
+
+
+def test_removable_patterns_match_brute_force():
+    expected = [brute_force_removable(mask) for mask in range(256)]
+    np.testing.assert_array_equal(gu.REMOVABLE_PATTERNS, expected)
+
+
+def local_search(grid):
+    rb.rebalance_sectors(grid, max_iter=20000, seed=0, contiguous=True)
+
+
+def bulk(grid):
+    ledger = SectorLedger.from_grid(grid)
+    so.give_bulk_boundaries_from_excess(grid, None, ledger.excess_sectors(0.15), ledger, True)
+    so.take_bulk_boundaries_to_deficient(grid, ledger.most_deficient(), None, ledger, True)
+
+
+def multilevel(grid):
+    rb.multilevel_rebalance(grid, seed=0, contiguous=True)
+
+
+@pytest.mark.parametrize("method", [local_search, bulk, multilevel])
+@pytest.mark.parametrize("kind", ["grid", "quadtree_grid"])
+def test_rebalancing_never_splits_a_sector(method, kind, request):
+    grid = request.getfixturevalue(kind)
+    initial = grid["Sector"].to_numpy().copy()
+    assert set(sector_components(grid).values()) == {1}
+    method(grid)
+    assert np.count_nonzero(grid["Sector"].to_numpy() != initial) > 0
+    components = sector_components(grid)
+    assert sorted(components) == sorted(np.unique(initial).tolist())
+    assert set(components.values()) == {1}
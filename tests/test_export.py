@@ -0,0 +1,35 @@
+import os
+import sys
+import numpy as np
+import pytest
+from pyproj import CRS
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import export
+import npps_cube
+
+
+@pytest.mark.parametrize("mmap_mode", ["r", None])
+@pytest.mark.parametrize("kind", ["grid", "quadtree_grid"])
+def test_lattice_round_trip_is_identical(kind, mmap_mode, request, tmp_path):
+    grid = request.getfixturevalue(kind)
+    cube = npps_cube.NppsCube(np.random.default_rng(0).gamma(2.0, 1.0, (len(grid), 168)))
+    path = str(tmp_path / "grid.lattice")
+    export.save_lattice(grid, path, cube)
+    loaded, loaded_cube = export.load_lattice(path, mmap_mode=mmap_mode)
+
+    for attr in ("minx", "miny", "cell_size", "n_rows", "n_cols"):
+        assert getattr(loaded.lattice, attr) == getattr(grid.lattice, attr), attr
+    assert CRS.from_user_input(loaded.crs) == CRS.from_user_input(grid.crs)
+    np.testing.assert_array_equal(loaded.lattice.x_edges, grid.lattice.x_edges)
+    np.testing.assert_array_equal(loaded.lattice.y_edges, grid.lattice.y_edges)
+    assert loaded.columns == grid.columns
+    assert ("span" in loaded.columns) == (kind == "quadtree_grid")
+    for name in grid.columns:
+        original, restored = grid[name].to_numpy(), loaded[name].to_numpy()
+        assert restored.dtype == original.dtype, name
+        np.testing.assert_array_equal(restored, original, err_msg=name)
+    assert loaded_cube.values.dtype == cube.values.dtype
+    np.testing.assert_array_equal(loaded_cube.values, cube.values)
+    assert loaded.to_geodataframe().geometry.geom_equals_exact(grid.to_geodataframe().geometry, 0).all()
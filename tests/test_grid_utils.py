@@ -0,0 +1,57 @@
+import os
+import sys
+import geopandas as gpd
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import grid_utils as gu
+import sector_optimization as so
+
+
+def baseline_identify_boundary_grids(grid):
+    """The original touches()-per-row identify_boundary_grids, kept as the reference."""
+    boundary_grids = grid.copy()
+    boundary_grids["is_boundary"] = False
+    for idx, row in grid.iterrows():
+        neighbors = grid[grid.geometry.touches(row.geometry)]
+        if not neighbors.empty:
+            if any(neighbors["Sector"] != row["Sector"]):
+                boundary_grids.at[idx, "is_boundary"] = True
+    return boundary_grids
+
+
+def baseline_build_boundary_pairs_info(grid):
+    """The original touches()-per-row build_boundary_pairs_info, kept as the reference."""
+    boundary_list = []
+    for idx, row in grid.iterrows():
+        from_sector = row["Sector"]
+        neighbors = grid[grid.geometry.touches(row.geometry)]
+        diff_sector_neighbors = neighbors[neighbors["Sector"] != from_sector]
+        for n_idx, n_row in diff_sector_neighbors.iterrows():
+            boundary_list.append({
+                "Grid_ID": row["Grid_ID"],
+                "Sector": from_sector,
+                "neighbor_sector": n_row["Sector"],
+                "geometry": row["geometry"]
+            })
+    boundary_pairs_info = gpd.GeoDataFrame(boundary_list, crs=grid.crs)
+    boundary_pairs_info.drop_duplicates(subset=["Grid_ID", "Sector", "neighbor_sector"], inplace=True)
+    return boundary_pairs_info
+
+
+def test_identify_boundary_grids_matches_touches_baseline(grid):
+    frame = grid.to_geodataframe()
+    expected = baseline_identify_boundary_grids(frame)
+    result = gu.identify_boundary_grids(grid)
+    pd.testing.assert_frame_equal(result, expected)
+    pd.testing.assert_series_equal(gu.identify_boundary_grids(frame)["is_boundary"], expected["is_boundary"])
+
+
+def test_build_boundary_pairs_info_matches_touches_baseline(grid):
+    frame = grid.to_geodataframe()
+    expected = baseline_build_boundary_pairs_info(frame)
+    result = so.build_boundary_pairs_info(frame)
+    # iterrows() hands the baseline object-dtype rows, so only values and index are compared
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    assert len(result) > 0
@@ -0,0 +1,25 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ingest
+
+
+@pytest.mark.parametrize("q", [0.0, 0.25, 0.5, 0.75, 1.0])
+def test_sketch_quantile_matches_series_quantile(q):
+    values = np.random.default_rng(0).gamma(2.0, 300.0, 1000).round()
+    sketch = ingest.ValueCountSketch()
+    sketch.update(values[:400])
+    sketch.update(values[400:])
+    assert sketch.quantile(q) == pd.Series(values).quantile(q)
+
+
+def test_sketch_quantile_of_empty_sketch_raises():
+    sketch = ingest.ValueCountSketch()
+    sketch.update([np.nan, np.nan])
+    with pytest.raises(ValueError, match="empty sketch"):
+        sketch.quantile(0.25)
@@ -0,0 +1,35 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import grid_utils as gu
+import multilevel as ml
+from conftest import sector_components
+
+
+def partition(grid, assignment, seed):
+    weights = grid["total_npps"].to_numpy(dtype=np.float64)
+    return ml.multilevel_partition(assignment, weights, gu.lattice_contacts(grid), 14, seed=seed)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("kind", ["grid", "quadtree_grid"])
+def test_coarsen_and_refine_keeps_sectors_whole_and_never_worsens_variance(kind, seed, request):
+    grid = request.getfixturevalue(kind)
+    weights = grid["total_npps"].to_numpy(dtype=np.float64)
+    before = np.searchsorted(np.unique(grid["Sector"].to_numpy()), grid["Sector"].to_numpy())
+    after, stats = partition(grid, before, seed)
+    assert len(stats["levels"]) > 1
+    # Every sector is still present and in one edge-connected piece
+    assert set(sector_components(grid, after).values()) == {1}
+    assert np.all(np.bincount(after, minlength=14) > 0)
+    variance = lambda a: np.var(np.bincount(a, weights=weights, minlength=14))
+    assert variance(after) < variance(before)
+    assert stats["final_variance"] == pytest.approx(variance(after))
+    # Starting from a balanced assignment it must not make things worse
+    again, _ = partition(grid, after, seed + 1)
+    assert variance(again) <= variance(after) * (1 + 1e-12)
+    assert set(sector_components(grid, again).values()) == {1}
@@ -0,0 +1,73 @@
+import os
+import sys
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.preprocessing import MinMaxScaler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import data_preprocessing as dp
+import npps_analysis as na
+
+PRIORITIES = [np.nan, None, "", "  ", "1F", "1", "2", "3", "4", "5", "P2", "12", "abc", 1.0, 2.0, 3.5, 4, "2.0"]
+DISPOSITIONS = [np.nan, None, "", " ", "ARREST MADE", "Arrest", "Case Report", "case", "Report Taken",
+                "unknown code", 7, "Arrest / case"]
+
+
+def baseline_npps(df):
+    """The original row-wise calculate_npps, kept as the reference."""
+    column = "Time Spent Responding"
+    q1, q3 = df[column].quantile(0.25), df[column].quantile(0.75)
+    lower, upper = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+    df[column] = df[column].apply(lambda x: config.OUTLIER_REPLACEMENT if x < lower or x > upper else x)
+    df["Priority Numeric"] = df["Priority"].apply(dp.extract_priority)
+    df["Priority Weight"] = df["Priority Numeric"].apply(lambda x: config.PRIORITY_WEIGHTS.get(x, 0.0))
+    df["Scaled Response Time"] = MinMaxScaler().fit_transform(df[[column]])
+    df["Disposition Weight"] = df["Dispositions"].apply(dp.get_disposition_weight)
+    w = config.NPPS_WEIGHTS
+    df["NPPS"] = (w["priority"] * df["Priority Weight"] + w["response_time"] * df["Scaled Response Time"]
+                  + w["disposition"] * df["Disposition Weight"])
+    return df
+
+
+def incidents(n, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "Priority": pd.Series([PRIORITIES[i] for i in rng.integers(len(PRIORITIES), size=n)], dtype=object),
+        "lat": rng.uniform(37.85, 37.9, n),
+        "lon": rng.uniform(-122.3, -122.25, n),
+        "Time Spent Responding": np.where(rng.random(n) < 0.05, np.nan, rng.gamma(2.0, 300.0, n)),
+        "Dispositions": pd.Series([DISPOSITIONS[i] for i in rng.integers(len(DISPOSITIONS), size=n)], dtype=object),
+    })
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_calculate_npps_matches_row_wise_baseline(seed):
+    df = incidents(5000, seed)
+    expected = baseline_npps(df.copy())
+    result = dp.calculate_npps(df.copy())
+    for column in ["Priority Numeric", "Priority Weight", "Disposition Weight", "Scaled Response Time", "NPPS"]:
+        np.testing.assert_array_equal(result[column].to_numpy(dtype=np.float64),
+                                      expected[column].to_numpy(dtype=np.float64), err_msg=column)
+
+
+@pytest.mark.parametrize("value", PRIORITIES)
+def test_priority_lookup_matches_extract_priority(value):
+    numeric, weight = dp.priority_lookup(pd.Series([value, "3"], dtype=object))
+    assert numeric[0] == dp.extract_priority(value)
+    assert weight[0] == config.PRIORITY_WEIGHTS.get(dp.extract_priority(value), 0.0)
+
+
+@pytest.mark.parametrize("value", DISPOSITIONS)
+def test_disposition_lookup_matches_get_disposition_weight(value):
+    assert dp.disposition_lookup(pd.Series([value, "arrest"], dtype=object))[0] == dp.get_disposition_weight(value)
+
+
+def test_balance_metrics_report_inf_ratio_for_a_sector_without_npps():
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        metrics = na.balance_metrics(pd.DataFrame({"sector_total_npps": [1.0, 0.0, 3.0]}))
+    assert metrics["max_min_ratio"] == float("inf")
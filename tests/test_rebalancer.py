@@ -0,0 +1,20 @@
+import os
+import sys
+import warnings
+import numpy as np
+from scipy import sparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rebalancer as rb
+
+
+def test_local_search_reports_inf_ratio_for_a_sector_without_workload():
+    # A chain of six cells; sector 2 holds one cell with no incidents
+    links = sparse.diags([np.ones(5), np.ones(5)], [-1, 1], format="csr")
+    assignment = np.array([0, 0, 0, 1, 1, 2])
+    weights = np.array([3.0, 2.0, 1.0, 1.0, 1.0, 0.0])
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        _, stats = rb.local_search(assignment, weights, links.indptr, links.indices, 3, max_iter=0)
+    assert stats["final_ratio"] == float("inf")
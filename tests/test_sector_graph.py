@@ -0,0 +1,61 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import grid_utils as gu
+from conftest import copy_grid
+from sector_graph import SectorGraph
+
+
+def random_moves(grid, graph, n_moves, seed):
+    """Move random boundary cells, singly and in batches, into a neighboring sector."""
+    rng = np.random.default_rng(seed)
+    adjacency = gu.lattice_adjacency(grid)
+    sector = grid["Sector"].to_numpy().copy()
+    for _ in range(n_moves):
+        cell = int(rng.integers(len(sector)))
+        nbrs = adjacency.indices[adjacency.indptr[cell]:adjacency.indptr[cell + 1]]
+        others = np.unique(sector[nbrs][sector[nbrs] != sector[cell]])
+        if len(others) == 0:
+            continue
+        to_sector = int(rng.choice(others))
+        if rng.random() < 0.5:
+            graph.move(cell, to_sector)
+            cells = [cell]
+        else:
+            cells = np.append(nbrs[sector[nbrs] == sector[cell]][:3], cell)
+            graph.move_cells(cells, to_sector)
+        sector[cells] = to_sector
+    grid["Sector"] = sector
+    return grid
+
+
+def assert_same_graph(graph, expected):
+    np.testing.assert_array_equal(graph.sectors, expected.sectors)
+    np.testing.assert_array_equal(graph.assignment, expected.assignment)
+    np.testing.assert_array_equal(graph.neighbor_counts, expected.neighbor_counts)
+    np.testing.assert_array_equal(graph.boundary, expected.boundary)
+    np.testing.assert_array_equal(graph.shared, expected.shared)
+
+
+@pytest.mark.parametrize("kind", ["grid", "quadtree_grid"])
+def test_moves_match_a_rebuild_from_the_final_assignment(kind, request):
+    grid = request.getfixturevalue(kind)
+    initial = grid["Sector"].to_numpy().copy()
+    graph = SectorGraph.from_grid(grid)
+    grid = random_moves(grid, graph, 500, seed=0)
+    assert np.count_nonzero(grid["Sector"].to_numpy() != initial) > 100
+    assert_same_graph(graph, SectorGraph.from_grid(grid))
+
+
+@pytest.mark.parametrize("kind", ["grid", "quadtree_grid"])
+def test_reset_matches_a_rebuild(kind, request):
+    grid = request.getfixturevalue(kind)
+    graph = SectorGraph.from_grid(grid)
+    moved = random_moves(copy_grid(grid), SectorGraph.from_grid(grid), 500, seed=1)
+    expected = SectorGraph.from_grid(moved)
+    graph.reset(expected.assignment)
+    assert_same_graph(graph, expected)
@@ -0,0 +1,52 @@
+import asyncio
+import os
+import sys
+import threading
+import numpy as np
+from sklearn.preprocessing import MinMaxScaler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import data_preprocessing as dp
+import export
+import service
+import synthetic
+
+
+def test_snapshot_is_not_torn_by_incidents_posted_while_it_is_written(grid, tmp_path, monkeypatch):
+    history = dp.preprocess_incident_data(synthetic.synthetic_incidents(5000, seed=1))
+    column = history["Time Spent Responding"]
+    bounds = dp.iqr_bounds(column.quantile(0.25), column.quantile(0.75))
+    scaler = MinMaxScaler().fit(history[["Time Spent Responding"]])
+    svc = service.RebalancingService(grid, bounds, scaler, max_workers=1)
+    before = svc.grid["total_npps"].to_numpy().copy()
+
+    path = str(tmp_path / "grid.lattice")
+    monkeypatch.setattr(config, "FINAL_LATTICE_PATH", path)
+    writing, added = threading.Event(), threading.Event()
+    save_lattice = export.save_lattice
+
+    def slow_save(grid, path):
+        writing.set()
+        assert added.wait(10)
+        save_lattice(grid, path)
+
+    monkeypatch.setattr(export, "save_lattice", slow_save)
+    batch = synthetic.synthetic_incidents(2000, seed=2).to_dict(orient="records")
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        snapshot = asyncio.create_task(svc.snapshot({}))
+        await loop.run_in_executor(None, writing.wait, 10)
+        version = svc.version
+        posted = await svc.incidents(batch)
+        added.set()
+        return await snapshot, version, posted
+
+    result, version, posted = asyncio.run(run())
+    assert posted["binned"] > 0 and posted["version"] > version
+    assert result["version"] == version
+    saved, _ = export.load_lattice(path)
+    np.testing.assert_array_equal(saved["total_npps"].to_numpy(), before)
+    assert not np.array_equal(svc.grid["total_npps"].to_numpy(), before)
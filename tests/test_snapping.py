@@ -0,0 +1,40 @@
+import os
+import sys
+import numpy as np
+import pytest
+import shapely
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snapping as sn
+
+
+def random_mask(rng):
+    """Random blobby or speckled cell mask: holes, islands and corner-only contacts."""
+    rows, cols = rng.integers(1, 16, 2)
+    mask = rng.random((rows, cols)) < rng.uniform(0.2, 0.9)
+    if rng.random() < 0.5 and rows > 2 and cols > 2:
+        # Smooth into blobs so the test also sees large rings with holes
+        padded = np.pad(mask, 1).astype(int)
+        votes = sum(np.roll(np.roll(padded, dr, 0), dc, 1) for dr in (-1, 0, 1) for dc in (-1, 0, 1))[1:-1, 1:-1]
+        mask = votes >= 5
+    if not mask.any():
+        mask[rng.integers(rows), rng.integers(cols)] = True
+    return mask
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_trace_outline_equals_unary_union_of_cell_boxes(seed):
+    rng = np.random.default_rng(seed)
+    mask = random_mask(rng)
+    cell_size = 0.001
+    x_edges = np.add.accumulate(np.r_[-122.3, np.full(mask.shape[1], cell_size)])
+    y_edges = np.add.accumulate(np.r_[37.85, np.full(mask.shape[0], cell_size)])
+    rows, cols = np.nonzero(mask)
+    boxes = shapely.box(x_edges[cols], y_edges[rows], x_edges[cols + 1], y_edges[rows + 1])
+    expected = shapely.unary_union(boxes)
+
+    outline = sn.trace_outline(mask, x_edges, y_edges)
+    assert outline.is_valid
+    assert outline.geom_type == expected.geom_type
+    assert shapely.normalize(outline).equals_exact(shapely.normalize(expected), 0)
@@ -0,0 +1,39 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import grid_utils as gu
+import stage_cache
+
+
+def test_grid_hit_keeps_columns_memory_mapped(tmp_path):
+    cache = stage_cache.StageCache(root=str(tmp_path / "cache"), max_bytes=1 << 30)
+    lattice = gu.LatticeGrid(0.0, 0.0, 1.0, 2, 3)
+    grid = gu.CompactGrid(lattice, {"Sector": np.array([1, 1, 2, 2, 3, 3]), "Grid_ID": np.arange(6),
+                                    "row": np.array([0, 0, 0, 1, 1, 1]), "col": np.array([0, 1, 2, 0, 1, 2])})
+    columns = ["Sector", "Grid_ID", "row", "col"]
+    cache.store("grid", "k", stage_cache._grid_arrays(grid, columns), stage_cache._lattice_meta(lattice))
+    loaded = stage_cache._grid_from_arrays(*cache.load("grid", "k"), columns)
+    sector = loaded["Sector"].to_numpy()
+    base = sector
+    while base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    assert base is not None
+    assert not sector.flags.writeable
+    loaded["Sector"] = np.where(sector == 3, 2, sector)
+    np.testing.assert_array_equal(loaded["Sector"].to_numpy(), [1, 1, 2, 2, 2, 2])
+
+
+def test_eviction_prunes_hashes_of_changed_and_deleted_files(tmp_path):
+    cache = stage_cache.StageCache(root=str(tmp_path / "cache"), max_bytes=0)
+    changed, deleted, kept = (tmp_path / name for name in ("changed.csv", "deleted.csv", "kept.csv"))
+    for path in (changed, deleted, kept):
+        path.write_text("a,b\n1,2\n")
+        cache.file_hash(str(path))
+    changed.write_text("a,b\n1,2\n3,4\n")
+    deleted.unlink()
+    cache.store("npps", "k", {"values": np.zeros(4)}, {})
+    reloaded = stage_cache.StageCache(root=cache.root, max_bytes=0)
+    assert [stamp.split("|")[0] for stamp in reloaded._hash_index] == [str(kept)]
@@ -0,0 +1,68 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import sector_optimization as so
+from conftest import copy_grid
+from workload import SectorLedger
+
+
+def bulk_rebalance(grid, excess, deficient):
+    ledger = SectorLedger.from_grid(grid)
+    so.give_bulk_boundaries_from_excess(grid, None, excess, ledger, True)
+    so.take_bulk_boundaries_to_deficient(grid, deficient, None, ledger, True)
+    return ledger
+
+
+def test_excess_and_most_deficient_follow_the_totals(grid):
+    ledger = SectorLedger.from_grid(grid)
+    excess = ledger.excess_sectors(config.BULK_EXCESS_TOLERANCE)
+    totals = dict(zip(ledger.sectors.tolist(), ledger.totals.tolist()))
+    assert excess == sorted((s for s, t in totals.items() if t > ledger.mean * (1 + config.BULK_EXCESS_TOLERANCE)),
+                            key=lambda s: -totals[s])
+    assert ledger.most_deficient() == min(totals, key=totals.get)
+
+
+def test_derived_bulk_sectors_balance_better_than_the_hardcoded_ones(city, grid):
+    _, base = city
+    initial = SectorLedger.from_grid(base).max_min_ratio
+    # The sectors main.py used to hardcode for the Berkeley beats
+    hardcoded = bulk_rebalance(grid, [4, 6, 7], 12).max_min_ratio
+    grid = copy_grid(base)
+    ledger = SectorLedger.from_grid(grid)
+    derived = bulk_rebalance(grid, ledger.excess_sectors(config.BULK_EXCESS_TOLERANCE),
+                             ledger.most_deficient()).max_min_ratio
+    assert (initial, hardcoded, derived) == pytest.approx((8.28, 7.64, 3.45), abs=0.01)
+
+
+def test_reassign_and_add_match_bincount(grid):
+    rng = np.random.default_rng(0)
+    ledger = SectorLedger.from_grid(grid)
+    sector = grid["Sector"].to_numpy().copy()
+    npps = grid["total_npps"].to_numpy().copy()
+    for _ in range(200):
+        cells = rng.choice(len(sector), size=int(rng.integers(1, 20)), replace=False)
+        if rng.random() < 0.5:
+            to_sector = int(rng.choice(ledger.sectors))
+            ledger.reassign(sector[cells], npps[cells], to_sector)
+            sector[cells] = to_sector
+        else:
+            added = rng.gamma(2.0, 1.0, len(cells))
+            ledger.add(sector[cells], added)
+            np.add.at(npps, cells, added)
+    positions = np.searchsorted(ledger.sectors, sector)
+    totals = np.bincount(positions, weights=npps, minlength=len(ledger.sectors))
+    np.testing.assert_allclose(ledger.totals, totals)
+    np.testing.assert_array_equal(ledger.counts, np.bincount(positions, minlength=len(ledger.sectors)))
+    assert ledger.variance == pytest.approx(np.var(totals))
+
+
+def test_max_min_ratio_of_an_empty_sector_is_inf(recwarn):
+    ledger = SectorLedger([1, 2, 3], [4.0, 0.0, 2.0], [3, 1, 2])
+    assert ledger.max_min_ratio == float("inf")
+    assert SectorLedger([1, 2], [4.0, 2.0], [1, 1]).max_min_ratio == 2.0
+    assert not recwarn.list
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+
+def max_min_ratio(totals):
+    """
+    Largest over smallest sector total; inf when a sector has no workload
+    (e.g. a beat without incidents), without a divide-by-zero warning.
+    """
+    totals = np.asarray(totals, dtype=np.float64)
+    low = totals.min()
+    return float(totals.max() / low) if low > 0 else float("inf")
+
+
+class SectorLedger:
+    """
+    Per-sector workload ledger.
+    Keeps NPPS totals, cell counts and the running sum of squared totals in
+    NumPy arrays indexed by sector position, so cell moves update it in
+    O(moved cells) instead of re-aggregating the whole grid.
+    """
+
+    def __init__(self, sectors, totals, counts):
+        self.sectors = np.asarray(sectors, dtype=np.int64)
+        self.totals = np.asarray(totals, dtype=np.float64).copy()
+        self.counts = np.asarray(counts, dtype=np.int64).copy()
+        self._position = {int(s): i for i, s in enumerate(self.sectors)}
+        self._sum_sq = float(np.dot(self.totals, self.totals))
+
+    @classmethod
+    def from_grid(cls, grid, value_col="total_npps"):
+        """Build a ledger from a grid with 'Sector' and value_col columns."""
+        sector = grid["Sector"].to_numpy()
+        sectors = np.unique(sector)
+        positions = np.searchsorted(sectors, sector)
+        totals = np.bincount(positions, weights=grid[value_col].to_numpy(dtype=np.float64),
+                             minlength=len(sectors))
+        counts = np.bincount(positions, minlength=len(sectors))
+        return cls(sectors, totals, counts)
+
+    def position(self, sector):
+        """Array position of a sector label."""
+        return self._position[int(sector)]
+
+    def positions(self, sectors):
+        """Array positions of an array of sector labels."""
+        return np.searchsorted(self.sectors, np.asarray(sectors))
+
+    def move(self, npps, from_sector, to_sector, n_cells=1):
+        """Move n_cells carrying npps workload from one sector to another in O(1)."""
+        self.move_positions(npps, self.position(from_sector), self.position(to_sector), n_cells)
+
+    def move_positions(self, npps, from_pos, to_pos, n_cells=1):
+        """Same as move(), addressed by sector position."""
+        old_from = self.totals[from_pos]
+        old_to = self.totals[to_pos]
+        new_from = old_from - npps
+        new_to = old_to + npps
+        self.totals[from_pos] = new_from
+        self.totals[to_pos] = new_to
+        self.counts[from_pos] -= n_cells
+        self.counts[to_pos] += n_cells
+        self._sum_sq += new_from * new_from + new_to * new_to - old_from * old_from - old_to * old_to
+
+    def reassign(self, from_sectors, npps, to_sector):
+        """
+        Move a batch of cells, each with its own current sector, to to_sector.
+        Cost is O(len(npps)).
+        """
+        from_pos = self.positions(from_sectors)
+        npps = np.asarray(npps, dtype=np.float64)
+        to_pos = self.position(to_sector)
+        old_sq = self.totals ** 2
+        np.subtract.at(self.totals, from_pos, npps)
+        np.subtract.at(self.counts, from_pos, 1)
+        self.totals[to_pos] += npps.sum()
+        self.counts[to_pos] += len(npps)
+        touched = np.unique(np.append(from_pos, to_pos))
+        self._sum_sq += float((self.totals[touched] ** 2 - old_sq[touched]).sum())
+
+    def add(self, sectors, npps):
+        """
+        Add new workload (e.g. freshly ingested incidents) to cells in the
+        given sectors, without re-aggregating the grid. Cost is O(len(npps)).
+        """
+        pos = self.positions(sectors)
+        touched = np.unique(pos)
+        old_sq = self.totals[touched] ** 2
+        np.add.at(self.totals, pos, np.asarray(npps, dtype=np.float64))
+        self._sum_sq += float((self.totals[touched] ** 2 - old_sq).sum())
+
+    def delta_sum_sq(self, npps, from_pos, to_pos):
+        """Change in the sum of squared totals if npps moved from_pos -> to_pos."""
+        return 2.0 * npps * (self.totals[to_pos] - self.totals[from_pos] + npps)
+
+    @property
+    def mean(self):
+        return self.totals.sum() / len(self.totals)
+
+    @property
+    def variance(self):
+        """Population variance of sector totals (same as np.var)."""
+        mean = self.mean
+        return max(self._sum_sq / len(self.totals) - mean * mean, 0.0)
+
+    @property
+    def max_min_ratio(self):
+        return max_min_ratio(self.totals)
+
+    def excess_sectors(self, tolerance=0.0):
+        """Sectors whose total exceeds the mean by more than tolerance (a fraction), heaviest first."""
+        order = np.argsort(-self.totals, kind="stable")
+        return [int(self.sectors[i]) for i in order if self.totals[i] > self.mean * (1.0 + tolerance)]
+
+    def most_deficient(self):
+        """Sector with the lowest total."""
+        return int(self.sectors[np.argmin(self.totals)])
+
+    def snapshot(self):
+        """Copy of the current totals, for later diffs."""
+        return self.totals.copy()
+
+    def to_frame(self):
+        """DataFrame view with columns: Sector, sector_total_npps"""
+        return pd.DataFrame({"Sector": self.sectors, "sector_total_npps": self.totals})
+
+    def diff_frame(self, old_totals, sector_list):
+        """
+        NPPS difference for the specified sectors against an earlier snapshot.
+        Returns DataFrame: Sector, sector_total_npps_old, sector_total_npps_new, npps_diff
+        """
+        pos = np.sort(self.positions(sector_list))
+        return pd.DataFrame({
+            "Sector": self.sectors[pos],
+            "sector_total_npps_old": old_totals[pos],
+            "sector_total_npps_new": self.totals[pos],
+            "npps_diff": self.totals[pos] - old_totals[pos]
+        })